@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+
+from DataServer.videoCatalog import parseSegmentName
+
+MANIFEST_NAME = 'archive_manifest.jsonl'
+
+
+def isArchivable(path: str) -> bool:
+    """Whether a file in the data directory is one the archiver copies: a
+    video segment or a raw data file.
+    """
+    return path.endswith('.bin') or parseSegmentName(path) is not None
+
+
+class Archiver:
+    """Copies closed video segments and raw data files from the data
+    directory to an archive directory, keeping their relative paths.
+
+    Files are handed over with Archiver.submit as they are closed.  Up to
+    max_transfers files are copied at a time.  Each copy streams the file in
+    chunk_bytes chunks on a thread pool, and hashes the current chunk while
+    it is written out and the next one is read.  A copy goes to a .part file
+    that is renamed once it is complete and synced.  An interrupted copy is
+    resumed from the part of the .part file that matches the source.
+
+    Completed files are appended to a manifest in the archive directory with
+    their size, modification time and SHA-256.  Files that are in the
+    manifest with the same size and modification time are not copied again.
+    """
+
+    def __init__(self, data_dir: str, archive_dir: str, max_transfers: int = 2,
+                 chunk_bytes: int = 1024 * 1024,
+                 retry_interval_s: float = 60.0) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.data_dir = os.path.abspath(data_dir)
+        self.archive_dir = os.path.abspath(archive_dir)
+        self.max_transfers = max_transfers
+        self.chunk_bytes = chunk_bytes
+        self.retry_interval_s = retry_interval_s
+        self.manifest_path = os.path.join(self.archive_dir, MANIFEST_NAME)
+        # Read, write and hash of each transfer can all be running at once
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=3 * max_transfers, thread_name_prefix='Archiver')
+        self.__manifest_lock = threading.Lock()
+        # Relative path to size and modification time of archived files
+        self.__archived: Dict[str, Tuple[int, int]] = {}
+        self.__queue: Optional[asyncio.Queue[str]] = None
+        self.__pending: Set[str] = set()
+        self.__workers: Set[asyncio.Task] = set()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.files = 0
+        self.bytes_copied = 0
+        self.failures = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self.__pending)
+
+    async def start(self, scan: bool = False) -> None:
+        """Loads the manifest and starts the transfers.
+
+        Args:
+            scan (bool, optional): Also submit the files that were closed
+            before now and are not in the manifest yet. Defaults to False.
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__queue = asyncio.Queue()
+        started = dt.datetime.now().timestamp()
+        await self.__run(self.__loadManifest)
+        for _ in range(self.max_transfers):
+            self.__workers.add(asyncio.create_task(self.__worker()))
+        if scan:
+            for path in await self.__run(self.__scan, started):
+                self.__enqueue(path)
+
+    def submit(self, path: str) -> None:
+        """Queues a closed file for archiving.  This may be called from any
+        thread.
+
+        Args:
+            path (str): File in the data directory
+        """
+        assert(self.__loop)
+        self.__loop.call_soon_threadsafe(self.__enqueue, os.path.abspath(path))
+
+    def __enqueue(self, path: str) -> None:
+        assert(self.__queue)
+        if path in self.__pending:
+            return
+        if os.path.commonpath([path, self.data_dir]) != self.data_dir:
+            self._log.warning(f'Not archiving {path}, it is outside of '
+                              f'{self.data_dir}')
+            return
+        self.__pending.add(path)
+        self.__queue.put_nowait(path)
+
+    async def __run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        assert(self.__loop)
+        return await self.__loop.run_in_executor(self.__pool, fn, *args)
+
+    async def __worker(self) -> None:
+        assert(self.__queue and self.__loop)
+        while True:
+            path = await self.__queue.get()
+            try:
+                await self.transfer(path)
+            except Exception:
+                self.failures += 1
+                self._log.exception(f'Failed to archive {path}, retrying in '
+                                    f'{self.retry_interval_s} s')
+                self.__loop.call_later(self.retry_interval_s,
+                                       self.__enqueue, path)
+            finally:
+                self.__pending.discard(path)
+
+    async def transfer(self, path: str) -> bool:
+        """Copies a file to the archive, unless it is already there.
+
+        Args:
+            path (str): File in the data directory
+
+        Returns:
+            bool: True if the file was copied
+        """
+        rel_path = os.path.relpath(path, self.data_dir)
+        dest = os.path.join(self.archive_dir, rel_path)
+        src: BinaryIO = await self.__run(open, path, 'rb')
+        try:
+            stat = os.fstat(src.fileno())
+            if self.__archived.get(rel_path) == (stat.st_size, stat.st_mtime_ns):
+                return False
+            offset, digest = await self.__run(self.__resume, src, dest + '.part')
+            dst: BinaryIO = await self.__run(self.__openPart, dest + '.part',
+                                             offset)
+            try:
+                chunk = await self.__run(src.read, self.chunk_bytes)
+                while chunk:
+                    _, _, chunk = await asyncio.gather(
+                        self.__run(digest.update, chunk),
+                        self.__run(dst.write, chunk),
+                        self.__run(src.read, self.chunk_bytes))
+                size = await self.__run(self.__sync, dst)
+            finally:
+                await self.__run(dst.close)
+        finally:
+            await self.__run(src.close)
+        if size != stat.st_size:
+            raise RuntimeError(f'{path} changed while it was archived')
+        await self.__run(os.replace, dest + '.part', dest)
+        await self.__run(self.__record, rel_path, stat.st_size,
+                         stat.st_mtime_ns, digest.hexdigest())
+        self.files += 1
+        self.bytes_copied += size - offset
+        return True
+
+    def __resume(self, src: BinaryIO, part: str) -> Tuple[int, Any]:
+        """Hashes the part of a previous copy that matches the source.
+
+        Returns:
+            Tuple[int, Any]: Offset to continue from, and the hash of the
+            source up to it.  src is left at the offset.
+        """
+        digest = hashlib.sha256()
+        try:
+            part_file = open(part, 'rb')
+        except FileNotFoundError:
+            return (0, digest)
+        offset = 0
+        with part_file:
+            while True:
+                expected = part_file.read(self.chunk_bytes)
+                actual = src.read(len(expected))
+                if not expected or actual != expected:
+                    break
+                digest.update(actual)
+                offset += len(actual)
+        if offset:
+            self._log.info(f'Resuming {part} at {offset} bytes')
+        src.seek(offset)
+        return (offset, digest)
+
+    @staticmethod
+    def __openPart(part: str, offset: int) -> BinaryIO:
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        handle = open(part, 'r+b' if offset else 'wb')
+        handle.truncate(offset)
+        handle.seek(offset)
+        return handle
+
+    @staticmethod
+    def __sync(handle: BinaryIO) -> int:
+        handle.flush()
+        os.fsync(handle.fileno())
+        return handle.tell()
+
+    def __record(self, rel_path: str, size: int, mtime_ns: int,
+                 sha256: str) -> None:
+        line = json.dumps({'path': rel_path, 'size': size,
+                           'mtime_ns': mtime_ns, 'sha256': sha256,
+                           'archived': dt.datetime.now().isoformat()})
+        with self.__manifest_lock:
+            # One write per line, so that workers can share the manifest
+            fd = os.open(self.manifest_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode() + b'\n')
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.__archived[rel_path] = (size, mtime_ns)
+
+    def __loadManifest(self) -> None:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        try:
+            with open(self.manifest_path) as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    self.__archived[entry['path']] = (entry['size'],
+                                                      entry['mtime_ns'])
+        except FileNotFoundError:
+            pass
+
+    def __scan(self, closed_before: float) -> List[str]:
+        paths = []
+        for root, dirs, files in os.walk(self.data_dir):
+            # Never archive the archive
+            dirs[:] = [name for name in dirs
+                       if os.path.join(root, name) != self.archive_dir]
+            for name in files:
+                path = os.path.join(root, name)
+                if not isArchivable(name):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_mtime >= closed_before:
+                    continue
+                rel_path = os.path.relpath(path, self.data_dir)
+                if self.__archived.get(rel_path) != (stat.st_size,
+                                                     stat.st_mtime_ns):
+                    paths.append(path)
+        return paths
+
+    async def join(self) -> None:
+        """Waits until the queued files have been handled.
+        """
+        while self.__pending:
+            await asyncio.sleep(0.01)
+
+    async def close(self) -> None:
+        """Stops the transfers.  Interrupted copies resume on the next start.
+        """
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers.clear()
+        self.__pool.shutdown(wait=True)
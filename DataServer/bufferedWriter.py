@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import pathlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, TextIO
+
+from DataServer.ioExecutor import IOExecutor
+
+
+@dataclass
+class WriterStats:
+    """Counters describing how many lines were turned into how many writes.
+    """
+    lines: int = 0
+    flushes: int = 0
+    bytes_written: int = 0
+    fsyncs: int = 0
+
+    def add(self, other: WriterStats) -> None:
+        self.lines += other.lines
+        self.flushes += other.flushes
+        self.bytes_written += other.bytes_written
+        self.fsyncs += other.fsyncs
+
+
+class BufferedLineWriter:
+    """Keeps a single text file open and batches appended lines.
+
+    Lines written during the same event loop tick are merged into a single
+    write.  Buffered lines are flushed once they exceed flush_bytes, once
+    flush_interval_s has elapsed since the first unflushed line, or when the
+    writer is closed.  The actual write and fsync are executed off of the
+    event loop.
+    """
+
+    total_stats = WriterStats()
+
+    def __init__(self, path: pathlib.Path, flush_bytes: int = 65536,
+                 flush_interval_s: float = 1.0, fsync: bool = True,
+                 io_executor: Optional[IOExecutor] = None) -> None:
+        """Creates a new buffered line writer.  The file is not opened until
+        the first flush.
+
+        Args:
+            path (pathlib.Path): File to append lines to
+            flush_bytes (int, optional): Number of buffered bytes that
+            triggers a flush. Defaults to 65536.
+            flush_interval_s (float, optional): Maximum time a line can remain
+            buffered. Defaults to 1.0.
+            fsync (bool, optional): fsync the file after each flush. Defaults
+            to True.
+            io_executor (Optional[IOExecutor], optional): Executor to perform
+            file operations on, ordered by the parent directory.  If None,
+            the event loop's default executor is used. Defaults to None.
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.stats = WriterStats()
+        self.__flush_bytes = flush_bytes
+        self.__flush_interval_s = flush_interval_s
+        self.__fsync = fsync
+        self.__io = io_executor
+        self.__pending: List[str] = []
+        self.__pending_bytes = 0
+        self.__file: Optional[TextIO] = None
+        self.__lock = asyncio.Lock()
+        self.__timer: Optional[asyncio.TimerHandle] = None
+        self.__flush_scheduled = False
+        self.__tasks: List[asyncio.Task] = []
+
+    def write(self, line: str) -> None:
+        """Queues a line for writing.  This does not block.
+
+        Args:
+            line (str): Line to append, including the trailing newline
+        """
+        self.__pending.append(line)
+        self.__pending_bytes += len(line)
+        self.stats.lines += 1
+        BufferedLineWriter.total_stats.lines += 1
+        loop = asyncio.get_running_loop()
+        if self.__pending_bytes >= self.__flush_bytes:
+            if not self.__flush_scheduled:
+                # Defer to the end of this tick so that all lines queued in
+                # the same tick end up in the same write
+                self.__flush_scheduled = True
+                loop.call_soon(self.__startFlush)
+        elif self.__timer is None:
+            self.__timer = loop.call_later(self.__flush_interval_s,
+                                           self.__startFlush)
+
+    def __startFlush(self) -> None:
+        task = asyncio.create_task(self.flush())
+        self.__tasks.append(task)
+        task.add_done_callback(self.__tasks.remove)
+
+    async def flush(self) -> None:
+        """Writes out all buffered lines.
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        self.__flush_scheduled = False
+        if not self.__pending:
+            return
+        data = ''.join(self.__pending)
+        self.__pending = []
+        self.__pending_bytes = 0
+        async with self.__lock:
+            try:
+                await self.__runBlocking(self.__writeBlocking, data)
+            except Exception:
+                self._log.exception('Failed to write to %s', self.path)
+                return
+        # Counters are only touched from the event loop
+        for stats in (self.stats, BufferedLineWriter.total_stats):
+            stats.flushes += 1
+            stats.bytes_written += len(data)
+            if self.__fsync:
+                stats.fsyncs += 1
+
+    async def __runBlocking(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.__io is not None:
+            return await self.__io.run(str(self.path.parent), fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, fn,
+                                                                 *args)
+
+    def __writeBlocking(self, data: str) -> None:
+        if self.__file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.__file = open(self.path, 'a')
+        self.__file.write(data)
+        self.__file.flush()
+        if self.__fsync:
+            os.fsync(self.__file.fileno())
+
+    async def close(self) -> None:
+        """Flushes all buffered lines and closes the file.
+        """
+        await self.flush()
+        if self.__tasks:
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+        async with self.__lock:
+            if self.__file is not None:
+                await self.__runBlocking(self.__file.close)
+                self.__file = None
+
+
+class WriterGroup:
+    """Set of buffered line writers for a single device directory.
+    """
+
+    def __init__(self, device_dir: pathlib.Path, flush_bytes: int = 65536,
+                 flush_interval_s: float = 1.0, fsync: bool = True,
+                 io_executor: Optional[IOExecutor] = None) -> None:
+        self.device_dir = device_dir
+        self.__io = io_executor
+        self.__flush_bytes = flush_bytes
+        self.__flush_interval_s = flush_interval_s
+        self.__fsync = fsync
+        self.__writers: Dict[str, BufferedLineWriter] = {}
+
+    def getWriter(self, fname: str) -> BufferedLineWriter:
+        if fname not in self.__writers:
+            self.__writers[fname] = BufferedLineWriter(
+                path=pathlib.Path(self.device_dir, fname),
+                flush_bytes=self.__flush_bytes,
+                flush_interval_s=self.__flush_interval_s,
+                fsync=self.__fsync,
+                io_executor=self.__io)
+        return self.__writers[fname]
+
+    def write(self, fname: str, line: str) -> None:
+        self.getWriter(fname).write(line)
+
+    @property
+    def stats(self) -> WriterStats:
+        stats = WriterStats()
+        for writer in self.__writers.values():
+            stats.add(writer.stats)
+        return stats
+
+    async def close(self) -> None:
+        await asyncio.gather(*[writer.close()
+                               for writer in self.__writers.values()])
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import time
+import uuid
+from typing import Callable, Dict, Hashable, Optional
+
+
+class TokenBucket:
+    """Allows events at rate_per_s on average, with bursts of up to burst.
+    """
+
+    def __init__(self, rate_per_s: float, burst: int,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        if rate_per_s <= 0 or burst < 1:
+            raise RuntimeError('Token bucket needs a positive rate and burst')
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.__clock = clock
+        self.__tokens = float(burst)
+        self.__updated = clock()
+
+    def take(self) -> bool:
+        """Takes a token if there is one.
+
+        Returns:
+            bool: True if the event is allowed
+        """
+        now = self.__clock()
+        self.__tokens = min(float(self.burst), self.__tokens +
+                            (now - self.__updated) * self.rate_per_s)
+        self.__updated = now
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+
+class SessionTable:
+    """Keeps a single session per device.  A session that authenticates as
+    a device which already has one takes its place, and the previous one is
+    handed back to be closed.
+
+    A table only knows the sessions of its own process.  With several
+    workers, a unit that reconnects to another worker keeps its previous
+    session on the first one until the liveness tracker reaps it.
+    """
+
+    def __init__(self) -> None:
+        self.__sessions: Dict[uuid.UUID, Hashable] = {}
+        self.superseded = 0
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    def claim(self, deviceID: uuid.UUID,
+              session: Hashable) -> Optional[Hashable]:
+        """Makes session the current session of a device.
+
+        Args:
+            deviceID (uuid.UUID): Device the session authenticated as
+            session (Hashable): New session
+
+        Returns:
+            Optional[Hashable]: Previous session of the device, to be closed
+        """
+        previous = self.__sessions.get(deviceID)
+        self.__sessions[deviceID] = session
+        if previous is None or previous is session:
+            return None
+        self.superseded += 1
+        return previous
+
+    def release(self, deviceID: uuid.UUID, session: Hashable) -> None:
+        # A superseded session must not remove its replacement
+        if self.__sessions.get(deviceID) is session:
+            del self.__sessions[deviceID]
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+import uuid
+from typing import Any, Dict, Optional
+
+from DataServer.devices import Device, DeviceNotFoundError, DeviceTree
+
+
+class DeviceRegistryServer:
+    """Serves a DeviceTree to worker processes over a Unix socket.
+
+    The process that runs this server is the only one that owns the tree and
+    writes it to disk.  Requests and replies are single lines of JSON.
+    """
+
+    def __init__(self, device_tree: DeviceTree, path: str) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.device_tree = device_tree
+        self.path = path
+
+    async def start(self) -> asyncio.AbstractServer:
+        server = await asyncio.start_unix_server(self.__handle, self.path)
+        self._log.info(f'Serving devices on {self.path}')
+        return server
+
+    async def __handle(self, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> None:
+        try:
+            async for line in reader:
+                try:
+                    reply = self.handleRequest(json.loads(line))
+                except Exception as e:
+                    self._log.exception('Bad registry request')
+                    reply = {'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def handleRequest(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        if op == 'get':
+            deviceID = uuid.UUID(request['id'])
+            try:
+                device = self.device_tree.getDeviceByUUID(deviceID)
+            except DeviceNotFoundError:
+                return {'error': 'not_found'}
+            last_comms = device._last_comms.timestamp() \
+                if device._last_comms else None
+            return {'device': device.to_dict(), 'last_comms': last_comms}
+        if op == 'add':
+            deviceID = uuid.UUID(request['id'])
+            self.device_tree.addDevice(Device.from_dict(deviceID=deviceID,
+                                                        **request['device']))
+            return {}
+        if op == 'heard':
+            for id, timestamp in request['devices']:
+                try:
+                    device = self.device_tree.getDeviceByUUID(uuid.UUID(id))
+                except DeviceNotFoundError:
+                    continue
+                device.setLastHeardFrom(dt.datetime.fromtimestamp(timestamp))
+            return {}
+        return {'error': f'Unknown op {op}'}
+
+
+class RemoteDeviceTree:
+    """Worker side of DeviceRegistryServer, with the parts of the DeviceTree
+    interface that ClientHandler uses.  Lookups and registrations are
+    coroutines, so that the worker's event loop keeps running while the
+    owner replies.
+
+    Devices are cached once looked up, so each unit costs one round trip per
+    worker.  Last heard from times are collected and sent to the owner in
+    batches by RemoteDeviceTree.run, every heard_interval_s seconds.
+    """
+
+    def __init__(self, path: str, heard_interval_s: float = 1.0,
+                 timeout_s: float = 5.0) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.heard_interval_s = heard_interval_s
+        self.timeout_s = timeout_s
+        # One request at a time on the connection
+        self.__lock: Optional[asyncio.Lock] = None
+        self.__reader: Optional[asyncio.StreamReader] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__devices: Dict[uuid.UUID, Device] = {}
+        self.__heard: Dict[uuid.UUID, float] = {}
+
+    async def __request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            try:
+                return await asyncio.wait_for(self.__roundTrip(request),
+                                              self.timeout_s)
+            except (OSError, asyncio.TimeoutError, asyncio.CancelledError):
+                # The reply may still arrive, do not read it as the next one
+                self.close()
+                raise
+
+    async def __roundTrip(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        if self.__writer is None:
+            self.__reader, self.__writer = await asyncio.open_unix_connection(
+                self.path)
+        assert(self.__reader)
+        self.__writer.write(json.dumps(request).encode() + b'\n')
+        await self.__writer.drain()
+        line = await self.__reader.readline()
+        if not line:
+            raise ConnectionError('Device registry closed the connection')
+        reply: Dict[str, Any] = json.loads(line)
+        return reply
+
+    async def getDeviceByUUID(self, uuid: uuid.UUID) -> Device:
+        device = self.__devices.get(uuid)
+        if device is not None:
+            return device
+        reply = await self.__request({'op': 'get', 'id': str(uuid)})
+        if reply.get('error') == 'not_found':
+            raise DeviceNotFoundError(uuid)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        device = Device.from_dict(deviceID=uuid, **reply['device'])
+        if reply['last_comms'] is not None:
+            device._last_comms = dt.datetime.fromtimestamp(reply['last_comms'])
+        self.__track(device)
+        return device
+
+    async def addDevice(self, device: Device) -> None:
+        await self.__request({'op': 'add', 'id': str(device.deviceID),
+                              'device': device.to_dict()})
+        self.__track(device)
+
+    def __track(self, device: Device) -> None:
+        # Device.setLastHeardFrom reports back through _updateLastHeardFrom
+        device._tree = self  # type: ignore
+        self.__devices[device.deviceID] = device
+
+    def _updateLastHeardFrom(self, device: Device,
+                             previous: Optional[dt.datetime]) -> None:
+        if device._last_comms is None:
+            return
+        self.__heard[device.deviceID] = device._last_comms.timestamp()
+
+    async def flush(self) -> None:
+        """Sends the pending last heard from times to the owner
+        """
+        if not self.__heard:
+            return
+        heard, self.__heard = self.__heard, {}
+        try:
+            await self.__request({'op': 'heard',
+                                  'devices': [(str(deviceID), timestamp)
+                                              for deviceID, timestamp in heard.items()]})
+        except (OSError, asyncio.TimeoutError):
+            self._log.exception('Failed to report last heard from times')
+            # Try again with the next batch, unless heard from again since
+            for deviceID, timestamp in heard.items():
+                self.__heard.setdefault(deviceID, timestamp)
+
+    async def run(self) -> None:
+        """Sends the last heard from times every heard_interval_s seconds,
+        until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.heard_interval_s)
+            await self.flush()
+
+    def close(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__reader = None
+        self.__writer = None
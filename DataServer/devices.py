@@ -1,14 +1,23 @@
 from __future__ import annotations
+import concurrent.futures
 import datetime as dt
 import enum
+import bisect
+import json
+import marshal
 import os
+import sys
+import threading
 import uuid
-from dataclasses import dataclass, field
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 import pathlib
 
 import yaml
 
+# Use the libyaml bindings when PyYAML was built with them
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class DeviceType(enum.Enum):
     ASM_REMOTE_SENSOR_UNIT = 'ASM_REMOTE_SENSOR_UNIT'
@@ -22,15 +31,59 @@ class DeviceNotFoundError(RuntimeError):
         args = (f'Unable to find device id {deviceID}')
         super().__init__(*args)
 
-@dataclass
 class Device:
-    deviceID: uuid.UUID
-    description: str
-    device_type: DeviceType
-    fw_version: str = ""
-    location: str = ""
-    location_units: str = ""
-    _last_comms: Optional[dt.datetime] = None
+    """A single registered device.
+
+    Devices are slotted records, since the server keeps one per unit in the
+    fleet.  Location and firmware strings are interned, as they are shared
+    by many devices.
+    """
+    __slots__ = ('deviceID', 'description', 'device_type', 'fw_version',
+                 'location', 'location_units', '_last_comms', '_tree')
+
+    def __init__(self, deviceID: uuid.UUID, description: str,
+                 device_type: DeviceType, fw_version: str = "",
+                 location: str = "", location_units: str = "",
+                 _last_comms: Optional[dt.datetime] = None) -> None:
+        self.deviceID = deviceID
+        self.description = description
+        self.device_type = device_type
+        self.fw_version = sys.intern(fw_version)
+        self.location = sys.intern(location)
+        self.location_units = sys.intern(location_units)
+        self._last_comms = _last_comms
+        # Tree that indexes this device, if any
+        self._tree: Optional[DeviceTree] = None
+
+    def __fields(self) -> Tuple[Any, ...]:
+        return (self.deviceID, self.description, self.device_type,
+                self.fw_version, self.location, self.location_units,
+                self._last_comms)
+
+    def __repr__(self) -> str:
+        return (f'Device(deviceID={self.deviceID!r}, '
+                f'description={self.description!r}, '
+                f'device_type={self.device_type!r}, '
+                f'fw_version={self.fw_version!r}, '
+                f'location={self.location!r}, '
+                f'location_units={self.location_units!r}, '
+                f'_last_comms={self._last_comms!r})')
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Device):
+            return NotImplemented
+        return self.__fields() == other.__fields()
+
+    __hash__ = None  # type: ignore
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        # The owning tree is not part of the record
+        return self.__fields()
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        (self.deviceID, self.description, self.device_type, self.fw_version,
+         self.location, self.location_units, self._last_comms) = state
+        self._tree = None
 
     def getDevicePath(self):
         # if self.description:
@@ -39,7 +92,10 @@ class Device:
         return f'{self.deviceID}'
 
     def setLastHeardFrom(self, t: dt.datetime):
+        previous = self._last_comms
         self._last_comms = t
+        if self._tree is not None:
+            self._tree._updateLastHeardFrom(self, previous)
 
     @classmethod
     def from_dict(cls, deviceID: uuid.UUID, **kwargs) -> Device:
@@ -75,31 +131,211 @@ class Device:
         return dict_args
 
 class DeviceTree:
-    def __init__(self, path: str):
+    """Registry of known devices, persisted to a YAML snapshot plus an
+    append-only journal of changes.
+
+    Changes are applied in memory immediately.  Persisting them is deferred
+    to a background thread, which appends all changes made since its last
+    run to the journal in a single write.  Once the journal holds
+    compact_every entries, it is folded into a new snapshot.  Snapshots are
+    written to a temporary file and renamed into place, so devices.yaml is
+    never left truncated.
+
+    Parsing the YAML snapshot is slow for large fleets, so a binary copy of
+    the snapshot is kept next to it.  The cache records the modification
+    time and size of the snapshot it was made from, and is ignored if the
+    snapshot no longer matches.
+
+    Devices are indexed by type, location and firmware version.  The time
+    each device was last heard from is kept in sorted order, so that
+    finding the devices that have gone quiet is a binary search.  Indexes
+    reflect the device fields at the time of DeviceTree.addDevice, so
+    re-add a device after changing those fields.
+    """
+
+    JOURNAL_SUFFIX = '.journal'
+    CACHE_SUFFIX = '.cache'
+    CACHE_VERSION = 1
+
+    def __init__(self, path: str, compact_every: int = 1000):
         if not os.path.isfile(path):
             file_dir = os.path.dirname(path)
             pathlib.Path(file_dir).mkdir(parents=True, exist_ok=True)
             with open(path, 'w') as stream:
                 yaml.safe_dump({}, stream)
-        with open(path, 'r') as stream:
-            tree: Optional[Dict[str, Any]] = yaml.safe_load(stream)
+        self.__path = path
+        self.__journal_path = path + self.JOURNAL_SUFFIX
+        self.__cache_path = path + self.CACHE_SUFFIX
+        self.__compact_every = compact_every
+        self.__lock = threading.Lock()
+        self.__pending: List[str] = []
+        self.__persist_scheduled = False
+        self.__journal_entries = 0
+        self.__persister = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='DeviceTree')
+        self.__persist_future: Optional[concurrent.futures.Future] = None
+
         self.__tree: Dict[uuid.UUID, Device] = {}
+        self.__by_type: Dict[DeviceType, Set[uuid.UUID]] = {}
+        self.__by_location: Dict[str, Set[uuid.UUID]] = {}
+        self.__by_fw_version: Dict[str, Set[uuid.UUID]] = {}
+        # Type, location and firmware each device was indexed under, which
+        # differ from its fields if it was changed in place before re-adding
+        self.__index_keys: Dict[uuid.UUID, Tuple[DeviceType, str, str]] = {}
+        # (last heard from timestamp, device ID), in ascending order
+        self.__comms_order: List[Tuple[float, uuid.UUID]] = []
+        if not self.__loadCache():
+            self.__loadYaml()
+        self.__replayJournal()
+        for device in self.__tree.values():
+            self.__index(device)
+
+    def __cacheKey(self) -> Tuple[int, int, int]:
+        stat = os.stat(self.__path)
+        return (self.CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+    def __loadYaml(self) -> None:
+        with open(self.__path, 'r') as stream:
+            tree: Optional[Dict[str, Any]] = yaml.load(stream,
+                                                       Loader=_YamlLoader)
         if tree is None:
-            return
+            tree = {}
         if not isinstance(tree, dict):
             raise RuntimeError("Unknown devices.yaml format")
         for id, args in tree.items():
             deviceID = uuid.UUID(id)
             device = Device.from_dict(deviceID=deviceID, **args)
             self.__tree[deviceID] = device
-        self.__path = path
-        
-    def saveToDisk(self) -> None:
+        self.__persist_future = self.__persister.submit(
+            self.__writeCache, tree, self.__cacheKey())
+
+    def __loadCache(self) -> bool:
+        """Loads the tree from the binary cache if it matches the snapshot
+
+        Returns:
+            bool: True if the tree was loaded from the cache
+        """
+        try:
+            with open(self.__cache_path, 'rb') as stream:
+                key, records = marshal.load(stream)
+            if tuple(key) != self.__cacheKey():
+                return False
+            tree: Dict[uuid.UUID, Device] = {}
+            for id_bytes, desc, device_type, fw_ver, location, units in records:
+                deviceID = uuid.UUID(bytes=id_bytes)
+                tree[deviceID] = Device(deviceID=deviceID,
+                                        description=desc,
+                                        device_type=DeviceType(device_type),
+                                        fw_version=fw_ver,
+                                        location=location,
+                                        location_units=units)
+        except (OSError, EOFError, ValueError, TypeError):
+            # Missing, stale or unreadable, fall back to the YAML
+            return False
+        self.__tree = tree
+        return True
+
+    def __writeCache(self, device_dict: Dict[str, Dict[str, Any]],
+                     key: Tuple[int, int, int]) -> None:
+        records = []
+        for id, args in device_dict.items():
+            device = Device.from_dict(deviceID=uuid.UUID(id), **args)
+            records.append((device.deviceID.bytes, device.description,
+                            device.device_type.value, device.fw_version,
+                            device.location, device.location_units))
+        tmp_path = self.__cache_path + '.tmp'
+        with open(tmp_path, 'wb') as stream:
+            marshal.dump((key, records), stream)
+        os.replace(tmp_path, self.__cache_path)
+
+    def __replayJournal(self) -> None:
+        if not os.path.isfile(self.__journal_path):
+            return
+        with open(self.__journal_path, 'r+b') as journal:
+            complete = 0
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    # A crash can leave a partially written last line
+                    break
+                complete += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('op') == 'add':
+                    deviceID = uuid.UUID(entry['id'])
+                    self.__tree[deviceID] = Device.from_dict(
+                        deviceID=deviceID, **entry['device'])
+                self.__journal_entries += 1
+            # Drop the partial line, so that the next append starts on a
+            # line of its own
+            journal.truncate(complete)
+
+    def __snapshot(self) -> Dict[str, Dict[str, str]]:
         device_dict: Dict[str, Dict[str, str]] = {}
         for deviceID, device in self.__tree.items():
             device_dict[str(deviceID)] = device.to_dict()
-        with open(self.__path, 'w') as stream:
-            yaml.safe_dump(device_dict, stream)
+        return device_dict
+
+    def __writeSnapshot(self, device_dict: Dict[str, Dict[str, str]]) -> None:
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w') as stream:
+            yaml.dump(device_dict, stream, Dumper=_YamlDumper)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, self.__path)
+        self.__writeCache(device_dict, self.__cacheKey())
+        # The snapshot now holds everything in the journal
+        with open(self.__journal_path, 'w'):
+            pass
+        self.__journal_entries = 0
+
+    def saveToDisk(self) -> None:
+        """Writes a full snapshot of the tree and clears the journal.  This
+        blocks until the snapshot is on disk.
+
+        The snapshot is written by the persister thread, after the changes
+        queued before it, so that it never races a compaction.
+        """
+        self.__persister.submit(self.__save).result()
+
+    def __save(self) -> None:
+        with self.__lock:
+            device_dict = self.__snapshot()
+            self.__pending = []
+        self.__writeSnapshot(device_dict)
+
+    def __persist(self) -> None:
+        with self.__lock:
+            entries = self.__pending
+            self.__pending = []
+            self.__persist_scheduled = False
+            compact = self.__journal_entries + len(entries) >= \
+                self.__compact_every
+            device_dict = self.__snapshot() if compact else None
+        if device_dict is not None:
+            self.__writeSnapshot(device_dict)
+            return
+        if not entries:
+            return
+        with open(self.__journal_path, 'a') as journal:
+            journal.write(''.join(entries))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.__journal_entries += len(entries)
+
+    def __schedulePersist(self) -> None:
+        # Called with the lock held
+        if not self.__persist_scheduled:
+            self.__persist_scheduled = True
+            self.__persist_future = self.__persister.submit(self.__persist)
+
+    def flush(self) -> None:
+        """Blocks until all changes made so far are on disk.
+        """
+        future = self.__persist_future
+        if future is not None:
+            future.result()
 
     def getDeviceByUUID(self, uuid: uuid.UUID) -> Device:
         if uuid not in self.__tree:
@@ -107,7 +343,108 @@ class DeviceTree:
         device_node = self.__tree[uuid]
         return device_node
 
+    def getDevices(self) -> List[Device]:
+        return list(self.__tree.values())
+
+    def __index(self, device: Device) -> None:
+        deviceID = device.deviceID
+        self.__by_type.setdefault(device.device_type, set()).add(deviceID)
+        self.__by_location.setdefault(device.location, set()).add(deviceID)
+        self.__by_fw_version.setdefault(device.fw_version, set()).add(deviceID)
+        self.__index_keys[deviceID] = (device.device_type, device.location,
+                                       device.fw_version)
+        if device._last_comms is not None:
+            bisect.insort(self.__comms_order,
+                          (device._last_comms.timestamp(), deviceID))
+        device._tree = self
+
+    def __unindex(self, device: Device) -> None:
+        deviceID = device.deviceID
+        device_type, location, fw_version = self.__index_keys.pop(deviceID)
+        for index, key in ((self.__by_type, device_type),
+                           (self.__by_location, location),
+                           (self.__by_fw_version, fw_version)):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(deviceID)
+                if not ids:
+                    index.pop(key)
+        if device._last_comms is not None:
+            self.__removeComms(device._last_comms, deviceID)
+        device._tree = None
+
+    def __removeComms(self, t: dt.datetime, deviceID: uuid.UUID) -> None:
+        entry = (t.timestamp(), deviceID)
+        idx = bisect.bisect_left(self.__comms_order, entry)
+        if idx < len(self.__comms_order) and self.__comms_order[idx] == entry:
+            del self.__comms_order[idx]
+
+    def _updateLastHeardFrom(self, device: Device,
+                             previous: Optional[dt.datetime]) -> None:
+        """Called by Device.setLastHeardFrom to keep the time index sorted
+        """
+        if previous is not None:
+            self.__removeComms(previous, device.deviceID)
+        if device._last_comms is not None:
+            entry = (device._last_comms.timestamp(), device.deviceID)
+            # Usually the newest entry, which is a plain append
+            if not self.__comms_order or self.__comms_order[-1] <= entry:
+                self.__comms_order.append(entry)
+            else:
+                bisect.insort(self.__comms_order, entry)
+
+    def __lookup(self, ids: Optional[Set[uuid.UUID]]) -> List[Device]:
+        if not ids:
+            return []
+        return [self.__tree[deviceID] for deviceID in ids]
+
+    def getDevicesByType(self, device_type: DeviceType) -> List[Device]:
+        return self.__lookup(self.__by_type.get(device_type))
+
+    def getDevicesByLocation(self, location: str) -> List[Device]:
+        return self.__lookup(self.__by_location.get(location))
+
+    def getDevicesByFirmware(self, fw_version: str) -> List[Device]:
+        return self.__lookup(self.__by_fw_version.get(fw_version))
+
+    def getStaleDevices(self, cutoff: dt.datetime) -> List[Device]:
+        """Finds the devices last heard from before cutoff.  Devices that
+        were never heard from are not included.
+
+        Args:
+            cutoff (dt.datetime): Devices heard from at or after this time are
+            not stale
+
+        Returns:
+            List[Device]: Stale devices, least recently heard from first
+        """
+        idx = bisect.bisect_left(self.__comms_order, (cutoff.timestamp(),))
+        return [self.__tree[deviceID]
+                for _, deviceID in self.__comms_order[:idx]]
+
+    def getSilentDevices(self) -> List[Device]:
+        """Finds the devices that were never heard from
+
+        Returns:
+            List[Device]: Devices without a last heard from time
+        """
+        return [device for device in self.__tree.values()
+                if device._last_comms is None]
+
     def addDevice(self, device: Device) -> None:
-        self.__tree[device.deviceID] = device
-        self.saveToDisk()
+        """Adds or replaces a device.  This does not block, the change is
+        persisted in the background.
 
+        Args:
+            device (Device): Device to add
+        """
+        entry = json.dumps({'op': 'add', 'id': str(device.deviceID),
+                            'device': device.to_dict()})
+        with self.__lock:
+            previous = self.__tree.get(device.deviceID)
+            if previous is not None:
+                self.__unindex(previous)
+            self.__tree[device.deviceID] = device
+            self.__index(device)
+            self.__pending.append(entry + '\n')
+            self.__schedulePersist()
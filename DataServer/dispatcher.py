@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import (Any, Awaitable, Callable, Dict, Hashable, Optional, Set,
+                    Tuple)
+
+from DataServer.metrics import Histogram
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+class PacketDispatcher:
+    """Runs packet handlers for a single client as tracked tasks.
+
+    Unordered handlers run concurrently, at most max_concurrency at a time.
+    Ordered handlers run one packet at a time per handler, in the order the
+    packets were dispatched, with at most max_concurrency packets waiting per
+    handler.  PacketDispatcher.dispatch waits while these limits are
+    reached, which holds back the receive loop.  Handler exceptions are
+    logged and counted.  PacketDispatcher.close lets the ordered handlers
+    finish their queued packets, and cancels the rest.  If a latency
+    histogram is given, the run time of every handler is recorded in it,
+    labelled with the handler name.
+    """
+
+    def __init__(self, max_concurrency: int = 32,
+                 latency: Optional[Histogram] = None) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.max_concurrency = max_concurrency
+        self.__latency = latency
+        self.__slots = asyncio.Semaphore(max_concurrency)
+        self.__tasks: Set[asyncio.Task] = set()
+        self.__lanes: Dict[Hashable, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        self.__waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def queued(self) -> int:
+        """Number of packets dispatched but not yet being handled
+        """
+        return self.__waiting + sum(lane.qsize()
+                                    for lane, _ in self.__lanes.values())
+
+    async def dispatch(self, handler: Handler, packet: Any,
+                       ordered: bool = False) -> None:
+        """Schedules handler(packet).
+
+        Args:
+            handler (Handler): Packet handler coroutine function
+            packet (Any): Packet to handle
+            ordered (bool, optional): Run after all previously dispatched
+            packets for the same handler have been handled. Defaults to False.
+        """
+        if ordered:
+            if handler not in self.__lanes:
+                lane: asyncio.Queue = asyncio.Queue(self.max_concurrency)
+                task = asyncio.create_task(self.__runLane(handler, lane))
+                self.__lanes[handler] = (lane, task)
+            self.__waiting += 1
+            try:
+                await self.__lanes[handler][0].put(packet)
+            finally:
+                self.__waiting -= 1
+            return
+
+        self.__waiting += 1
+        try:
+            await self.__slots.acquire()
+        finally:
+            self.__waiting -= 1
+        task = asyncio.create_task(self.__run(handler, packet))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__onDone)
+
+    def __onDone(self, task: asyncio.Task) -> None:
+        self.__tasks.discard(task)
+        self.__slots.release()
+
+    async def __run(self, handler: Handler, packet: Any) -> None:
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            await handler(packet)
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            self._log.exception('Handler %s failed for %s',
+                                getattr(handler, '__name__', handler), packet)
+        finally:
+            self.in_flight -= 1
+            if self.__latency is not None:
+                self.__latency.labels(getattr(handler, '__name__', 'unknown')
+                                      ).observe(time.perf_counter() - start)
+
+    async def __runLane(self, handler: Handler, lane: asyncio.Queue) -> None:
+        while True:
+            packet = await lane.get()
+            try:
+                await self.__run(handler, packet)
+            finally:
+                lane.task_done()
+
+    async def close(self, drain_timeout_s: float = 5.0) -> None:
+        """Cancels the running unordered handlers, then waits for the
+        ordered handlers to work through their queued packets, so that
+        ordered streams such as event logs are not cut short.  Ordered
+        handlers still running after drain_timeout_s are cancelled.
+
+        Args:
+            drain_timeout_s (float, optional): Time to wait for the ordered
+            handlers. Defaults to 5.0.
+        """
+        tasks = list(self.__tasks)
+        for task in tasks:
+            task.cancel()
+        lanes = [lane.join() for lane, _ in self.__lanes.values()]
+        if lanes:
+            try:
+                await asyncio.wait_for(asyncio.gather(*lanes),
+                                       drain_timeout_s)
+            except asyncio.TimeoutError:
+                self._log.warning('Ordered handlers did not finish in %.1f '
+                                  's, cancelling them with %d packets queued',
+                                  drain_timeout_s, self.queued)
+        lane_tasks = [task for _, task in self.__lanes.values()]
+        for task in lane_tasks:
+            task.cancel()
+        tasks.extend(lane_tasks)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__tasks.clear()
+        self.__lanes.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
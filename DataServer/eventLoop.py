@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+from DataServer.metrics import Histogram
+
+EVENT_LOOPS = ('asyncio', 'uvloop', 'auto')
+
+
+def installEventLoop(name: str) -> str:
+    """Selects the event loop used by later asyncio.run calls.
+
+    Args:
+        name (str): 'asyncio' for the standard loop, 'uvloop' to require
+        uvloop, or 'auto' to use uvloop when it is installed
+
+    Raises:
+        RuntimeError: Unknown loop, or uvloop requested but not installed
+
+    Returns:
+        str: Name of the loop that was installed
+    """
+    if name not in EVENT_LOOPS:
+        raise RuntimeError(f'Unknown event loop {name}')
+    if name == 'asyncio':
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise RuntimeError('uvloop is not installed') from None
+        asyncio.set_event_loop_policy(None)
+        return 'asyncio'
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return 'uvloop'
+
+
+class LoopWatchdog:
+    """Measures how late the event loop wakes up from short sleeps.
+
+    A helper thread watches for wake ups that are overdue by more than
+    threshold_s.  While the loop is still stuck, it captures the stack of the
+    event loop thread, which shows the coroutine that is blocking it.  Once
+    the loop recovers, the stall and the captured stack are logged.
+    """
+
+    def __init__(self, threshold_s: float = 0.1, interval_s: float = 0.05,
+                 histogram: Optional[Histogram] = None) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.threshold_s = threshold_s
+        self.interval_s = interval_s
+        self.__histogram = histogram
+        self.stalls = 0
+        self.max_lag_s = 0.0
+        self.__tick = time.monotonic()
+        self.__blocked_stack: Optional[str] = None
+        self.__loop_thread = 0
+        self.__stop = threading.Event()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.__loop_thread = threading.get_ident()
+        self.__stop.clear()
+        monitor = threading.Thread(target=self.__monitor, name='LoopWatchdog',
+                                   daemon=True)
+        monitor.start()
+        try:
+            while True:
+                start = loop.time()
+                self.__tick = time.monotonic()
+                await asyncio.sleep(self.interval_s)
+                lag = max(0.0, loop.time() - start - self.interval_s)
+                if self.__histogram is not None:
+                    self.__histogram.observe(lag)
+                self.max_lag_s = max(self.max_lag_s, lag)
+                if lag > self.threshold_s:
+                    self.__reportStall(lag)
+        finally:
+            self.__stop.set()
+
+    def __reportStall(self, lag: float) -> None:
+        self.stalls += 1
+        stack, self.__blocked_stack = self.__blocked_stack, None
+        if stack is None:
+            # Too short for the monitor to catch, show where tasks are waiting
+            stack = ''.join(self.__taskStacks())
+        self._log.warning('Event loop blocked for %.3f s:\n%s', lag, stack)
+
+    @staticmethod
+    def __taskStacks() -> List[str]:
+        lines: List[str] = []
+        for task in asyncio.all_tasks():
+            lines.append(f'{task.get_name()}:\n')
+            for frame in task.get_stack(limit=5):
+                lines.extend(traceback.format_stack(frame, limit=1))
+        return lines
+
+    def __monitor(self) -> None:
+        captured_tick = None
+        while not self.__stop.wait(self.threshold_s / 2):
+            tick = self.__tick
+            overdue = time.monotonic() - tick - self.interval_s
+            if overdue <= self.threshold_s or tick == captured_tick:
+                continue
+            frame = sys._current_frames().get(self.__loop_thread)
+            if frame is not None:
+                self.__blocked_stack = ''.join(traceback.format_stack(frame))
+                captured_tick = tick
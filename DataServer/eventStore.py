@@ -0,0 +1,413 @@
+'''Compacted, memory mapped copies of the per-device label and flipper event
+logs.
+'''
+from __future__ import annotations
+
+import argparse
+import bisect
+import datetime as dt
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Text log of each stream, as written by ClientHandler
+STREAM_FILES = {
+    'labels': 'labels.csv',
+    'flipper': 'flipper_data.txt',
+}
+STORE_DIR = 'events'
+INDEX_NAME = 'index.json'
+
+CHUNK_MAGIC = b'ASMEVT01'
+# Magic, event count, first and last timestamp, vocabulary length
+CHUNK_HEADER = struct.Struct('<8sQqqQ')
+
+
+def toMicroseconds(timestamp: dt.datetime) -> int:
+    """Converts a timestamp to integer microseconds since the epoch, without
+    going through a float.
+    """
+    return int(timestamp.replace(microsecond=0).timestamp()) * 1000000 + \
+        timestamp.microsecond
+
+
+def fromMicroseconds(us: int) -> dt.datetime:
+    return dt.datetime.fromtimestamp(us // 1000000).replace(
+        microsecond=us % 1000000)
+
+
+def parseLine(stream: str, line: str) -> Optional[Tuple[dt.datetime, str]]:
+    """Parses a line of a text event log.
+
+    Labels are "<isoformat>, <label>", flipper events are
+    "<timestamp>: in" or "<timestamp>: out".
+
+    Args:
+        stream (str): Stream name, a key of STREAM_FILES
+        line (str): Line, with or without its newline
+
+    Returns:
+        Optional[Tuple[dt.datetime, str]]: Local timestamp and value, or None
+        if the line is not valid
+    """
+    line = line.rstrip('\n')
+    # Labels may contain the separator, flipper timestamps contain colons
+    if stream == 'labels':
+        fields = line.split(', ', 1)
+    else:
+        fields = line.rsplit(': ', 1)
+    if len(fields) != 2:
+        return None
+    try:
+        timestamp = dt.datetime.fromisoformat(fields[0].strip())
+    except ValueError:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return (timestamp, fields[1].strip())
+
+
+def writeChunk(path: str, timestamps: array, codes: array,
+               vocab: List[str]) -> None:
+    """Writes a chunk file, replacing any previous one atomically.
+
+    The file is the header, the JSON vocabulary padded to 8 bytes, the int64
+    timestamps and then the int32 codes, all little endian.
+
+    Args:
+        path (str): Chunk path
+        timestamps (array): Sorted microsecond timestamps, typecode 'q'
+        codes (array): Index into vocab of each event, typecode 'i'
+        vocab (List[str]): Values of the codes
+    """
+    assert(timestamps.typecode == 'q' and codes.typecode == 'i')
+    assert(len(timestamps) == len(codes) and len(timestamps) > 0)
+    vocab_bytes = json.dumps(vocab).encode()
+    vocab_bytes += b' ' * (-len(vocab_bytes) % 8)
+    if sys.byteorder != 'little':
+        timestamps = array('q', timestamps)
+        codes = array('i', codes)
+        timestamps.byteswap()
+        codes.byteswap()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as handle:
+        handle.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(timestamps),
+                                       timestamps[0], timestamps[-1],
+                                       len(vocab_bytes)))
+        handle.write(vocab_bytes)
+        timestamps.tofile(handle)
+        codes.tofile(handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class EventSlice:
+    """Events of one day chunk that fall in a window.  timestamps and codes
+    are views of the memory mapped chunk and are not copied.
+    """
+    day: dt.date
+    timestamps: memoryview
+    codes: memoryview
+    vocab: List[str]
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __iter__(self) -> Iterator[Tuple[dt.datetime, str]]:
+        for us, code in zip(self.timestamps, self.codes):
+            yield (fromMicroseconds(us), self.vocab[code])
+
+
+class Chunk:
+    """A memory mapped chunk file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as handle:
+            self.__map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.first, self.last, vocab_len = \
+            CHUNK_HEADER.unpack_from(self.__map)
+        if magic != CHUNK_MAGIC:
+            self.__map.close()
+            raise RuntimeError(f'{path} is not an event chunk')
+        if sys.byteorder != 'little':
+            self.__map.close()
+            raise RuntimeError('Event chunks can only be mapped on little '
+                               'endian machines')
+        self.count = count
+        offset = CHUNK_HEADER.size
+        self.vocab: List[str] = json.loads(
+            self.__map[offset:offset + vocab_len])
+        offset += vocab_len
+        view = memoryview(self.__map)
+        self.timestamps = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.codes = view[offset:offset + 4 * count].cast('i')
+
+    def slice(self, day: dt.date, start_us: int, end_us: int) -> EventSlice:
+        first = bisect.bisect_left(self.timestamps, start_us)
+        last = bisect.bisect_left(self.timestamps, end_us, first)
+        return EventSlice(day=day, timestamps=self.timestamps[first:last],
+                          codes=self.codes[first:last], vocab=self.vocab)
+
+    def read(self) -> Tuple[array, List[str]]:
+        """Copies out the events, for merging.
+
+        Returns:
+            Tuple[array, List[str]]: Timestamps, and the value of each event
+        """
+        values = [self.vocab[code] for code in self.codes]
+        return (array('q', self.timestamps), values)
+
+    def close(self) -> None:
+        self.timestamps.release()
+        self.codes.release()
+        try:
+            self.__map.close()
+        except BufferError:
+            # An EventSlice still refers to it, the map is freed with it
+            pass
+
+
+class EventStore:
+    """Columnar store of one device's events, next to its text logs.
+
+    Each stream gets a directory under events/ with one chunk file per
+    closed day, named YYYY-MM-DD.evt, and an index.json that records the
+    count and time range of every chunk and how far into the text log
+    compaction has got.  The text logs are not modified, compaction only
+    ever reads complete lines past its last position.
+
+    A day is closed once it is before the current local day.  Compaction
+    stops at the first event of a day that is still open, so events that
+    arrive late for a closed day are merged into its chunk on a later run.
+    Queries read the chunks through mmap and parse the text log past the
+    compacted position for the rest.
+    """
+
+    def __init__(self, device_dir: str) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.device_dir = device_dir
+        self.__chunks: Dict[str, Chunk] = {}
+
+    def streamDir(self, stream: str) -> str:
+        return os.path.join(self.device_dir, STORE_DIR, stream)
+
+    def chunkPath(self, stream: str, day: dt.date) -> str:
+        return os.path.join(self.streamDir(stream), f'{day.isoformat()}.evt')
+
+    def readIndex(self, stream: str) -> Dict:
+        try:
+            with open(os.path.join(self.streamDir(stream), INDEX_NAME)) as handle:
+                index: Dict = json.load(handle)
+                return index
+        except FileNotFoundError:
+            return {'position': 0, 'days': {}}
+
+    def __writeIndex(self, stream: str, index: Dict) -> None:
+        path = os.path.join(self.streamDir(stream), INDEX_NAME)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(index, handle, sort_keys=True)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(path + '.tmp', path)
+
+    def compact(self, stream: str, today: Optional[dt.date] = None) -> int:
+        """Moves the closed days of a text log into chunks.  This blocks, call
+        it from the IO executor.
+
+        Args:
+            stream (str): Stream name, a key of STREAM_FILES
+            today (Optional[dt.date], optional): First day that is still
+            open. Defaults to the current local day.
+
+        Returns:
+            int: Number of events compacted
+        """
+        if today is None:
+            today = dt.date.today()
+        log_path = os.path.join(self.device_dir, STREAM_FILES[stream])
+        if not os.path.exists(log_path):
+            return 0
+        index = self.readIndex(stream)
+        position = index['position']
+        if os.path.getsize(log_path) < position:
+            self._log.warning(f'{log_path} shrank, compacting it from the start')
+            position = 0
+        days: Dict[dt.date, List[Tuple[int, str]]] = {}
+        with open(log_path, 'rb') as handle:
+            handle.seek(position)
+            for raw_line in handle:
+                if not raw_line.endswith(b'\n'):
+                    # Still being written
+                    break
+                event = parseLine(stream, raw_line.decode(errors='replace'))
+                if event is not None:
+                    if event[0].date() >= today:
+                        break
+                    days.setdefault(event[0].date(), []).append(
+                        (toMicroseconds(event[0]), event[1]))
+                position += len(raw_line)
+        if position == index['position'] and not days:
+            return 0
+        os.makedirs(self.streamDir(stream), exist_ok=True)
+        compacted = 0
+        for day, events in sorted(days.items()):
+            compacted += len(events)
+            path = self.chunkPath(stream, day)
+            if day.isoformat() in index['days'] and os.path.exists(path):
+                previous = Chunk(path)
+                try:
+                    timestamps, values = previous.read()
+                finally:
+                    previous.close()
+                # A run that failed before writing the index may already
+                # have added these events
+                events = list(set(events).union(zip(timestamps, values)))
+            events.sort()
+            vocab = sorted({value for _, value in events})
+            codes = {value: code for code, value in enumerate(vocab)}
+            writeChunk(path, array('q', (us for us, _ in events)),
+                       array('i', (codes[value] for _, value in events)),
+                       vocab)
+            index['days'][day.isoformat()] = {
+                'count': len(events), 'first': events[0][0],
+                'last': events[-1][0]}
+        index['position'] = position
+        self.__writeIndex(stream, index)
+        return compacted
+
+    def __chunk(self, stream: str, day: str, count: int) -> Chunk:
+        key = f'{stream}/{day}'
+        chunk = self.__chunks.get(key)
+        if chunk is None or chunk.count != count:
+            # New, or rewritten with late events since it was mapped
+            if chunk is not None:
+                chunk.close()
+            chunk = Chunk(self.chunkPath(stream, dt.date.fromisoformat(day)))
+            self.__chunks[key] = chunk
+        return chunk
+
+    def query(self, stream: str, start: dt.datetime,
+              end: dt.datetime) -> List[EventSlice]:
+        """Finds the events of a stream in [start, end).
+
+        Args:
+            stream (str): Stream name, a key of STREAM_FILES
+            start (dt.datetime): Start of the window, local time
+            end (dt.datetime): End of the window, local time
+
+        Returns:
+            List[EventSlice]: Events by day, oldest first
+        """
+        start_us = toMicroseconds(start)
+        end_us = toMicroseconds(end)
+        index = self.readIndex(stream)
+        slices: List[EventSlice] = []
+        for day in sorted(index['days']):
+            entry = index['days'][day]
+            if entry['last'] < start_us or entry['first'] >= end_us:
+                continue
+            chunk = self.__chunk(stream, day, entry['count'])
+            day_slice = chunk.slice(dt.date.fromisoformat(day), start_us, end_us)
+            if len(day_slice):
+                slices.append(day_slice)
+        slices.extend(self.__queryTail(stream, index['position'], start_us,
+                                       end_us))
+        return slices
+
+    def __queryTail(self, stream: str, position: int, start_us: int,
+                    end_us: int) -> List[EventSlice]:
+        log_path = os.path.join(self.device_dir, STREAM_FILES[stream])
+        days: Dict[dt.date, List[Tuple[int, str]]] = {}
+        try:
+            with open(log_path, 'rb') as handle:
+                handle.seek(position)
+                for raw_line in handle:
+                    if not raw_line.endswith(b'\n'):
+                        break
+                    event = parseLine(stream, raw_line.decode(errors='replace'))
+                    if event is None:
+                        continue
+                    us = toMicroseconds(event[0])
+                    if start_us <= us < end_us:
+                        days.setdefault(event[0].date(), []).append(
+                            (us, event[1]))
+        except FileNotFoundError:
+            return []
+        slices: List[EventSlice] = []
+        for day, events in sorted(days.items()):
+            events.sort()
+            vocab = sorted({value for _, value in events})
+            codes = {value: code for code, value in enumerate(vocab)}
+            slices.append(EventSlice(
+                day=day,
+                timestamps=memoryview(array('q', (us for us, _ in events))),
+                codes=memoryview(array('i', (codes[value]
+                                             for _, value in events))),
+                vocab=vocab))
+        return slices
+
+    def close(self) -> None:
+        for chunk in self.__chunks.values():
+            chunk.close()
+        self.__chunks.clear()
+
+
+def compactDataDir(data_dir: str, today: Optional[dt.date] = None) -> int:
+    """Compacts the event logs of every device in a data directory.
+
+    Args:
+        data_dir (str): Data directory, with one directory per device
+        today (Optional[dt.date], optional): First day that is still open.
+        Defaults to the current local day.
+
+    Returns:
+        int: Number of events compacted
+    """
+    compacted = 0
+    for device in sorted(os.listdir(data_dir)):
+        device_dir = os.path.join(data_dir, device)
+        if not os.path.isdir(device_dir):
+            continue
+        store = EventStore(device_dir)
+        for stream in STREAM_FILES:
+            compacted += store.compact(stream, today)
+    return compacted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ASM event store')
+    parser.add_argument('data_dir', help='Server data directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('compact', help='Compact the closed days')
+    query = commands.add_parser('query', help='List events in a window')
+    query.add_argument('device', help='Device directory name')
+    query.add_argument('stream', choices=sorted(STREAM_FILES))
+    query.add_argument('start', type=dt.datetime.fromisoformat,
+                       help='Window start, ISO 8601 local time')
+    query.add_argument('end', type=dt.datetime.fromisoformat,
+                       help='Window end, ISO 8601 local time')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        print(f'Compacted {compactDataDir(args.data_dir)} events')
+        return
+    store = EventStore(os.path.join(args.data_dir, args.device))
+    for day_slice in store.query(args.stream, args.start, args.end):
+        for timestamp, value in day_slice:
+            print(f'{timestamp.isoformat()} {value}')
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
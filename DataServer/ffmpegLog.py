@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import datetime as dt
+import logging
+from typing import Deque, Dict, List, Optional
+
+from DataServer.bufferedWriter import BufferedLineWriter
+
+
+class FFmpegLogParser:
+    """Drains the output of an ffmpeg process started with
+    "-nostats -progress pipe:1".
+
+    Progress reports on stdout are collected into one line per report and
+    written to the stats log.  Everything ffmpeg prints on stderr is written
+    to the info log.  The most recent stderr lines are kept for error
+    reporting.
+    """
+
+    def __init__(self, stats_log: BufferedLineWriter,
+                 info_log: BufferedLineWriter, history: int = 20) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.__stats_log = stats_log
+        self.__info_log = info_log
+        self.progress: Dict[str, str] = {}
+        self.recent: Deque[str] = collections.deque(maxlen=history)
+
+    async def drain(self, proc: asyncio.subprocess.Process) -> None:
+        """Reads stdout and stderr until the process closes them.
+
+        Args:
+            proc (asyncio.subprocess.Process): ffmpeg process
+        """
+        readers = []
+        if proc.stdout is not None:
+            readers.append(self.__readProgress(proc.stdout))
+        if proc.stderr is not None:
+            readers.append(self.__readInfo(proc.stderr))
+        await asyncio.gather(*readers)
+
+    async def __readProgress(self, stream: asyncio.StreamReader) -> None:
+        block: List[str] = []
+        async for raw_line in stream:
+            line = raw_line.decode(errors='replace').strip()
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            self.progress[key] = value
+            block.append(line)
+            # Each report ends with progress=continue or progress=end
+            if key == 'progress':
+                timestamp = dt.datetime.now().isoformat()
+                self.__stats_log.write(f'{timestamp} {" ".join(block)}\n')
+                block = []
+
+    async def __readInfo(self, stream: asyncio.StreamReader) -> None:
+        async for raw_line in stream:
+            line = raw_line.decode(errors='replace').rstrip()
+            if not line:
+                continue
+            self.recent.append(line)
+            self.__info_log.write(f'{line}\n')
+
+    def lastOutput(self) -> Optional[str]:
+        if not self.recent:
+            return None
+        return '\n'.join(self.recent)
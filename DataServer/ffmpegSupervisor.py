@@ -0,0 +1,326 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import (AsyncIterator, Awaitable, Callable, Dict, List, Optional,
+                    Set)
+
+from asyncio.subprocess import Process
+
+
+class AdmissionError(RuntimeError):
+    """Raised when a new stream cannot be admitted by the supervisor
+    """
+
+
+@dataclass
+class StreamStats:
+    name: str
+    pid: int
+    started: float
+    restarts: int
+    cpu_s: float
+    rss_bytes: int
+
+
+def _readProcUsage(pid: int) -> Optional[List[int]]:
+    """Reads the CPU ticks and resident pages of a process from /proc
+
+    Args:
+        pid (int): Process ID
+
+    Returns:
+        Optional[List[int]]: utime + stime in clock ticks and resident set
+        size in pages, or None if the process does not exist
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as stat_file:
+            stat = stat_file.read()
+        with open(f'/proc/{pid}/statm', 'r') as statm_file:
+            statm = statm_file.read().split()
+    except OSError:
+        return None
+    # The command name may contain spaces, fields resume after the last ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    return [int(fields[11]) + int(fields[12]), int(statm[1])]
+
+
+def _procChildren(pid: int) -> List[int]:
+    children: List[int] = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children', 'r') as child_file:
+                children.extend(int(child) for child in child_file.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def processTreeUsage(pid: int) -> List[float]:
+    """Sums the CPU time and resident memory of a process and all of its
+    descendants.  This is only supported on Linux, other platforms report
+    zero usage.
+
+    Args:
+        pid (int): Root process ID
+
+    Returns:
+        List[float]: CPU time in seconds and resident set size in bytes
+    """
+    ticks = 0
+    pages = 0
+    to_visit = [pid]
+    while to_visit:
+        current = to_visit.pop()
+        usage = _readProcUsage(current)
+        if usage is None:
+            continue
+        ticks += usage[0]
+        pages += usage[1]
+        to_visit.extend(_procChildren(current))
+    try:
+        tick_rate = os.sysconf('SC_CLK_TCK')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return [0.0, 0]
+    return [ticks / tick_rate, pages * page_size]
+
+
+class SupervisedStream:
+    """A single ffmpeg capture owned by the supervisor.
+    """
+
+    def __init__(self, supervisor: FFmpegSupervisor, name: str,
+                 launch: Callable[[], Awaitable[Process]],
+                 max_restarts: int) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self.__supervisor = supervisor
+        self.__launch = launch
+        self.__max_restarts = max_restarts
+        self.restarts = 0
+        self.started = time.time()
+        self.proc: Optional[Process] = None
+        self.__stopping = False
+
+    async def start(self) -> None:
+        self.proc = await self.__launch()
+
+    async def wait(self) -> int:
+        """Waits for the stream to end, restarting ffmpeg if it crashes.  A
+        restart that fails to launch ends the stream like a final crash.
+
+        Returns:
+            int: Return code of the last ffmpeg process
+        """
+        assert(self.proc)
+        try:
+            while True:
+                returncode = await self.proc.wait()
+                if returncode == 0 or self.__stopping:
+                    return returncode
+                if self.restarts >= self.__max_restarts:
+                    self._log.error('Stream %s failed with code %d after %d '
+                                    'restarts', self.name, returncode,
+                                    self.restarts)
+                    return returncode
+                self.restarts += 1
+                self._log.warning('Stream %s exited with code %d, restarting '
+                                  '(%d/%d)', self.name, returncode,
+                                  self.restarts, self.__max_restarts)
+                try:
+                    await self.start()
+                except Exception:
+                    self._log.exception('Failed to restart stream %s',
+                                        self.name)
+                    return returncode
+        finally:
+            self.__supervisor._removeStream(self)
+
+    def stop(self) -> None:
+        """Terminates the ffmpeg process without restarting it.
+        """
+        self.__stopping = True
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.terminate()
+
+    def stats(self) -> StreamStats:
+        pid = self.proc.pid if self.proc else 0
+        cpu_s, rss_bytes = processTreeUsage(pid) if pid else [0.0, 0]
+        return StreamStats(name=self.name, pid=pid, started=self.started,
+                           restarts=self.restarts, cpu_s=cpu_s,
+                           rss_bytes=int(rss_bytes))
+
+
+class FFmpegSupervisor:
+    """Owns all of the ffmpeg processes of the server.
+
+    At most max_streams streams run at once.  Further requests wait for a
+    free slot, up to max_queued requests and for at most queue_timeout_s.
+    Requests beyond that are rejected with an AdmissionError.  Streams whose
+    ffmpeg process exits with an error are restarted up to max_restarts
+    times.
+
+    Once started, a stream is watched by the supervisor rather than by the
+    client connection that requested it, so captures keep running if the
+    control connection drops.
+    """
+
+    def __init__(self, max_streams: int = 16, max_queued: int = 16,
+                 queue_timeout_s: float = 30.0, max_restarts: int = 3) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.max_streams = max_streams
+        self.max_queued = max_queued
+        self.queue_timeout_s = queue_timeout_s
+        self.max_restarts = max_restarts
+        self.__active = 0
+        self.__queued = 0
+        self.__slot_freed: Optional[asyncio.Condition] = None
+        self.__streams: Dict[str, SupervisedStream] = {}
+        self.__watchers: Set[asyncio.Task] = set()
+        self.rejected = 0
+
+    @property
+    def active(self) -> int:
+        return self.__active
+
+    @property
+    def queued(self) -> int:
+        return self.__queued
+
+    async def setLimits(self, max_streams: int, max_queued: int,
+                        queue_timeout_s: float, max_restarts: int) -> None:
+        """Changes the limits for streams admitted from now on.  Running
+        streams are not affected, even if there are now more of them than
+        max_streams.
+        """
+        self.max_queued = max_queued
+        self.queue_timeout_s = queue_timeout_s
+        self.max_restarts = max_restarts
+        if self.__slot_freed is None:
+            self.max_streams = max_streams
+            return
+        async with self.__slot_freed:
+            self.max_streams = max_streams
+            # Waiters may fit under a raised limit
+            self.__slot_freed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Holds a stream slot for the duration of an async with block.
+
+        Raises:
+            AdmissionError: No slot became available
+        """
+        if self.__slot_freed is None:
+            self.__slot_freed = asyncio.Condition()
+        async with self.__slot_freed:
+            if self.__active >= self.max_streams:
+                if self.__queued >= self.max_queued:
+                    self.rejected += 1
+                    raise AdmissionError('Too many queued streams')
+                self.__queued += 1
+                try:
+                    await asyncio.wait_for(
+                        self.__slot_freed.wait_for(
+                            lambda: self.__active < self.max_streams),
+                        self.queue_timeout_s)
+                except asyncio.TimeoutError:
+                    self.rejected += 1
+                    raise AdmissionError('Timed out waiting for a free '
+                                         'stream slot') from None
+                finally:
+                    self.__queued -= 1
+            self.__active += 1
+        try:
+            yield
+        finally:
+            async with self.__slot_freed:
+                self.__active -= 1
+                self.__slot_freed.notify()
+
+    async def start(self, name: str,
+                    launch: Callable[[], Awaitable[Process]]
+                    ) -> SupervisedStream:
+        """Starts a supervised stream.  The caller must hold a slot from
+        FFmpegSupervisor.admit.
+
+        Args:
+            name (str): Unique name of the stream
+            launch (Callable[[], Awaitable[Process]]): Coroutine function that
+            starts the ffmpeg process.  This is called again on restarts.
+
+        Returns:
+            SupervisedStream: Started stream
+        """
+        stream = SupervisedStream(self, name, launch, self.max_restarts)
+        await stream.start()
+        self.__streams[name] = stream
+        return stream
+
+    def watch(self, stream: SupervisedStream,
+              cleanup: contextlib.AsyncExitStack,
+              on_exit: Callable[[SupervisedStream], Awaitable[None]]) -> None:
+        """Waits for a stream to end in the background, then calls on_exit and
+        unwinds cleanup, which typically holds the stream's admission slot
+        and port lease.
+
+        Args:
+            stream (SupervisedStream): Started stream
+            cleanup (contextlib.AsyncExitStack): Resources held by the stream
+            on_exit (Callable[[SupervisedStream], Awaitable[None]]): Called
+            after the stream ends
+        """
+        async def watcher():
+            async with cleanup:
+                await stream.wait()
+                await on_exit(stream)
+
+        task = asyncio.create_task(watcher())
+        self.__watchers.add(task)
+        task.add_done_callback(self.__onWatcherDone)
+
+    def __onWatcherDone(self, task: asyncio.Task) -> None:
+        self.__watchers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._log.error('Stream watcher failed', exc_info=task.exception())
+
+    def _removeStream(self, stream: SupervisedStream) -> None:
+        if self.__streams.get(stream.name) is stream:
+            self.__streams.pop(stream.name)
+
+    def stats(self) -> List[StreamStats]:
+        """Reports the resource usage of all running streams.  This reads from
+        /proc, so call it from an executor if it is called often.
+
+        Returns:
+            List[StreamStats]: Usage per stream
+        """
+        return [stream.stats() for stream in list(self.__streams.values())]
+
+    def stop(self, name: str) -> None:
+        """Terminates a stream without restarting it.  Does nothing if the
+        stream has already ended.
+
+        Args:
+            name (str): Name the stream was started with
+        """
+        stream = self.__streams.get(name)
+        if stream is not None:
+            stream.stop()
+
+    def stopAll(self) -> None:
+        for stream in list(self.__streams.values()):
+            stream.stop()
+
+    async def close(self) -> None:
+        """Stops all streams and waits for their cleanup to finish.
+        """
+        self.stopAll()
+        if self.__watchers:
+            await asyncio.gather(*list(self.__watchers),
+                                 return_exceptions=True)
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+
+
+class IOExecutor:
+    """Runs blocking file operations on a bounded thread pool.
+
+    Operations submitted with the same key are executed one at a time in
+    submission order, so that all of the writes for a single device land on
+    disk in the order that they were received.  Operations with different
+    keys run concurrently.
+
+    The number of outstanding operations is tracked against queue_depth.
+    Producers should await IOExecutor.waitForCapacity before accepting more
+    work, which applies backpressure when the disk cannot keep up.
+    """
+
+    def __init__(self, max_workers: int = 4, queue_depth: int = 1024) -> None:
+        """Creates a new IO executor
+
+        Args:
+            max_workers (int, optional): Number of IO threads. Defaults to 4.
+            queue_depth (int, optional): Number of outstanding operations
+            before IOExecutor.waitForCapacity blocks. Defaults to 1024.
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='DataServerIO')
+        self.queue_depth = queue_depth
+        self.__queues: Dict[Hashable, Deque[Tuple[Callable[..., Any],
+                                                  Tuple[Any, ...],
+                                                  asyncio.Future,
+                                                  asyncio.AbstractEventLoop]]] = {}
+        self.__queue_lock = threading.Lock()
+        self.__pending = 0
+        self.__has_capacity = asyncio.Event()
+        self.__has_capacity.set()
+        self.__idle = asyncio.Event()
+        self.__idle.set()
+
+    @property
+    def pending(self) -> int:
+        """Number of operations that have been submitted but not completed
+        """
+        return self.__pending
+
+    async def waitForCapacity(self) -> None:
+        """Blocks while the number of outstanding operations is at or above
+        the configured queue depth.
+        """
+        while self.__pending >= self.queue_depth:
+            self.__has_capacity.clear()
+            await self.__has_capacity.wait()
+
+    def submit(self, key: Hashable, fn: Callable[..., Any],
+               *args: Any) -> asyncio.Future:
+        """Queues fn(*args) for execution after all previously submitted
+        operations with the same key.  This never blocks.
+
+        Args:
+            key (Hashable): Ordering key, typically the device path
+            fn (Callable[..., Any]): Blocking function to execute
+
+        Returns:
+            asyncio.Future: Future resolving to the return value of fn
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending += 1
+        self.__idle.clear()
+        with self.__queue_lock:
+            start_runner = key not in self.__queues
+            if start_runner:
+                self.__queues[key] = collections.deque()
+            self.__queues[key].append((fn, args, future, loop))
+        if start_runner:
+            self.__pool.submit(self.__runKey, key)
+        return future
+
+    async def run(self, key: Hashable, fn: Callable[..., Any],
+                  *args: Any) -> Any:
+        """Waits for queue capacity, then executes fn(*args) in key order.
+
+        Args:
+            key (Hashable): Ordering key, typically the device path
+            fn (Callable[..., Any]): Blocking function to execute
+
+        Returns:
+            Any: Return value of fn
+        """
+        await self.waitForCapacity()
+        return await self.submit(key, fn, *args)
+
+    def __runKey(self, key: Hashable) -> None:
+        while True:
+            with self.__queue_lock:
+                queue = self.__queues[key]
+                if not queue:
+                    self.__queues.pop(key)
+                    return
+                fn, args, future, loop = queue.popleft()
+            try:
+                result = fn(*args)
+            except BaseException as exc:  # pylint: disable=broad-except
+                loop.call_soon_threadsafe(self.__complete, future, None, exc)
+            else:
+                loop.call_soon_threadsafe(self.__complete, future, result,
+                                          None)
+
+    def __complete(self, future: asyncio.Future, result: Any,
+                   exc: BaseException) -> None:
+        self.__pending -= 1
+        if self.__pending < self.queue_depth:
+            self.__has_capacity.set()
+        if self.__pending == 0:
+            self.__idle.set()
+        if future.cancelled():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    async def drain(self) -> None:
+        """Waits until every submitted operation has completed, including
+        ones submitted while waiting.
+        """
+        while self.__pending:
+            self.__idle.clear()
+            await self.__idle.wait()
+
+    def shutdown(self) -> None:
+        """Waits for all queued operations to complete and stops the IO
+        threads.
+        """
+        self.__pool.shutdown(wait=True)
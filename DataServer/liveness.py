@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+import math
+import uuid
+from typing import (Callable, Dict, Generic, Hashable, List, Optional, Set,
+                    TypeVar)
+
+K = TypeVar('K', bound=Hashable)
+
+
+class TimerWheel(Generic[K]):
+    """Expires keys that have not been touched for timeout_ticks ticks.
+
+    Keys live in a ring of buckets, one per tick.  Touching a key moves it to
+    the bucket that the wheel reaches timeout_ticks from now, and advancing
+    the wheel by a tick expires everything in the bucket it arrives at, so
+    every operation is O(1) in the number of keys.  Keys expire between
+    timeout_ticks and timeout_ticks + 1 ticks after their last touch.
+    """
+
+    def __init__(self, timeout_ticks: int) -> None:
+        if timeout_ticks < 1:
+            raise RuntimeError('Timeout must be at least one tick')
+        self.timeout_ticks = timeout_ticks
+        self.__buckets: List[Set[K]] = [set() for _ in range(timeout_ticks + 1)]
+        self.__slot: Dict[K, int] = {}
+        self.__cursor = 0
+
+    def __len__(self) -> int:
+        return len(self.__slot)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__slot
+
+    def touch(self, key: K) -> None:
+        """Adds a key, or restarts its timeout if it is already present.
+
+        Args:
+            key (K): Key to touch
+        """
+        slot = (self.__cursor + self.timeout_ticks) % len(self.__buckets)
+        previous = self.__slot.get(key)
+        if previous == slot:
+            return
+        if previous is not None:
+            self.__buckets[previous].discard(key)
+        self.__buckets[slot].add(key)
+        self.__slot[key] = slot
+
+    def remove(self, key: K) -> None:
+        slot = self.__slot.pop(key, None)
+        if slot is not None:
+            self.__buckets[slot].discard(key)
+
+    def advance(self) -> List[K]:
+        """Moves the wheel forward by one tick.
+
+        Returns:
+            List[K]: Keys that expired, these are removed from the wheel
+        """
+        self.__cursor = (self.__cursor + 1) % len(self.__buckets)
+        bucket = self.__buckets[self.__cursor]
+        expired = list(bucket)
+        bucket.clear()
+        for key in expired:
+            del self.__slot[key]
+        return expired
+
+
+class LivenessTracker:
+    """Tracks client connections by their heartbeats and reaps the ones that
+    go quiet.
+
+    A connection that does not send a heartbeat for timeout_s seconds, from
+    when it connected or from its last heartbeat, is passed to on_expire.
+    The devices behind the connections are reported as online while they
+    have a live connection, and as offline once it is gone.
+    """
+
+    def __init__(self, timeout_s: float, on_expire: Callable[[Hashable], None],
+                 tick_s: Optional[float] = None) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.timeout_s = timeout_s
+        self.tick_s = tick_s if tick_s else min(1.0, timeout_s / 10)
+        self.__on_expire = on_expire
+        self.__wheel: TimerWheel[Hashable] = TimerWheel(
+            max(1, math.ceil(timeout_s / self.tick_s)))
+        # Device ID of each connection, once known
+        self.__devices: Dict[Hashable, uuid.UUID] = {}
+        self.__online: Dict[uuid.UUID, Hashable] = {}
+        self.__last_heard: Dict[uuid.UUID, dt.datetime] = {}
+        self.reaped = 0
+
+    @property
+    def connections(self) -> int:
+        return len(self.__wheel)
+
+    def connect(self, connection: Hashable) -> None:
+        self.__wheel.touch(connection)
+
+    def heard(self, connection: Hashable, deviceID: uuid.UUID) -> None:
+        """Records a heartbeat from the device on a connection.
+
+        Args:
+            connection (Hashable): Connection the heartbeat arrived on
+            deviceID (uuid.UUID): Device that sent it
+        """
+        self.__wheel.touch(connection)
+        self.__devices[connection] = deviceID
+        if self.__online.get(deviceID) is not connection:
+            if deviceID not in self.__online:
+                self._log.info(f'Device {deviceID} online')
+            self.__online[deviceID] = connection
+        self.__last_heard[deviceID] = dt.datetime.now()
+
+    def disconnect(self, connection: Hashable) -> None:
+        """Stops tracking a connection that has closed.
+
+        Args:
+            connection (Hashable): Closed connection
+        """
+        self.__wheel.remove(connection)
+        deviceID = self.__devices.pop(connection, None)
+        # The device may already have reconnected on a new connection
+        if deviceID is not None and self.__online.get(deviceID) is connection:
+            del self.__online[deviceID]
+            self._log.info(f'Device {deviceID} offline')
+
+    def tick(self) -> None:
+        for connection in self.__wheel.advance():
+            self.reaped += 1
+            self._log.warning('Reaping connection %s of device %s after %.1f s '
+                              'without a heartbeat', connection,
+                              self.__devices.get(connection), self.timeout_s)
+            try:
+                self.__on_expire(connection)
+            except Exception:
+                self._log.exception('Failed to reap %s', connection)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick_s
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            next_tick += self.tick_s
+            self.tick()
+
+    @property
+    def online(self) -> int:
+        return len(self.__online)
+
+    def status(self) -> Dict[str, List[Dict[str, Optional[str]]]]:
+        """Lists the devices seen by this tracker.
+
+        Returns:
+            Dict[str, List[Dict[str, Optional[str]]]]: Online and offline
+            devices, each with the time it was last heard from
+        """
+        status: Dict[str, List[Dict[str, Optional[str]]]] = {
+            'online': [], 'offline': []}
+        for deviceID, last_heard in self.__last_heard.items():
+            state = 'online' if deviceID in self.__online else 'offline'
+            status[state].append({'id': str(deviceID),
+                                  'last_heard': last_heard.isoformat()})
+        return status
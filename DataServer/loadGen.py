@@ -0,0 +1,350 @@
+'''Load generator that runs a Server on localhost and drives it with simulated
+sensor units.
+'''
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import math
+import os
+import socket
+import stat
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List
+
+import yaml
+from asm_protocol import codec
+
+from DataServer.ffmpegSupervisor import processTreeUsage
+from DataServer.server import Server
+
+# Stands in for ffmpeg so that RTP starts can be benchmarked without video.
+# Reports progress until it is terminated, like a real capture would.
+STUB_FFMPEG = '''#!{python}
+import signal
+import sys
+import time
+
+signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+frame = 0
+while True:
+    frame += 25
+    sys.stdout.write(f'frame={{frame}}\\nfps=25.0\\nprogress=continue\\n')
+    sys.stdout.flush()
+    time.sleep(1)
+'''
+
+
+@dataclass
+class LoadConfig:
+    units: int = 10
+    duration_s: float = 10.0
+    heartbeat_hz: float = 1.0
+    label_hz: float = 1.0
+    flipper_hz: float = 10.0
+    # RTP start commands sent by each unit, spread over the run
+    rtp_starts: int = 0
+    # Server receive_path, stream or protocol
+    receive_path: str = 'stream'
+
+
+@dataclass
+class LoadReport:
+    units: int
+    duration_s: float
+    packets_sent: int
+    bytes_sent: int
+    packets_handled: int
+    rtp_responses: int
+    handler_p50_s: float
+    handler_p99_s: float
+    rtp_rtt_p50_s: float
+    rtp_rtt_p99_s: float
+    loop_lag_p50_s: float
+    loop_lag_max_s: float
+    rss_per_connection: float
+
+    def format(self) -> str:
+        ms = 1e3
+        return '\n'.join([
+            f'Units:              {self.units}',
+            f'Duration:           {self.duration_s:.1f} s',
+            f'Sent:               {self.packets_sent} packets, '
+            f'{self.bytes_sent} bytes '
+            f'({self.packets_sent / self.duration_s:.0f} packets/s)',
+            f'Handled:            {self.packets_handled} packets '
+            f'({self.packets_handled / self.duration_s:.0f} packets/s)',
+            f'Handler latency:    p50 {self.handler_p50_s * ms:.3f} ms, '
+            f'p99 {self.handler_p99_s * ms:.3f} ms',
+            f'RTP start RTT:      {self.rtp_responses} responses, '
+            f'p50 {self.rtp_rtt_p50_s * ms:.3f} ms, '
+            f'p99 {self.rtp_rtt_p99_s * ms:.3f} ms',
+            f'Event loop lag:     p50 {self.loop_lag_p50_s * ms:.3f} ms, '
+            f'max {self.loop_lag_max_s * ms:.3f} ms',
+            f'Memory/connection:  {self.rss_per_connection / 1024:.1f} KiB',
+        ])
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SimulatedUnit:
+    """A sensor unit that connects to the server and sends heartbeats, labels,
+    flipper data and RTP start commands at fixed rates.
+    """
+
+    def __init__(self, host: str, port: int, server_uuid: uuid.UUID,
+                 config: LoadConfig) -> None:
+        self.uuid = uuid.uuid4()
+        self.host = host
+        self.port = port
+        self.server_uuid = server_uuid
+        self.config = config
+        self.codec = codec.Codec()
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.rtt_s: List[float] = []
+        self.__rtp_sent: Dict[int, float] = {}
+        self.connected = asyncio.Event()
+
+    async def run(self, stop: asyncio.Event) -> None:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        # The server only accepts other packets once the unit is known
+        self.__send(writer, codec.E4E_Heartbeat(self.uuid, self.server_uuid))
+        await writer.drain()
+        self.connected.set()
+        senders = [
+            self.__every(writer, stop, self.config.heartbeat_hz,
+                         lambda: codec.E4E_Heartbeat(self.uuid,
+                                                     self.server_uuid)),
+            self.__every(writer, stop, self.config.label_hz,
+                         lambda: codec.E4E_Data_Labels(
+                             self.uuid, self.server_uuid, label='loadgen',
+                             timestamp=dt.datetime.now())),
+            self.__every(writer, stop, self.config.flipper_hz,
+                         lambda: codec.E4E_Flipper_Data(
+                             self.uuid, self.server_uuid,
+                             direction=codec.E4E_Flipper_Data.OUT,
+                             timestamp=dt.datetime.now())),
+        ]
+        if self.config.rtp_starts:
+            senders.append(self.__startStreams(writer, stop))
+        receiver = asyncio.create_task(self.__receive(reader))
+        try:
+            await asyncio.gather(*senders)
+        finally:
+            writer.close()
+            try:
+                await asyncio.wait_for(receiver, 5)
+            except asyncio.TimeoutError:
+                receiver.cancel()
+
+    def __send(self, writer: asyncio.StreamWriter,
+               packet: codec.binaryPacket) -> None:
+        data = self.codec.encode([packet])
+        writer.write(data)
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+
+    async def __every(self, writer: asyncio.StreamWriter, stop: asyncio.Event,
+                      rate_hz: float, make_packet) -> None:
+        if rate_hz <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        period = 1 / rate_hz
+        next_send = loop.time()
+        while not stop.is_set():
+            self.__send(writer, make_packet())
+            await writer.drain()
+            # Keep to the schedule instead of drifting by the send time
+            next_send += period
+            delay = next_send - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(stop.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def __startStreams(self, writer: asyncio.StreamWriter,
+                             stop: asyncio.Event) -> None:
+        period = self.config.duration_s / self.config.rtp_starts
+        for stream_id in range(self.config.rtp_starts):
+            if stop.is_set():
+                return
+            self.__rtp_sent[stream_id] = time.perf_counter()
+            self.__send(writer, codec.E4E_START_RTP_CMD(self.uuid,
+                                                        self.server_uuid,
+                                                        streamID=stream_id))
+            await writer.drain()
+            try:
+                await asyncio.wait_for(stop.wait(), period)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            for packet in self.codec.decode(data):
+                if isinstance(packet, codec.E4E_START_RTP_RSP):
+                    sent = self.__rtp_sent.pop(packet.streamID, None)
+                    if sent is not None:
+                        self.rtt_s.append(time.perf_counter() - sent)
+
+
+async def measureLoopLag(stop: asyncio.Event, samples: List[float],
+                         interval_s: float = 0.01) -> None:
+    """Records how late the event loop wakes up from a fixed sleep.
+
+    Args:
+        stop (asyncio.Event): Stops sampling when set
+        samples (List[float]): Receives the lag of each wake up in seconds
+        interval_s (float, optional): Sleep interval. Defaults to 0.01.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval_s)
+        samples.append(max(0.0, loop.time() - start - interval_s))
+
+
+def _freePort() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _writeStubFFmpeg(directory: str) -> str:
+    path = os.path.join(directory, 'ffmpeg')
+    with open(path, 'w') as stub:
+        stub.write(STUB_FFMPEG.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+def _currentRSS() -> float:
+    return processTreeUsage(os.getpid())[1]
+
+
+async def runLoad(config: LoadConfig, work_dir: str) -> LoadReport:
+    """Starts a Server in work_dir, runs the simulated units against it and
+    reports the results.  The server and units share this process, so the
+    memory per connection includes both ends of each connection.
+
+    Args:
+        config (LoadConfig): Load to generate
+        work_dir (str): Directory for the configuration and recorded data
+
+    Returns:
+        LoadReport: Results
+    """
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    port = _freePort()
+    rtp_start = _freePort()
+    server_config = {
+        'data_dir': data_dir,
+        'port': port,
+        'server_uuid': str(uuid.uuid4()),
+        'video_increment': 60,
+        'rtsp_port_block': [rtp_start, rtp_start + 100],
+        'ffmpeg_path': _writeStubFFmpeg(work_dir),
+        'ffmpeg_log_dir': os.path.join(work_dir, 'ffmpeg_logs'),
+        'video_catalog_path': os.path.join(work_dir, 'video_catalog.sqlite'),
+        'max_rtp_streams': 100,
+        'rtp_queue_timeout': 1.0,
+        'receive_path': config.receive_path,
+    }
+    config_path = os.path.join(work_dir, 'asm_config.yaml')
+    with open(config_path, 'w') as config_file:
+        yaml.safe_dump(server_config, config_file)
+
+    server = Server(config_path)
+    server_task = asyncio.create_task(server.run())
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+
+    stop = asyncio.Event()
+    lag_samples: List[float] = []
+    lag_task = asyncio.create_task(measureLoopLag(stop, lag_samples))
+    units = [SimulatedUnit('127.0.0.1', port, server.config.uuid, config)
+             for _ in range(config.units)]
+    rss_before = _currentRSS()
+    start = time.perf_counter()
+    unit_tasks = [asyncio.create_task(unit.run(stop)) for unit in units]
+    await asyncio.gather(*[unit.connected.wait() for unit in units])
+    rss_connected = _currentRSS()
+    await asyncio.sleep(max(0.0, config.duration_s -
+                            (time.perf_counter() - start)))
+    stop.set()
+    await asyncio.gather(*unit_tasks, lag_task)
+    duration_s = time.perf_counter() - start
+
+    handled = int(server.metrics.packets_received.total())
+    rtts = [rtt for unit in units for rtt in unit.rtt_s]
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
+    if server.io_executor:
+        server.io_executor.shutdown()
+
+    latency = server.metrics.handler_latency
+    return LoadReport(
+        units=config.units,
+        duration_s=duration_s,
+        packets_sent=sum(unit.packets_sent for unit in units),
+        bytes_sent=sum(unit.bytes_sent for unit in units),
+        packets_handled=handled,
+        rtp_responses=len(rtts),
+        handler_p50_s=latency.quantile(0.5),
+        handler_p99_s=latency.quantile(0.99),
+        rtp_rtt_p50_s=percentile(rtts, 0.5),
+        rtp_rtt_p99_s=percentile(rtts, 0.99),
+        loop_lag_p50_s=percentile(lag_samples, 0.5),
+        loop_lag_max_s=max(lag_samples, default=math.nan),
+        rss_per_connection=(rss_connected - rss_before) / max(1, config.units))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ASM Data '
+                                     'Server with simulated sensor units')
+    parser.add_argument('--units', type=int, default=LoadConfig.units)
+    parser.add_argument('--duration', type=float, default=LoadConfig.duration_s)
+    parser.add_argument('--heartbeat-hz', type=float,
+                        default=LoadConfig.heartbeat_hz)
+    parser.add_argument('--label-hz', type=float, default=LoadConfig.label_hz)
+    parser.add_argument('--flipper-hz', type=float,
+                        default=LoadConfig.flipper_hz)
+    parser.add_argument('--rtp-starts', type=int, default=LoadConfig.rtp_starts,
+                        help='RTP start commands per unit')
+    parser.add_argument('--receive-path', choices=('stream', 'protocol'),
+                        default=LoadConfig.receive_path)
+    args = parser.parse_args()
+    config = LoadConfig(units=args.units, duration_s=args.duration,
+                        heartbeat_hz=args.heartbeat_hz, label_hz=args.label_hz,
+                        flipper_hz=args.flipper_hz, rtp_starts=args.rtp_starts,
+                        receive_path=args.receive_path)
+    with tempfile.TemporaryDirectory() as work_dir:
+        report = asyncio.run(runLoad(config, work_dir))
+    print(report.format())
+
+
+if __name__ == '__main__':
+    main()
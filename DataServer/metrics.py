@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import logging
+import math
+from typing import (Any, Awaitable, Callable, Dict, List, Optional, Sequence,
+                    Tuple)
+
+# Handler latency buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0)
+
+
+def _formatValue(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _formatLabels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None) -> None:
+        if function is not None and label_names:
+            raise RuntimeError('Function metrics cannot have labels')
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._function = function
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _newChild(self) -> object:
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Returns the child for a set of label values.  Children are cached,
+        so hot paths should keep the returned object instead of calling this
+        on every update.
+        """
+        if len(values) != len(self.label_names):
+            raise RuntimeError(f'{self.name} expects labels {self.label_names}')
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._newChild()
+            self._children[key] = child
+        return child
+
+    def clear(self) -> None:
+        """Removes all children, e.g. before setting the ones that still
+        exist.
+        """
+        self._children.clear()
+
+    def _header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.TYPE}']
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        if self._function is not None:
+            lines.append(f'{self.name} {_formatValue(self._function())}')
+            return lines
+        for key, child in list(self._children.items()):
+            assert(isinstance(child, _Value))
+            lines.append(f'{self.name}{_formatLabels(self.label_names, key)} '
+                         f'{_formatValue(child.value)}')
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing value.  A counter without labels can instead
+    read its value from a function when it is rendered.
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, help_text, label_names, function)
+        if not self.label_names:
+            self.inc = self.labels().inc
+
+    def _newChild(self) -> _Value:
+        return _Value()
+
+    def total(self) -> float:
+        """Sums the counter over all label values
+        """
+        if self._function is not None:
+            return self._function()
+        return sum(child.value for child in list(self._children.values())
+                   if isinstance(child, _Value))
+
+
+class Gauge(_Metric):
+    """Value that can go up and down.  A gauge without labels can instead
+    read its value from a function when it is rendered.
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, help_text, label_names, function)
+        if not self.label_names:
+            value = self.labels()
+            self.inc = value.inc
+            self.dec = value.dec
+            self.set = value.set
+
+    def _newChild(self) -> _Value:
+        return _Value()
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # One extra bucket for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """Distribution of values over fixed buckets
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help_text: str,
+                 label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        if not self.label_names:
+            self.observe = self.labels().observe
+
+    def _newChild(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile over all label values by interpolating within
+        the bucket that contains it.
+
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            float: Estimated value, or nan if nothing was observed.  Values in
+            the overflow bucket are reported as the last bucket bound.
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        for child in list(self._children.values()):
+            assert(isinstance(child, _HistogramValue))
+            counts = [total + count for total, count in zip(counts, child.counts)]
+        total = sum(counts)
+        if total == 0:
+            return math.nan
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, child in list(self._children.items()):
+            assert(isinstance(child, _HistogramValue))
+            bucket_names = self.label_names + ('le',)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                labels = _formatLabels(bucket_names,
+                                       key + (_formatValue(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _formatLabels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {_formatValue(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics, rendered in the Prometheus text format.
+
+    Metrics are plain attribute updates without locking, so they must only be
+    updated from the event loop thread.
+    """
+
+    def __init__(self) -> None:
+        self.__metrics: Dict[str, _Metric] = {}
+
+    def __register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.__metrics:
+            raise RuntimeError(f'Metric {metric.name} already registered')
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str,
+                label_names: Sequence[str] = (),
+                function: Optional[Callable[[], float]] = None) -> Counter:
+        metric = Counter(name, help_text, label_names, function)
+        self.__register(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, label_names: Sequence[str] = (),
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        metric = Gauge(name, help_text, label_names, function)
+        self.__register(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str,
+                  label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.__register(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self.__metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Minimal HTTP server that serves a registry on GET /metrics.  Other
+    paths can serve JSON documents produced by the functions in routes.
+    Metrics that are too slow to read on the event loop can be refreshed by
+    on_scrape, which is awaited before each /metrics render.
+    """
+
+    def __init__(self, registry: MetricsRegistry,
+                 routes: Optional[Dict[str, Callable[[], Any]]] = None,
+                 on_scrape: Optional[Callable[[], Awaitable[None]]] = None
+                 ) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.registry = registry
+        self.routes = routes if routes else {}
+        self.on_scrape = on_scrape
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Starts listening for scrapes.
+
+        Args:
+            host (str): Bind address
+            port (int): Port to listen on
+
+        Returns:
+            asyncio.AbstractServer: Listening server, close it to stop
+        """
+        server = await asyncio.start_server(self.__handle, host, port)
+        self._log.info(f'Serving metrics on {host}:{port}')
+        return server
+
+    async def __handle(self, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            request_line = request.split(b'\r\n', 1)[0].decode(errors='replace')
+            parts = request_line.split()
+            path = parts[1].split('?', 1)[0] if len(parts) >= 2 else ''
+            content_type = 'text/plain; version=0.0.4'
+            if parts and parts[0] == 'GET' and path == '/metrics':
+                status = '200 OK'
+                if self.on_scrape is not None:
+                    try:
+                        await self.on_scrape()
+                    except Exception:
+                        self._log.exception('Failed to refresh metrics')
+                body = self.registry.render().encode()
+            elif parts and parts[0] == 'GET' and path in self.routes:
+                status = '200 OK'
+                content_type = 'application/json'
+                body = json.dumps(self.routes[path]()).encode()
+            else:
+                status = '404 Not Found'
+                body = b'Not Found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
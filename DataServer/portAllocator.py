@@ -1,11 +1,54 @@
 from __future__ import annotations
+import asyncio
+import collections
+import contextlib
 from enum import Enum, auto
 import socket
-from typing import Dict
+import threading
+from typing import AsyncIterator, Deque, Dict, Optional, Set, Tuple
+
+
+def partitionBlock(block_start: int, block_end: int, index: int,
+                   count: int) -> Tuple[int, int]:
+    """Splits a block of ports into count contiguous, non-overlapping parts
+    of near equal size.
+
+    Args:
+        block_start (int): Starting number of the block
+        block_end (int): Ending number of the block
+        index (int): Part to return, from 0 to count - 1
+        count (int): Number of parts
+
+    Raises:
+        RuntimeError: The block has fewer ports than parts
+
+    Returns:
+        Tuple[int, int]: Start and end of the part, in the same convention as
+        block_start and block_end
+    """
+    size = block_end - block_start
+    if size < count:
+        raise RuntimeError(f'Cannot split {size} ports into {count} parts')
+    return (block_start + size * index // count,
+            block_start + size * (index + 1) // count)
+
 
 class PortAllocator:
     """This class provides a method to allocate the next available port in the
     given block of ports.
+
+    Ports are kept in separate queues by status, so that reserving and
+    releasing a port does not need to look at the rest of the block.
+    Released ports do not hold a socket, they are probed again when they are
+    handed out.  Ports
+    found to be in use by another process are not probed again by
+    PortAllocator.reservePort.  Instead, they are re-probed in the background
+    once the allocator runs out of released and unknown ports, or when
+    PortAllocator.reprobe is called.
+
+    Coroutines should use PortAllocator.reserve, PortAllocator.release and
+    PortAllocator.lease, which perform the socket probes on an executor
+    instead of on the event loop.
     """
 
     class PortStatus(Enum):
@@ -14,89 +57,238 @@ class PortAllocator:
         RELEASED=auto()
         USED=auto()
 
-    def __init__(self, block_start: int, block_end: int) -> None:
+    def __init__(self, block_start: int, block_end: int,
+                 bind_address: str = '0.0.0.0') -> None:
         """Initializes the allocator with the specified block of ports
         Args:
             block_start (int): Starting number of block of ports, inclusive
             block_end (int): Ending number of block of ports, inclusive
+            bind_address (str, optional): Address that the ports will be
+            bound on. Defaults to '0.0.0.0'.
         """
 
         self.__start = block_start
         self.__end = block_end
-
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.connect(("8.8.8.8", 80))
-            self.__ip = sock.getsockname()[0]
+        self.__ip = bind_address
 
         self.__portDict: Dict[int, PortAllocator.PortStatus] = {i:PortAllocator.PortStatus.UNKNOWN for i in range(block_start, block_end)}
-        self.__reservedPorts: Dict[int, socket.socket] = {}
+        # Reserved ports that are no longer in the block
+        self.__retiring: Set[int] = set()
+        self.__reserved_count = 0
+
+        self.__released: Deque[int] = collections.deque()
+        self.__unknown: Deque[int] = collections.deque(range(block_start, block_end))
+        self.__used: Deque[int] = collections.deque()
+        self.__lock = threading.Lock()
+        self.__reprobe_lock = threading.Lock()
+        self.__reprobe_thread: Optional[threading.Thread] = None
+
+    @property
+    def reserved(self) -> int:
+        """Number of ports currently reserved
+        """
+        return self.__reserved_count
 
     def __isOpen(self, port:int) -> bool:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            try:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
                 sock.bind((self.__ip, port))
-                return True
-            except:
-                return False
+            return True
+        except OSError:
+            return False
 
     def reservePort(self) -> int:
         """Retrieves the next available port in the specified block of ports.
         This method must check that the port returned is currently available.
-        Once this method returns a particular port, it must not return that 
+        Once this method returns a particular port, it must not return that
         port until PortAllocator.releasePort is called on that port.  This
         method must throw an exception if no ports are currently available.
 
+        Released ports are returned first, followed by ports that have never
+        been probed.  Each port is probed once per hand-out, so this is
+        amortized constant time.  Ports in use by other processes are only
+        picked up again after a background re-probe.
+
         Raises:
             RuntimeError: No free ports
 
         Returns:
             int: Next available port number
         """
-        free_ports = [port for port, status in self.__portDict.items() if status == PortAllocator.PortStatus.RELEASED]
-        for port in free_ports:
-            assert(port in self.__reservedPorts)
-            self.__reservedPorts[port].close()
-            self.__reservedPorts.pop(port)
-            self.__portDict[port] = PortAllocator.PortStatus.RESERVED
-            return port
-        
-        unknown_ports = [port for port, status in self.__portDict.items() if status == PortAllocator.PortStatus.UNKNOWN]
-        for port in unknown_ports:
-            if self.__isOpen(port):
-                self.__portDict[port] = PortAllocator.PortStatus.RESERVED
-                return port
-            else:
+        with self.__lock:
+            while self.__released or self.__unknown:
+                if self.__released:
+                    port = self.__released.popleft()
+                else:
+                    port = self.__unknown.popleft()
+                if self.__isOpen(port):
+                    self.__portDict[port] = PortAllocator.PortStatus.RESERVED
+                    self.__reserved_count += 1
+                    return port
                 self.__portDict[port] = PortAllocator.PortStatus.USED
-        
-        used_ports = [port for port, status in self.__portDict.items() if status == PortAllocator.PortStatus.USED]
-        for port in used_ports:
-            if self.__isOpen(port):
-                self.__portDict[port] = PortAllocator.PortStatus.RESERVED
-                return port
-        
+                self.__used.append(port)
+
+        self.__startReprobe()
         raise RuntimeError("No free ports")
-        
 
     def releasePort(self, port: int) -> None:
         """Releases the lock on the specified port.  After calling this method
         on a specific port, that port may be returned by
         PortAllocator.reservePort.  Passing in an already released port or a
         port not in the specified block shall not result in any internal state
-        change. 
+        change.
 
         Args:
             port (int): Port to release
+
+        Raises:
+            RuntimeError: The port is not in the block, or is not reserved
         """
 
+        with self.__lock:
+            if port in self.__retiring:
+                # Left the block while it was in use, forget it
+                self.__retiring.discard(port)
+                del self.__portDict[port]
+                self.__reserved_count -= 1
+                return
         if port > self.__end or port < self.__start:
             raise RuntimeError('Invalid port')
-        if port in self.__reservedPorts:
-            raise RuntimeError("Double free on port!")
-        self.__reservedPorts[port] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__reservedPorts[port].bind((self.__ip, port))
-        self.__reservedPorts[port].listen(1)
-        self.__portDict[port] = PortAllocator.PortStatus.RELEASED
-        
-
-        
-        
\ No newline at end of file
+        with self.__lock:
+            status = self.__portDict.get(port)
+            if status is None:
+                raise RuntimeError('Invalid port')
+            if status == PortAllocator.PortStatus.RELEASED:
+                raise RuntimeError("Double free on port!")
+            if status != PortAllocator.PortStatus.RESERVED:
+                # Still queued as unknown or used, it must not be queued twice
+                raise RuntimeError(f'Port {port} is not reserved')
+            self.__reserved_count -= 1
+            self.__portDict[port] = PortAllocator.PortStatus.RELEASED
+            self.__released.append(port)
+
+    def reprobe(self) -> int:
+        """Probes all ports that were found to be in use, and makes the ones
+        that are now free available again.
+
+        Returns:
+            int: Number of ports that became available
+        """
+        with self.__reprobe_lock:
+            with self.__lock:
+                used_ports = list(self.__used)
+                self.__used.clear()
+            still_used = []
+            freed = []
+            for port in used_ports:
+                if self.__isOpen(port):
+                    freed.append(port)
+                else:
+                    still_used.append(port)
+            with self.__lock:
+                # Skip ports that PortAllocator.resize removed meanwhile
+                freed = [port for port in freed if self.__portDict.get(port) ==
+                         PortAllocator.PortStatus.USED]
+                for port in freed:
+                    self.__portDict[port] = PortAllocator.PortStatus.UNKNOWN
+                    self.__unknown.append(port)
+                self.__used.extend(port for port in still_used
+                                   if self.__portDict.get(port) ==
+                                   PortAllocator.PortStatus.USED)
+            return len(freed)
+
+    def resize(self, block_start: int, block_end: int) -> None:
+        """Moves the allocator to a new block of ports.  Ports that stay in
+        the block keep their state.  Reserved ports that leave the block stay
+        reserved until they are released, and are then dropped instead of
+        being handed out again.
+
+        Args:
+            block_start (int): Starting number of the new block, inclusive
+            block_end (int): Ending number of the new block, inclusive
+        """
+        block = range(block_start, block_end)
+        with self.__lock:
+            for port, status in list(self.__portDict.items()):
+                if port in block:
+                    continue
+                if status == PortAllocator.PortStatus.RESERVED:
+                    self.__retiring.add(port)
+                    continue
+                del self.__portDict[port]
+            self.__released = collections.deque(
+                port for port in self.__released if port in block)
+            self.__unknown = collections.deque(
+                port for port in self.__unknown if port in block)
+            self.__used = collections.deque(
+                port for port in self.__used if port in block)
+            for port in block:
+                self.__retiring.discard(port)
+                if port not in self.__portDict:
+                    self.__portDict[port] = PortAllocator.PortStatus.UNKNOWN
+                    self.__unknown.append(port)
+            self.__start = block_start
+            self.__end = block_end
+
+    def __startReprobe(self) -> None:
+        with self.__lock:
+            if not self.__used:
+                return
+            if self.__reprobe_thread is not None and \
+                    self.__reprobe_thread.is_alive():
+                return
+            self.__reprobe_thread = threading.Thread(target=self.reprobe,
+                                                     name='PortReprobe',
+                                                     daemon=True)
+            self.__reprobe_thread.start()
+
+    async def reserve(self) -> int:
+        """Asynchronous version of PortAllocator.reservePort.  If the caller
+        is cancelled while the port is being reserved, the port is released
+        again.
+
+        Raises:
+            RuntimeError: No free ports
+
+        Returns:
+            int: Next available port number
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, self.reservePort)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self.__releaseAbandoned)
+            raise
+
+    def __releaseAbandoned(self, future: asyncio.Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        asyncio.get_running_loop().run_in_executor(None, self.releasePort,
+                                                   future.result())
+
+    async def release(self, port: int) -> None:
+        """Asynchronous version of PortAllocator.releasePort.
+
+        Args:
+            port (int): Port to release
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.releasePort, port)
+
+    @contextlib.asynccontextmanager
+    async def lease(self) -> AsyncIterator[int]:
+        """Reserves a port for the duration of an async with block.  The port
+        is released when the block exits, including on cancellation.
+
+        Raises:
+            RuntimeError: No free ports
+
+        Yields:
+            int: Reserved port number
+        """
+        port = await self.reserve()
+        try:
+            yield port
+        finally:
+            await asyncio.shield(self.release(port))
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import datetime as dt
+import logging
+import os
+import pathlib
+import struct
+import time
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+from DataServer.ioExecutor import IOExecutor
+
+# asm_protocol frame layout: sync word, source UUID, destination UUID, class,
+# id, payload length, header checksum, payload, payload checksum
+FRAME_SYNC = b'\xe4\xeb'
+FRAME_HEADER = struct.Struct('<2s16s16sBBHH')
+FRAME_TRAILER_LEN = 2
+# The header checksum covers the header bytes in front of it
+FRAME_CHECKED_LEN = FRAME_HEADER.size - 2
+
+# Maximum number of buffers passed to a single os.writev call
+IOV_MAX = 1024
+
+BufferLike = Union[bytes, memoryview]
+
+INDEX_FILE_NAME = 'data_index.idx'
+# Index record: unix time, packet class, packet ID, byte offset, file name
+INDEX_RECORD = struct.Struct('<dBB6xQ32s')
+
+
+def frameChecksum(data: BufferLike) -> int:
+    """Computes the Fletcher-16 checksum that asm_protocol appends to the
+    header and payload of a frame.
+
+    Args:
+        data (BufferLike): Checksummed bytes
+
+    Returns:
+        int: Checksum, as stored little endian in the frame
+    """
+    sum_a = 0
+    sum_b = 0
+    for byte in data:
+        sum_a = (sum_a + byte) & 0xFF
+        sum_b = (sum_b + sum_a) & 0xFF
+    return sum_a | sum_b << 8
+
+
+def headerValid(data: BufferLike, start: int) -> bool:
+    """Checks the header checksum of the frame header at start, so that a
+    sync word inside junk or a payload is not taken for a frame.
+
+    Args:
+        data (BufferLike): Buffer holding at least a full header at start
+        start (int): Offset of the sync word
+
+    Returns:
+        bool: True if the header checksum matches
+    """
+    view = memoryview(data)
+    checksum = int.from_bytes(
+        view[start + FRAME_CHECKED_LEN:start + FRAME_HEADER.size], 'little')
+    return frameChecksum(view[start:start + FRAME_CHECKED_LEN]) == checksum
+
+
+class FrameScanner:
+    """Splits a byte stream into asm_protocol frames without copying.
+
+    Complete frames are returned as memoryview slices of the buffer that was
+    passed in.  Only a frame that is split across two reads is copied, in
+    order to join it with the rest of the frame on the next call.  A sync
+    word whose header checksum does not match is skipped as junk.
+    """
+
+    def __init__(self) -> None:
+        self.__partial = b''
+        self.discarded_bytes = 0
+
+    def scan(self, data: bytes) -> List[Tuple[int, int, memoryview]]:
+        """Returns the complete frames in data, preceded by any partial frame
+        left over from the previous call.
+
+        Args:
+            data (bytes): Bytes received from the client
+
+        Returns:
+            List[Tuple[int, int, memoryview]]: Packet class, packet ID and
+            frame bytes of each complete frame
+        """
+        if self.__partial:
+            data = self.__partial + data
+            self.__partial = b''
+        view = memoryview(data)
+        frames: List[Tuple[int, int, memoryview]] = []
+        pos = 0
+        n_bytes = len(data)
+        while pos < n_bytes:
+            start = data.find(FRAME_SYNC, pos)
+            if start < 0:
+                # Keep a trailing first sync byte, it may start the next frame
+                if data[-1:] == FRAME_SYNC[:1]:
+                    self.discarded_bytes += n_bytes - pos - 1
+                    self.__partial = bytes(view[-1:])
+                else:
+                    self.discarded_bytes += n_bytes - pos
+                break
+            self.discarded_bytes += start - pos
+            if n_bytes - start < FRAME_HEADER.size:
+                self.__partial = bytes(view[start:])
+                break
+            if not headerValid(view, start):
+                self.discarded_bytes += 1
+                pos = start + 1
+                continue
+            _, _, _, packet_class, packet_id, payload_len, _ = \
+                FRAME_HEADER.unpack_from(data, start)
+            end = start + FRAME_HEADER.size + payload_len + FRAME_TRAILER_LEN
+            if end > n_bytes:
+                self.__partial = bytes(view[start:])
+                break
+            frames.append((packet_class, packet_id, view[start:end]))
+            pos = end
+        return frames
+
+
+@dataclass
+class IndexEntry:
+    timestamp: float
+    file_key: Tuple[int, int]
+    offset: int
+    fname: str
+
+
+class DataIndex:
+    """Sidecar index of the .bin files in a device directory.
+
+    The index is a flat file of fixed size records.  A record is appended
+    whenever an endpoint opens a file and then at most once every
+    interval_s while data is written, mapping the time at which a block of
+    data was received to the file and byte offset at which it starts.  Data
+    received at time t for a given (class, id) therefore starts at or after
+    the offset of the last record for that (class, id) with a timestamp at
+    or before t.
+
+    DataIndex.append blocks, and must be called from the IO executor.
+    """
+
+    def __init__(self, device_dir: pathlib.Path,
+                 interval_s: float = 10.0) -> None:
+        self.path = pathlib.Path(device_dir, INDEX_FILE_NAME)
+        self.interval_s = interval_s
+
+    def append(self, timestamp: float, file_key: Tuple[int, int], offset: int,
+               fname: str) -> None:
+        record = INDEX_RECORD.pack(timestamp, file_key[0], file_key[1],
+                                   offset, fname.encode())
+        with open(self.path, 'ab') as index_file:
+            index_file.write(record)
+
+    @staticmethod
+    def read(device_dir: Union[str, pathlib.Path]) -> List[IndexEntry]:
+        """Loads all of the index entries of a device directory
+
+        Args:
+            device_dir (Union[str, pathlib.Path]): Device data directory
+
+        Returns:
+            List[IndexEntry]: Index entries in the order they were written
+        """
+        path = pathlib.Path(device_dir, INDEX_FILE_NAME)
+        if not path.is_file():
+            return []
+        data = path.read_bytes()
+        n_records = len(data) // INDEX_RECORD.size
+        entries = []
+        for timestamp, packet_class, packet_id, offset, fname in \
+                INDEX_RECORD.iter_unpack(data[:n_records * INDEX_RECORD.size]):
+            entries.append(IndexEntry(timestamp, (packet_class, packet_id),
+                                      offset, fname.rstrip(b'\x00').decode()))
+        return entries
+
+    @staticmethod
+    def seek(device_dir: Union[str, pathlib.Path], file_key: Tuple[int, int],
+             timestamp: Union[float, dt.datetime]
+             ) -> Optional[Tuple[pathlib.Path, int]]:
+        """Finds where to start reading the data of the given (class, id) in
+        order to get all data received at or after timestamp.
+
+        Args:
+            device_dir (Union[str, pathlib.Path]): Device data directory
+            file_key (Tuple[int, int]): Packet class and ID
+            timestamp (Union[float, dt.datetime]): Start of the time window
+
+        Returns:
+            Optional[Tuple[pathlib.Path, int]]: File and byte offset, or None
+            if there is no data for file_key
+        """
+        if isinstance(timestamp, dt.datetime):
+            timestamp = timestamp.timestamp()
+        entries = [entry for entry in DataIndex.read(device_dir)
+                   if entry.file_key == file_key]
+        if not entries:
+            return None
+        times = [entry.timestamp for entry in entries]
+        idx = max(bisect.bisect_right(times, timestamp) - 1, 0)
+        return pathlib.Path(device_dir, entries[idx].fname), \
+            entries[idx].offset
+
+
+class RawEndpoint:
+    """Append-only .bin files for a single (class, id) data stream.
+
+    A new file is started once the current one reaches rotate_bytes or has
+    been open for rotate_interval_s.  All methods except RawEndpoint.__init__
+    block, and must be called from the IO executor.
+    """
+
+    def __init__(self, device_dir: pathlib.Path, file_key: Tuple[int, int],
+                 rotate_bytes: int = 0, rotate_interval_s: float = 0,
+                 index: Optional[DataIndex] = None,
+                 on_closed: Optional[Callable[[pathlib.Path], None]] = None) -> None:
+        """Creates a new endpoint.  No file is created until the first write.
+
+        Args:
+            device_dir (pathlib.Path): Device data directory
+            file_key (Tuple[int, int]): Packet class and ID
+            rotate_bytes (int, optional): Maximum file size, or 0 for no
+            limit. Defaults to 0.
+            rotate_interval_s (float, optional): Maximum file duration, or 0
+            for no limit. Defaults to 0.
+            index (Optional[DataIndex], optional): Index to record file
+            positions in. Defaults to None.
+            on_closed (Optional[Callable[[pathlib.Path], None]], optional):
+            Called from the IO executor with the path of each file once it is
+            closed. Defaults to None.
+        """
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.device_dir = device_dir
+        self.file_key = file_key
+        self.__on_closed = on_closed
+        self.__rotate_bytes = rotate_bytes
+        self.__rotate_interval_s = rotate_interval_s
+        self.__index = index
+        self.__file: Optional[BinaryIO] = None
+        self.__opened_at = 0.0
+        self.__size = 0
+        self.__last_indexed = 0.0
+        self.path: Optional[pathlib.Path] = None
+
+    def __open(self) -> BinaryIO:
+        now = time.time()
+        stem = dt.datetime.fromtimestamp(now).strftime('%Y.%m.%d.%H.%M.%S')
+        self.device_dir.mkdir(parents=True, exist_ok=True)
+        self.path = pathlib.Path(self.device_dir, f'{stem}.bin').absolute()
+        suffix = 1
+        # Never share a file with another endpoint or a previous rotation
+        while self.path.exists():
+            self.path = pathlib.Path(self.device_dir,
+                                     f'{stem}_{suffix}.bin').absolute()
+            suffix += 1
+        # Unbuffered, os.writev does the batching
+        self.__file = open(self.path, 'ab', buffering=0)
+        self.__opened_at = now
+        self.__size = 0
+        self.__last_indexed = 0.0
+        self._log.info(f'Opened file endpoint for {self.file_key} at '
+                       f'{self.path}')
+        return self.__file
+
+    def __needsRotation(self, now: float) -> bool:
+        if self.__rotate_bytes and self.__size >= self.__rotate_bytes:
+            return True
+        if self.__rotate_interval_s and \
+                now - self.__opened_at >= self.__rotate_interval_s:
+            return True
+        return False
+
+    def writev(self, buffers: List[BufferLike]) -> int:
+        """Writes the buffers to the end of the file with as few system calls
+        as possible.
+
+        Args:
+            buffers (List[BufferLike]): Data to write
+
+        Returns:
+            int: Number of bytes written
+        """
+        now = time.time()
+        fi = self.__file
+        if fi is not None and not fi.closed and self.__needsRotation(now):
+            self._log.info(f'Rotating file endpoint for {self.file_key}')
+            self.close()
+            fi = None
+        if fi is None or fi.closed:
+            fi = self.__open()
+        fd = fi.fileno()
+        if self.__index is not None and self.path is not None and \
+                now - self.__last_indexed >= self.__index.interval_s:
+            self.__index.append(now, self.file_key, self.__size,
+                                self.path.name)
+            self.__last_indexed = now
+        total = 0
+        for idx in range(0, len(buffers), IOV_MAX):
+            batch = buffers[idx:idx + IOV_MAX]
+            expected = sum(len(buf) for buf in batch)
+            written = os.writev(fd, batch)
+            if written < expected:
+                # Short write, fall back to writing the remainder directly
+                remainder = b''.join(batch)[written:]
+                while remainder:
+                    n_written = os.write(fd, remainder)
+                    remainder = remainder[n_written:]
+            total += expected
+        self.__size += total
+        return total
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+            if self.__on_closed is not None and self.path is not None:
+                self.__on_closed(self.path)
+
+
+class RawDataSink:
+    """Collects data frames per (class, id) and appends them to their .bin
+    endpoints.
+
+    Frames added between two calls to RawDataSink.flush are written with a
+    single os.writev call per endpoint.  Writes are queued on the IO executor
+    under the device's ordering key and are not awaited, so that the receive
+    loop is only held back by the IO executor's queue depth.
+    """
+
+    def __init__(self, device_dir: pathlib.Path, io_executor: IOExecutor,
+                 io_key: str, rotate_bytes: int = 0,
+                 rotate_interval_s: float = 0,
+                 index_interval_s: float = 10.0,
+                 on_closed: Optional[Callable[[pathlib.Path], None]] = None) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.device_dir = device_dir
+        self.__on_closed = on_closed
+        self.__io = io_executor
+        self.__io_key = io_key
+        self.__rotate_bytes = rotate_bytes
+        self.__rotate_interval_s = rotate_interval_s
+        self.__index = DataIndex(device_dir, index_interval_s)
+        self.__endpoints: Dict[Tuple[int, int], RawEndpoint] = {}
+        self.__pending: Dict[Tuple[int, int], List[BufferLike]] = {}
+        self.__flush_scheduled = False
+        self.frames = 0
+        self.bytes_written = 0
+        self.writes = 0
+
+    def add(self, file_key: Tuple[int, int], frame: BufferLike) -> None:
+        """Queues a frame for the given endpoint.
+
+        Args:
+            file_key (Tuple[int, int]): Packet class and ID
+            frame (BufferLike): Frame bytes.  This must not be modified after
+            being passed in.
+        """
+        self.__pending.setdefault(file_key, []).append(frame)
+        self.frames += 1
+
+    def scheduleFlush(self) -> None:
+        """Flushes at the end of the current event loop tick, so that all
+        frames added during this tick are batched together.
+        """
+        if not self.__flush_scheduled:
+            self.__flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        """Submits all queued frames to the IO executor.
+        """
+        self.__flush_scheduled = False
+        for file_key, buffers in self.__pending.items():
+            if file_key not in self.__endpoints:
+                self.__endpoints[file_key] = RawEndpoint(
+                    device_dir=self.device_dir,
+                    file_key=file_key,
+                    rotate_bytes=self.__rotate_bytes,
+                    rotate_interval_s=self.__rotate_interval_s,
+                    index=self.__index,
+                    on_closed=self.__on_closed)
+            endpoint = self.__endpoints[file_key]
+            future = self.__io.submit(self.__io_key, endpoint.writev, buffers)
+            future.add_done_callback(self.__onWritten)
+        self.__pending = {}
+
+    def __onWritten(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._log.error('Failed to write data frames',
+                            exc_info=future.exception())
+            return
+        self.writes += 1
+        self.bytes_written += future.result()
+
+    async def close(self) -> None:
+        """Writes out any queued frames and closes all endpoints.
+        """
+        self.flush()
+        for endpoint in self.__endpoints.values():
+            await self.__io.run(self.__io_key, endpoint.close)
+        self.__endpoints = {}
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+from typing import Any, Callable, Deque, Optional, Tuple
+
+from DataServer.rawSink import (FRAME_HEADER, FRAME_SYNC, FRAME_TRAILER_LEN,
+                                headerValid)
+
+
+class TransportWriter:
+    """The parts of asyncio.StreamWriter that ClientHandler uses, on top of a
+    transport owned by a PacketReceiver.
+    """
+
+    def __init__(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.__writable = asyncio.Event()
+        self.__writable.set()
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    async def drain(self) -> None:
+        if self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        await self.__writable.wait()
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def get_extra_info(self, name: str, default: Any = None) -> Any:
+        return self.transport.get_extra_info(name, default)
+
+    def _pause(self) -> None:
+        self.__writable.clear()
+
+    def _resume(self) -> None:
+        self.__writable.set()
+
+
+class PacketReceiver(asyncio.BufferedProtocol):
+    """Receives asm_protocol frames into a preallocated, reused buffer.
+
+    The transport reads straight into the free tail of the buffer.  After
+    each read, the complete frames at the front are copied out as a single
+    bytes chunk, and any partial frame stays in the buffer until the rest of
+    it arrives.  The buffer is compacted in place when its tail runs low, and
+    only reallocated for a frame that is larger than the whole buffer.
+    Chunks are returned by PacketReceiver.read, which mirrors
+    StreamReader.read.  Reading from the socket is paused while more than
+    max_queued_bytes are waiting to be read.
+    """
+
+    def __init__(self, on_connect: Callable[[PacketReceiver], None],
+                 buffer_size: int = 65536,
+                 max_queued_bytes: Optional[int] = None) -> None:
+        self.__on_connect = on_connect
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__min_free = max(1, buffer_size // 4)
+        # Unconsumed bytes are __buffer[__start:__end]
+        self.__start = 0
+        self.__end = 0
+        self.__chunks: Deque[bytes] = collections.deque()
+        self.__queued_bytes = 0
+        self.max_queued_bytes = max_queued_bytes if max_queued_bytes \
+            else 4 * buffer_size
+        self.__readable = asyncio.Event()
+        self.__eof = False
+        self.__reading_paused = False
+        self.transport: Optional[asyncio.Transport] = None
+        self.writer: Optional[TransportWriter] = None
+        self.bytes_received = 0
+        self.discarded_bytes = 0
+        self.reallocations = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert(isinstance(transport, asyncio.Transport))
+        self.transport = transport
+        self.writer = TransportWriter(transport)
+        self.__on_connect(self)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if len(self.__buffer) - self.__end < self.__min_free:
+            self.__makeRoom()
+        return self.__view[self.__end:]
+
+    def __makeRoom(self) -> None:
+        pending = self.__end - self.__start
+        if len(self.__buffer) - pending >= self.__min_free:
+            # Move the partial frame to the front.  The source overlaps the
+            # destination, so it is copied out first.
+            self.__buffer[:pending] = bytes(self.__view[self.__start:self.__end])
+        else:
+            # A single frame fills the buffer.  Views of the old buffer may
+            # still be alive, so allocate a new one instead of resizing.
+            buffer = bytearray(2 * len(self.__buffer))
+            buffer[:pending] = self.__view[self.__start:self.__end]
+            self.__buffer = buffer
+            self.__view = memoryview(buffer)
+            self.__min_free = len(buffer) // 4
+            self.reallocations += 1
+        self.__start = 0
+        self.__end = pending
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.__end += nbytes
+        self.bytes_received += nbytes
+        while True:
+            first, last = self.__scan()
+            if last <= first:
+                break
+            chunk = bytes(self.__view[first:last])
+            self.__chunks.append(chunk)
+            self.__queued_bytes += len(chunk)
+            self.__readable.set()
+        if self.__start == self.__end:
+            # Nothing partial is left, the next read starts at the front
+            self.__start = self.__end = 0
+        if self.__queued_bytes > self.max_queued_bytes and \
+                not self.__reading_paused and self.transport:
+            self.transport.pause_reading()
+            self.__reading_paused = True
+
+    def __scan(self) -> Tuple[int, int]:
+        """Advances past the next run of back to back complete frames and
+        any junk in front of it.
+
+        Returns:
+            Tuple[int, int]: Start and end of the run, equal if there is none
+        """
+        buffer = self.__buffer
+        pos = self.__start
+        end = self.__end
+        first = -1
+        last = -1
+        while pos < end:
+            sync = buffer.find(FRAME_SYNC, pos, end)
+            if sync < 0:
+                # Keep a trailing first sync byte, it may start the next frame
+                keep = 1 if buffer[end - 1] == FRAME_SYNC[0] else 0
+                self.discarded_bytes += end - pos - keep
+                pos = end - keep
+                break
+            if sync != pos:
+                if first >= 0:
+                    # Junk after the run, left for the next scan
+                    break
+                self.discarded_bytes += sync - pos
+                pos = sync
+            if end - pos < FRAME_HEADER.size:
+                break
+            if not headerValid(self.__view, pos):
+                if first >= 0:
+                    break
+                # A sync word in junk, look for the next one
+                self.discarded_bytes += 1
+                pos += 1
+                continue
+            payload_len = FRAME_HEADER.unpack_from(buffer, pos)[5]
+            frame_end = pos + FRAME_HEADER.size + payload_len + \
+                FRAME_TRAILER_LEN
+            if frame_end > end:
+                break
+            if first < 0:
+                first = pos
+            pos = frame_end
+            last = pos
+        self.__start = pos
+        if first < 0:
+            return (0, 0)
+        return (first, last)
+
+    def eof_received(self) -> bool:
+        self.__eof = True
+        self.__readable.set()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.__eof = True
+        self.__readable.set()
+        if self.writer:
+            self.writer._resume()
+
+    def pause_writing(self) -> None:
+        if self.writer:
+            self.writer._pause()
+
+    def resume_writing(self) -> None:
+        if self.writer:
+            self.writer._resume()
+
+    async def read(self, n: int = -1) -> bytes:
+        """Returns the next chunk of complete frames, or b'' once the
+        connection has closed and all chunks have been read.
+
+        Args:
+            n (int, optional): Accepted for compatibility with
+            StreamReader.read.  Chunks are at most the size of the receive
+            buffer. Defaults to -1.
+
+        Returns:
+            bytes: One or more complete frames
+        """
+        while not self.__chunks:
+            if self.__eof:
+                return b''
+            self.__readable.clear()
+            await self.__readable.wait()
+        chunk = self.__chunks.popleft()
+        self.__queued_bytes -= len(chunk)
+        if self.__reading_paused and \
+                self.__queued_bytes <= self.max_queued_bytes // 2 and \
+                self.transport:
+            self.transport.resume_reading()
+            self.__reading_paused = False
+        return chunk
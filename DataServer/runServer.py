@@ -1,27 +1,34 @@
+import argparse
 import asyncio
 import logging
 import logging.handlers
+import multiprocessing
 import os
 import pathlib
+import queue
+import signal
+import tempfile
 import time
+from typing import Optional
 
 import appdirs
 
-from DataServer.server import Server
+from DataServer.deviceRegistry import DeviceRegistryServer
+from DataServer.devices import DeviceTree
+from DataServer.eventLoop import EVENT_LOOPS, installEventLoop
+from DataServer.server import Server, ServerConfig
 
-def main():
-    os.environ['XDG_CONFIG_DIRS'] = '/usr/local/etc'
-    app_name = 'ASMDataServer'
-    app_author = 'E4E'
+def setupLogging(log_dest: str) -> logging.handlers.QueueListener:
+    """Routes all log records through a queue to a background writer thread,
+    so that formatting and file I/O never run on the event loop.
 
-    if os.getuid() == 0:
-        log_dest = os.path.join('var', 'log', 'asm_server.log')
-    else:
-        log_dir = appdirs.user_log_dir(app_name)
-        pathlib.Path(log_dir).mkdir(parents=True, exist_ok=True)
-        log_dest = os.path.join(log_dir, 'asm_server.log')
+    Args:
+        log_dest (str): Log file path
 
-    print(f"Logging to {log_dest}")
+    Returns:
+        logging.handlers.QueueListener: Started listener, stop it on exit to
+        flush the remaining records
+    """
     root_logger = logging.getLogger()
     # Log to root to begin
     root_logger.setLevel(logging.DEBUG)
@@ -31,34 +38,154 @@ def main():
 
     root_formatter = logging.Formatter('%(asctime)s.%(msecs)03d - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     log_file_handler.setFormatter(root_formatter)
-    root_logger.addHandler(log_file_handler)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.WARN)
 
     error_formatter = logging.Formatter('%(asctime)s.%(msecs)03d - %(name)s - %(levelname)s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     console_handler.setFormatter(error_formatter)
-    root_logger.addHandler(console_handler)
     logging.Formatter.converter = time.gmtime
 
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, log_file_handler,
+                                              console_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
+def findConfig() -> str:
+    app_name = 'ASMDataServer'
+    app_author = 'E4E'
     site_config = os.path.join(appdirs.site_config_dir(
         app_name, app_author), 'asm_config.yaml')
     user_config = os.path.join(appdirs.user_config_dir(
         app_name, app_author), 'asm_config.yaml')
+    if os.path.isfile(site_config):
+        return site_config
+    elif os.path.isfile(user_config):
+        return user_config
+    return 'asm_config.yaml'
+
+def runWorker(config_path: str, worker_index: int, workers: int,
+              registry_path: str, log_dest: str,
+              event_loop: Optional[str]) -> None:
+    """Entry point of a worker process in --workers mode.  Each worker logs
+    to its own file.
+    """
+    # Until Server.run handles it, a forwarded SIGHUP must not end the worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    root, ext = os.path.splitext(log_dest)
+    log_listener = setupLogging(f'{root}.worker{worker_index}{ext}')
+    root_logger = logging.getLogger()
     try:
-        if os.path.isfile(site_config):
-            server = Server(site_config)
-        elif os.path.isfile(user_config):
-            server = Server(user_config)
-        else:
-            server = Server('asm_config.yaml')
-    except Exception as e:
-        root_logger.exception(f"Failed to create server: {e}")
-        return
-    try:
+        server = Server(config_path, worker_index=worker_index,
+                        workers=workers, registry_path=registry_path)
+        selectLoop(event_loop or server.config.event_loop)
         asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
-        root_logger.exception(f"Failed to run server: {e}")
-        
+        root_logger.exception(f"Worker {worker_index} failed: {e}")
+    finally:
+        log_listener.stop()
+
+def selectLoop(event_loop: str) -> None:
+    installed = installEventLoop(event_loop)
+    logging.getLogger().info(f'Using the {installed} event loop')
+
+async def runWorkers(config_path: str, workers: int, log_dest: str,
+                     event_loop: Optional[str] = None) -> None:
+    """Runs the device registry in this process and the servers in workers
+    processes that share the configured port.
+
+    Args:
+        config_path (str): Configuration file path
+        workers (int): Number of worker processes
+        log_dest (str): Log file path, workers log next to it
+        event_loop (Optional[str], optional): Event loop of the workers,
+        overrides the configuration. Defaults to None.
+    """
+    root_logger = logging.getLogger()
+    config = ServerConfig(config_path)
+    device_tree = DeviceTree(os.path.join(config.data_dir, 'devices.yaml'))
+    with tempfile.TemporaryDirectory() as registry_dir:
+        registry_path = os.path.join(registry_dir, 'devices.sock')
+        registry = await DeviceRegistryServer(device_tree, registry_path).start()
+        # Workers start from a clean interpreter instead of a copy of this
+        # process and its threads
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=runWorker,
+                                     args=(config_path, idx, workers,
+                                           registry_path, log_dest,
+                                           event_loop),
+                                     name=f'ASMDataServer-{idx}')
+                     for idx in range(workers)]
+        for process in processes:
+            process.start()
+        loop = asyncio.get_running_loop()
+        # Each worker reloads the configuration itself
+        loop.add_signal_handler(signal.SIGHUP, lambda: [
+            os.kill(process.pid, signal.SIGHUP) for process in processes
+            if process.is_alive() and process.pid is not None])
+        try:
+            await asyncio.gather(*[loop.run_in_executor(None, process.join)
+                                   for process in processes])
+            for process in processes:
+                root_logger.warning(f'{process.name} exited with code '
+                                    f'{process.exitcode}')
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            registry.close()
+            await loop.run_in_executor(None, device_tree.flush)
+
+def main():
+    parser = argparse.ArgumentParser(description='ASM Data Server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of server processes accepting on the '
+                        'configured port')
+    parser.add_argument('--loop', choices=EVENT_LOOPS, default=None,
+                        help='Event loop implementation, overrides the '
+                        'event_loop configuration key')
+    args = parser.parse_args()
+
+    os.environ['XDG_CONFIG_DIRS'] = '/usr/local/etc'
+    app_name = 'ASMDataServer'
+
+    if os.getuid() == 0:
+        log_dest = os.path.join('var', 'log', 'asm_server.log')
+    else:
+        log_dir = appdirs.user_log_dir(app_name)
+        pathlib.Path(log_dir).mkdir(parents=True, exist_ok=True)
+        log_dest = os.path.join(log_dir, 'asm_server.log')
+
+    print(f"Logging to {log_dest}")
+    log_listener = setupLogging(log_dest)
+    root_logger = logging.getLogger()
+
+    config_path = findConfig()
+    try:
+        if args.workers > 1:
+            try:
+                asyncio.run(runWorkers(config_path, args.workers, log_dest,
+                                       args.loop))
+            except Exception as e:
+                root_logger.exception(f"Failed to run workers: {e}")
+            return
+        try:
+            server = Server(config_path)
+        except Exception as e:
+            root_logger.exception(f"Failed to create server: {e}")
+            return
+        try:
+            selectLoop(args.loop or server.config.event_loop)
+            asyncio.run(server.run())
+        except Exception as e:
+            root_logger.exception(f"Failed to run server: {e}")
+    finally:
+        log_listener.stop()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
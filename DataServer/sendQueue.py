@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+from typing import Deque, Generic, List, TypeVar
+
+T = TypeVar('T')
+
+
+class WatermarkQueue(Generic[T]):
+    """Queue that is drained in batches and applies backpressure with
+    hysteresis.
+
+    Once the queue holds high_watermark items, producers block in
+    WatermarkQueue.put.  They are resumed when the consumer comes back for
+    its next batch, meaning that it has finished sending the previous one,
+    and at most low_watermark items are waiting.
+    """
+
+    def __init__(self, high_watermark: int = 256,
+                 low_watermark: int = 64) -> None:
+        if low_watermark > high_watermark:
+            raise RuntimeError('Low watermark above high watermark')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.__items: Deque[T] = collections.deque()
+        self.__not_empty = asyncio.Event()
+        self.__writable = asyncio.Event()
+        self.__writable.set()
+        self.pauses = 0
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    @property
+    def paused(self) -> bool:
+        return not self.__writable.is_set()
+
+    async def put(self, item: T) -> None:
+        """Adds an item, waiting while the queue is above its watermarks.
+
+        Args:
+            item (T): Item to add
+        """
+        while not self.__writable.is_set():
+            await self.__writable.wait()
+        self.put_nowait(item)
+
+    def put_nowait(self, item: T) -> None:
+        """Adds an item regardless of the queue length.
+
+        Args:
+            item (T): Item to add
+        """
+        self.__items.append(item)
+        self.__not_empty.set()
+        if len(self.__items) >= self.high_watermark and \
+                self.__writable.is_set():
+            self.__writable.clear()
+            self.pauses += 1
+
+    async def get_batch(self) -> List[T]:
+        """Removes and returns every queued item, waiting for at least one.
+
+        Returns:
+            List[T]: Queued items, oldest first
+        """
+        # The previous batch has been handled by now
+        if len(self.__items) <= self.low_watermark:
+            self.__writable.set()
+        while not self.__items:
+            self.__not_empty.clear()
+            await self.__not_empty.wait()
+        batch = list(self.__items)
+        self.__items.clear()
+        self.__not_empty.clear()
+        return batch
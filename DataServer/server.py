@@ -1,25 +1,44 @@
 import asyncio
+import collections
+import contextlib
 import datetime as dt
 import logging
 import os
 import pathlib
 import shutil
+import signal
 import socketserver
 import subprocess
-import sys
 import uuid
 from asyncio.streams import StreamReader, StreamWriter
 from threading import Event
-from typing import (Any, Awaitable, BinaryIO, Callable, Dict, List, Optional,
-                    Tuple, Type, Union)
+from typing import (Any, Awaitable, Callable, Deque, Dict, List, Optional,
+                    Set, Tuple, Type, Union)
 
 import appdirs
 import yaml
 from asm_protocol import codec
 
 import DataServer
-from DataServer import devices
-from DataServer.portAllocator import PortAllocator
+from DataServer import bufferedWriter, devices, rawSink
+from DataServer.archiver import Archiver
+from DataServer.connectionGuard import SessionTable, TokenBucket
+from DataServer.deviceRegistry import RemoteDeviceTree
+from DataServer.dispatcher import PacketDispatcher
+from DataServer.eventLoop import EVENT_LOOPS, LoopWatchdog
+from DataServer.eventStore import STREAM_FILES, EventStore
+from DataServer.ffmpegLog import FFmpegLogParser
+from DataServer.ffmpegSupervisor import (AdmissionError, FFmpegSupervisor,
+                                         SupervisedStream)
+from DataServer.ioExecutor import IOExecutor
+from DataServer.liveness import LivenessTracker
+from DataServer.metrics import MetricsRegistry, MetricsServer
+from DataServer.sendQueue import WatermarkQueue
+from DataServer.portAllocator import PortAllocator, partitionBlock
+from DataServer.receiver import PacketReceiver, TransportWriter
+from DataServer.videoCatalog import (CATALOG_NAME, SEGMENT_NAME_FORMAT,
+                                     SegmentListFollower, VideoCatalog,
+                                     defaultCatalogPath)
 
 
 class ServerConfig:
@@ -31,6 +50,60 @@ class ServerConfig:
         'rtsp_port_block': list,
     }
 
+    # Optional keys, mapped to their accepted types and default value
+    OPTIONAL_CONFIG_TYPES = {
+        'event_flush_bytes': ((int,), 65536),
+        'event_flush_interval': ((int, float), 1.0),
+        'event_fsync': ((bool,), True),
+        'io_threads': ((int,), 4),
+        'io_queue_depth': ((int,), 1024),
+        'raw_data_ingest': ((bool,), False),
+        'data_rotate_bytes': ((int,), 256 * 1024 * 1024),
+        'data_increment': ((int,), None),
+        'data_index_interval': ((int, float), 10.0),
+        'rtp_bind_address': ((str,), '0.0.0.0'),
+        'max_rtp_streams': ((int,), 16),
+        'max_queued_rtp_streams': ((int,), 16),
+        'rtp_queue_timeout': ((int, float), 30.0),
+        'ffmpeg_max_restarts': ((int,), 3),
+        'rtp_listen_timeout': ((int, float), 30.0),
+        'packet_log_level': ((str,), 'INFO'),
+        'send_queue_high': ((int,), 256),
+        'send_queue_low': ((int,), 64),
+        'max_packet_handlers': ((int,), 32),
+        'metrics_port': ((int,), None),
+        'metrics_bind_address': ((str,), '127.0.0.1'),
+        'ffmpeg_path': ((str,), 'ffmpeg'),
+        'ffmpeg_log_dir': ((str,), None),
+        'event_loop': ((str,), 'asyncio'),
+        'loop_lag_threshold': ((int, float), 0.1),
+        'receive_path': ((str,), 'stream'),
+        'receive_buffer_bytes': ((int,), 65536),
+        'heartbeat_interval': ((int, float), 10.0),
+        'missed_heartbeats': ((int,), 0),
+        'video_catalog': ((bool,), True),
+        'video_catalog_path': ((str,), None),
+        'event_compaction_interval': ((int, float), 3600.0),
+        'accept_rate': ((int, float), 50.0),
+        'accept_burst': ((int,), 100),
+        'max_connections': ((int,), 0),
+        'archive_dir': ((str,), None),
+        'archive_transfers': ((int,), 2),
+        'archive_chunk_bytes': ((int,), 1024 * 1024),
+    }
+
+    # Settings that are only read when the server starts.  A reload keeps
+    # the running values of these.
+    RESTART_ATTRIBUTES = (
+        'data_dir', 'port', 'uuid', 'rtp_bind_address', 'event_loop',
+        'loop_lag_threshold_s', 'receive_path', 'receive_buffer_bytes',
+        'heartbeat_interval_s', 'missed_heartbeats', 'video_catalog',
+        'video_catalog_path',
+        'io_threads', 'io_queue_depth', 'metrics_port',
+        'metrics_bind_address', 'archive_dir', 'archive_transfers',
+        'archive_chunk_bytes', 'event_compaction_interval_s',
+    )
+
     def __init__(self, path: str) -> None:
         self._log = logging.getLogger()
         with open(path, 'r') as config_stream:
@@ -58,21 +131,160 @@ class ServerConfig:
         assert(isinstance(configDict['server_uuid'], str))
         self.uuid = uuid.UUID(configDict['server_uuid'])
         self.video_increment_s = int(configDict['video_increment'])
-        self.rtsp_ports = PortAllocator(configDict['rtsp_port_block'][0], configDict['rtsp_port_block'][1])
+        self.rtp_bind_address = str(self.__get_optional(configDict, 'rtp_bind_address'))
+        self.rtsp_port_block = (int(configDict['rtsp_port_block'][0]),
+                                int(configDict['rtsp_port_block'][1]))
+        self.rtsp_ports = PortAllocator(self.rtsp_port_block[0],
+                                        self.rtsp_port_block[1],
+                                        bind_address=self.rtp_bind_address)
+        self.max_rtp_streams = int(self.__get_optional(configDict, 'max_rtp_streams'))
+        self.max_queued_rtp_streams = int(self.__get_optional(configDict, 'max_queued_rtp_streams'))
+        self.rtp_queue_timeout_s = float(self.__get_optional(configDict, 'rtp_queue_timeout'))
+        self.ffmpeg_max_restarts = int(self.__get_optional(configDict, 'ffmpeg_max_restarts'))
+        self.rtp_listen_timeout_s = float(self.__get_optional(configDict, 'rtp_listen_timeout'))
+        self.ffmpeg_path = str(self.__get_optional(configDict, 'ffmpeg_path'))
+        self.ffmpeg_log_dir: Optional[str] = self.__get_optional(configDict, 'ffmpeg_log_dir')
+        self.event_loop = str(self.__get_optional(configDict, 'event_loop'))
+        if self.event_loop not in EVENT_LOOPS:
+            raise RuntimeError('Configuration key event_loop is malformed!')
+        self.loop_lag_threshold_s = float(self.__get_optional(configDict, 'loop_lag_threshold'))
+        self.receive_path = str(self.__get_optional(configDict, 'receive_path'))
+        if self.receive_path not in ('stream', 'protocol'):
+            raise RuntimeError('Configuration key receive_path is malformed!')
+        self.receive_buffer_bytes = int(self.__get_optional(configDict, 'receive_buffer_bytes'))
+        self.heartbeat_interval_s = float(self.__get_optional(configDict, 'heartbeat_interval'))
+        self.missed_heartbeats = int(self.__get_optional(configDict, 'missed_heartbeats'))
+        self.video_catalog = bool(self.__get_optional(configDict, 'video_catalog'))
+        self.video_catalog_path: str = self.__get_optional(configDict, 'video_catalog_path') or defaultCatalogPath()
+        self.event_compaction_interval_s = float(self.__get_optional(configDict, 'event_compaction_interval'))
+        self.accept_rate = float(self.__get_optional(configDict, 'accept_rate'))
+        self.accept_burst = int(self.__get_optional(configDict, 'accept_burst'))
+        self.max_connections = int(self.__get_optional(configDict, 'max_connections'))
+        self.archive_dir: Optional[str] = self.__get_optional(configDict, 'archive_dir')
+        self.archive_transfers = int(self.__get_optional(configDict, 'archive_transfers'))
+        self.archive_chunk_bytes = int(self.__get_optional(configDict, 'archive_chunk_bytes'))
+        packet_log_level = logging.getLevelName(
+            str(self.__get_optional(configDict, 'packet_log_level')).upper())
+        if not isinstance(packet_log_level, int):
+            raise RuntimeError('Configuration key packet_log_level is malformed!')
+        self.packet_log_level: int = packet_log_level
+        self.send_queue_high = int(self.__get_optional(configDict, 'send_queue_high'))
+        self.send_queue_low = int(self.__get_optional(configDict, 'send_queue_low'))
+        if self.send_queue_low > self.send_queue_high:
+            raise RuntimeError('send_queue_low must not exceed send_queue_high!')
+        self.max_packet_handlers = int(self.__get_optional(configDict, 'max_packet_handlers'))
+        metrics_port = self.__get_optional(configDict, 'metrics_port')
+        self.metrics_port: Optional[int] = int(metrics_port) if metrics_port is not None else None
+        self.metrics_bind_address = str(self.__get_optional(configDict, 'metrics_bind_address'))
+
+        self.event_flush_bytes = int(self.__get_optional(configDict, 'event_flush_bytes'))
+        self.event_flush_interval_s = float(self.__get_optional(configDict, 'event_flush_interval'))
+        self.event_fsync = bool(self.__get_optional(configDict, 'event_fsync'))
+        self.io_threads = int(self.__get_optional(configDict, 'io_threads'))
+        self.io_queue_depth = int(self.__get_optional(configDict, 'io_queue_depth'))
+        self.raw_data_ingest = bool(self.__get_optional(configDict, 'raw_data_ingest'))
+        self.data_rotate_bytes = int(self.__get_optional(configDict, 'data_rotate_bytes'))
+        # .bin files rotate with the video segments unless configured otherwise
+        data_increment = self.__get_optional(configDict, 'data_increment')
+        if data_increment is None:
+            data_increment = self.video_increment_s
+        self.data_increment_s = int(data_increment)
+        self.data_index_interval_s = float(self.__get_optional(configDict, 'data_index_interval'))
+
+    def keepRestartSettings(self, running: 'ServerConfig') -> List[str]:
+        """Copies the settings that need a restart from the running
+        configuration.
+
+        Args:
+            running (ServerConfig): Configuration the server started with
+
+        Returns:
+            List[str]: Settings whose new value is not used until a restart
+        """
+        ignored = []
+        for name in self.RESTART_ATTRIBUTES:
+            if getattr(self, name) != getattr(running, name):
+                ignored.append(name)
+                setattr(self, name, getattr(running, name))
+        return ignored
+
+    def partitionPorts(self, index: int, count: int) -> None:
+        """Restricts the RTP ports to the index-th of count parts of the
+        configured block, so that workers sharing the block never collide.
+
+        Args:
+            index (int): Worker index
+            count (int): Number of workers
+        """
+        start, end = partitionBlock(self.rtsp_port_block[0],
+                                    self.rtsp_port_block[1], index, count)
+        self._log.info(f'RTP ports: {start} to {end}')
+        self.rtsp_ports = PortAllocator(start, end,
+                                        bind_address=self.rtp_bind_address)
+
+    def __get_optional(self, configDict: Dict[str, Any], key: str) -> Any:
+        key_types, default = self.OPTIONAL_CONFIG_TYPES[key]
+        if key not in configDict:
+            return default
+        value = configDict[key]
+        if not isinstance(value, key_types):
+            raise RuntimeError(f'Configuration key {key} is malformed!')
+        self._log.info(f'Discovered {key}: {value}')
+        return value
+
+
+class ServerMetrics:
+    """Metrics that are updated on the packet paths of every client
+    """
+
+    def __init__(self, registry: MetricsRegistry) -> None:
+        self.registry = registry
+        self.connections_total = registry.counter(
+            'asm_connections_total', 'Client connections accepted')
+        self.connections_rejected = registry.counter(
+            'asm_connections_rejected_total',
+            'Client connections closed on accept', ('reason',))
+        self.packets_received = registry.counter(
+            'asm_packets_received_total', 'Packets received',
+            ('device', 'type'))
+        self.packets_sent = registry.counter(
+            'asm_packets_sent_total', 'Packets sent', ('device',))
+        self.bytes_received = registry.counter(
+            'asm_bytes_received_total', 'Bytes received from clients')
+        self.bytes_sent = registry.counter(
+            'asm_bytes_sent_total', 'Bytes sent to clients')
+        self.handler_latency = registry.histogram(
+            'asm_handler_latency_seconds', 'Packet handler run time',
+            ('handler',))
+        self.loop_lag = registry.histogram(
+            'asm_loop_lag_seconds', 'Event loop wake up delay')
 
 
 class ClientHandler:
 
-    def __init__(self, device_tree: devices.DeviceTree, reader: StreamReader,
-                 writer: StreamWriter, config: ServerConfig) -> None:
+    def __init__(self, device_tree: Union[devices.DeviceTree, RemoteDeviceTree],
+                 reader: Union[StreamReader, PacketReceiver],
+                 writer: Union[StreamWriter, TransportWriter],
+                 config: ServerConfig,
+                 io_executor: IOExecutor,
+                 ffmpeg_supervisor: FFmpegSupervisor,
+                 metrics: ServerMetrics,
+                 liveness: Optional[LivenessTracker] = None,
+                 video_catalog: Optional[VideoCatalog] = None,
+                 archiver: Optional[Archiver] = None,
+                 on_identified: Optional[Callable[['ClientHandler'], None]] = None) -> None:
         self._log = logging.getLogger(self.__class__.__name__)
+        # Per-packet logs, kept separate so that they can be filtered
+        self._rx_log = logging.getLogger(f'{self.__class__.__name__}.Receiver')
+        self._tx_log = logging.getLogger(f'{self.__class__.__name__}.Sender')
         self.device_tree = device_tree
         self.reader = reader
         self.writer = writer
         self.protocol_codec = codec.Codec()
         self.end_event = Event()
-        self.__packet_queue: asyncio.Queue[Optional[codec.binaryPacket]] = \
-            asyncio.Queue()
+        self.__packet_queue: WatermarkQueue[Optional[codec.binaryPacket]] = \
+            WatermarkQueue(high_watermark=config.send_queue_high,
+                           low_watermark=config.send_queue_low)
 
         self._packet_handlers: Dict[Type[codec.binaryPacket],
                                     Callable[[codec.binaryPacket],
@@ -83,22 +295,67 @@ class ClientHandler:
                 codec.E4E_Flipper_Data: self.flipper_handler,
                 codec.E4E_Data_Labels: self.data_labels
             }
+        # Handlers that must see packets in the order they were received
+        self._ordered_handlers = {self.flipper_handler, self.data_labels,
+                                  self.data_packet_handler}
+        self._dispatcher = PacketDispatcher(
+            max_concurrency=config.max_packet_handlers,
+            latency=metrics.handler_latency)
+        # Ordered handlers wait for the first heartbeat, so their packets are
+        # held here until then instead of filling a bounded lane, which
+        # would stop the reader before it gets to the heartbeat.  None once
+        # the held packets have been handed to the dispatcher.
+        self.__held: Optional[Deque[Tuple[Callable[[codec.binaryPacket],
+                                                   Awaitable[None]],
+                                          codec.binaryPacket]]] = \
+            collections.deque()
+        self.__release_task: Optional[asyncio.Task] = None
+        self._metrics = metrics
+        # Per-device metric children, looked up once instead of per packet
+        self._rx_counters: Dict[Any, Any] = {}
+        self._tx_counter: Optional[Any] = None
 
         self.client_device: Optional[devices.Device] = None
-        self._data_endpoints: Dict[Tuple[int, int], Optional[BinaryIO]] = {}
+        self._raw_sink: Optional[rawSink.RawDataSink] = None
+        self._frame_scanner = rawSink.FrameScanner()
+        # (class, id) pairs seen in raw ingest mode, split by whether they are
+        # handled as commands or stored as data
+        self._control_keys: Set[Tuple[int, int]] = set()
+        self._data_keys: Set[Tuple[int, int]] = set()
+        self._event_writers: Optional[bufferedWriter.WriterGroup] = None
+        # Output parser and drain task of the latest ffmpeg process per port
+        self._ffmpeg_parsers: Dict[int, Tuple[FFmpegLogParser, asyncio.Task]] = {}
+        # Supervisor names of the running streams started by this client
+        self._streams: Set[str] = set()
+        self._liveness = liveness
+        self._catalog = video_catalog
+        self._archiver = archiver
+        self.__on_identified = on_identified
 
         self._config = config
+        self._io = io_executor
+        self._ffmpeg = ffmpeg_supervisor
 
         self.hasClient = asyncio.Event()
 
-        if os.getuid() == 0:
+        if config.ffmpeg_log_dir is not None:
+            self.ff_log_dir = pathlib.Path(config.ffmpeg_log_dir).absolute()
+        elif os.getuid() == 0:
             self.ff_log_dir = pathlib.Path('var', 'log', 'ffmpeg_logs').absolute()
         else:
             # absolute() not necessary due to ASMDataServer dir path
             self.ff_log_dir = pathlib.Path(appdirs.user_log_dir('ASMDataServer'), 'ffmpeg_logs')
-        pathlib.Path(self.ff_log_dir).mkdir(parents=True, exist_ok=True)
-        
+
+    def _ioKey(self) -> str:
+        """Key used to order this client's file operations in the IO executor
+        """
+        if self.client_device:
+            return str(pathlib.Path(self._config.data_dir,
+                                    self.client_device.getDevicePath()))
+        return str(self.ff_log_dir)
+
     async def run(self):
+        await self._io.run(str(self.ff_log_dir), self.__makeDir, self.ff_log_dir)
         rx = asyncio.create_task(self.command_handler())
         tx = asyncio.create_task(self.response_sender())
         done, pending = await asyncio.wait({rx, tx})
@@ -106,36 +363,140 @@ class ClientHandler:
         for task in pending:
             task.cancel()
 
-        for fi in self._data_endpoints.values():
-            if fi:
-                fi.close()
+        if self.__release_task:
+            # Held packets can only be handled once the client identified
+            if not self.hasClient.is_set():
+                self.__release_task.cancel()
+            await asyncio.wait({self.__release_task}, timeout=5.0)
+            self.__release_task.cancel()
+        await self._dispatcher.close()
+        self._log.info('Handlers: %s', self._dispatcher.stats())
+
+        if self._raw_sink:
+            await self._raw_sink.close()
+            self._log.info('Raw data: %d frames in %d writes, %d bytes',
+                           self._raw_sink.frames, self._raw_sink.writes,
+                           self._raw_sink.bytes_written)
+
+        if self._event_writers:
+            await self._event_writers.close()
+            stats = self._event_writers.stats
+            self._log.info('Event writers: %d lines in %d flushes, %d bytes',
+                           stats.lines, stats.flushes, stats.bytes_written)
 
     async def command_handler(self):
-        logger = logging.Logger("Receiver")
         while not self.end_event.is_set():
-            data = await self.reader.read(65536)
+            # Stop reading from the socket while the disk is behind
+            await self._io.waitForCapacity()
+            data = await self.reader.read(self._config.receive_buffer_bytes)
             if len(data):
-                packets = self.protocol_codec.decode(data)
-                for packet in packets:
-                    logger.info(f'Received {packet}')
-                    if type(packet) in self._packet_handlers:
-                        asyncio.create_task(self._packet_handlers[type(packet)](packet))
-                    else:
-                        self._log.warning(f'No handler for class {type(packet)}')
+                self._metrics.bytes_received.inc(len(data))
+                if self._config.raw_data_ingest:
+                    await self.ingest_raw(data)
+                else:
+                    for packet in self.protocol_codec.decode(data):
+                        await self.dispatch_packet(packet)
             else:
                 # Do this to unblock the response_sender
-                await self.__packet_queue.put(None)
+                self.__packet_queue.put_nowait(None)
                 self.end_event.set()
         self._log.info(f'Rx closed')
 
+    async def dispatch_packet(self, packet: codec.binaryPacket):
+        level = self._config.packet_log_level
+        if self._rx_log.isEnabledFor(level):
+            self._rx_log.log(level, 'Received %s', packet)
+        self._countReceived(type(packet))
+        handler = self._packet_handlers.get(type(packet),
+                                            self.data_packet_handler)
+        ordered = handler in self._ordered_handlers
+        if ordered and self.__held is not None:
+            self.__held.append((handler, packet))
+            if self.__release_task is None:
+                self.__release_task = asyncio.create_task(self.__releaseHeld())
+            return
+        await self._dispatcher.dispatch(handler, packet, ordered=ordered)
+
+    async def __releaseHeld(self):
+        await self.hasClient.wait()
+        assert(self.__held is not None)
+        while self.__held:
+            handler, packet = self.__held.popleft()
+            await self._dispatcher.dispatch(handler, packet, ordered=True)
+        self.__held = None
+
+    async def ingest_raw(self, data: bytes):
+        """Splits data into frames and writes data frames straight to their
+        endpoints.  Only frames of command types are decoded.  The first
+        frame of every (class, id) pair is decoded to learn which kind it is,
+        and is then stored as received like the frames after it, so that the
+        .bin files keep the order the frames arrived in.
+
+        Args:
+            data (bytes): Bytes received from the client
+        """
+        control_frames: List[memoryview] = []
+        for packet_class, packet_id, frame in self._frame_scanner.scan(data):
+            file_key = (packet_class, packet_id)
+            if file_key in self._control_keys:
+                control_frames.append(frame)
+                continue
+            if file_key not in self._data_keys:
+                # Keep packets in order by dispatching what has accumulated
+                await self.__dispatchFrames(control_frames)
+                control_frames = []
+                packets = self.protocol_codec.decode(bytes(frame))
+                if not packets:
+                    continue
+                if type(packets[0]) in self._packet_handlers:
+                    self._control_keys.add(file_key)
+                    for packet in packets:
+                        await self.dispatch_packet(packet)
+                    continue
+                self._data_keys.add(file_key)
+            self._countReceived('raw')
+            if self.client_device:
+                self._getRawSink().add(file_key, frame)
+        await self.__dispatchFrames(control_frames)
+        if self._raw_sink:
+            self._raw_sink.scheduleFlush()
+
+    async def __dispatchFrames(self, frames: List[memoryview]):
+        if frames:
+            for packet in self.protocol_codec.decode(b''.join(frames)):
+                await self.dispatch_packet(packet)
+
+    def _countReceived(self, packet_type: Any) -> None:
+        counter = self._rx_counters.get(packet_type)
+        if counter is None:
+            type_name = getattr(packet_type, '__name__', str(packet_type))
+            counter = self._metrics.packets_received.labels(self._deviceLabel(),
+                                                            type_name)
+            self._rx_counters[packet_type] = counter
+        counter.inc()
+
+    def _deviceLabel(self) -> str:
+        if self.client_device:
+            return str(self.client_device.deviceID)
+        return 'unknown'
+
     async def response_sender(self):
-        logger = logging.Logger("Sender")
+        level = self._config.packet_log_level
         while not self.end_event.is_set():
-            packet = await self.__packet_queue.get()
-            if not packet:
+            # Everything queued since the last write goes out in one write
+            packets = [packet for packet in await self.__packet_queue.get_batch()
+                       if packet]
+            if not packets:
                 continue
-            logger.info(f'Sending {packet}')
-            bytes_to_send = self.protocol_codec.encode([packet])
+            if self._tx_log.isEnabledFor(level):
+                for packet in packets:
+                    self._tx_log.log(level, 'Sending %s', packet)
+            bytes_to_send = self.protocol_codec.encode(packets)
+            if self._tx_counter is None:
+                self._tx_counter = self._metrics.packets_sent.labels(
+                    self._deviceLabel())
+            self._tx_counter.inc(len(packets))
+            self._metrics.bytes_sent.inc(len(bytes_to_send))
             self.writer.write(bytes_to_send)
             await self.writer.drain()
         self.writer.close()
@@ -151,125 +512,245 @@ class ClientHandler:
         assert(isinstance(packet, codec.E4E_Flipper_Data))
         await self.hasClient.wait()
         assert(self.client_device)
-        data_dir = self._config.data_dir
-        self._log.info("Got Flipper Data")
-        device_path = self.client_device.getDevicePath()
-        fname = 'flipper_data.txt'
-        file_path = pathlib.Path(data_dir, device_path, fname)
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(file_path, 'a') as dataFile:
-            if packet.direction == codec.E4E_Flipper_Data.OUT:
-                dataFile.write(f'{packet.timestamp}: out\n')
-            else:
-                dataFile.write(f'{packet.timestamp}: in\n')
+        self._rx_log.debug('Got Flipper Data')
+        if packet.direction == codec.E4E_Flipper_Data.OUT:
+            line = f'{packet.timestamp}: out\n'
+        else:
+            line = f'{packet.timestamp}: in\n'
+        self._getEventWriters().write('flipper_data.txt', line)
 
     async def data_labels(self, packet: codec.binaryPacket):
         assert(isinstance(packet, codec.E4E_Data_Labels))
         await self.hasClient.wait()
         assert(self.client_device)
 
-        data_dir = self._config.data_dir
-        self._log.info("Got data label")
-
-        device_path = self.client_device.getDevicePath()
-
-        fname = "labels.csv"
-
-        file_path = pathlib.Path(data_dir, device_path, fname)
-        file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._rx_log.debug('Got data label')
+        line = f'{packet.timestamp.isoformat()}, {packet.label}\n'
+        self._getEventWriters().write('labels.csv', line)
 
-        with open(file_path, 'a') as dataFile:
-            dataFile.write(f'{packet.timestamp.isoformat()}, {packet.label}\n')
+    def _getEventWriters(self) -> bufferedWriter.WriterGroup:
+        assert(self.client_device)
+        if self._event_writers is None:
+            device_dir = pathlib.Path(self._config.data_dir,
+                                      self.client_device.getDevicePath())
+            self._event_writers = bufferedWriter.WriterGroup(
+                device_dir=device_dir,
+                flush_bytes=self._config.event_flush_bytes,
+                flush_interval_s=self._config.event_flush_interval_s,
+                fsync=self._config.event_fsync,
+                io_executor=self._io)
+        return self._event_writers
 
     async def heartbeat_handler(self, packet: codec.binaryPacket):
         assert(isinstance(packet, codec.E4E_Heartbeat))
         client_uuid = packet._source
         if not self.client_device:
             self._log.info(f'Getting client for uuid {client_uuid}')
-            try:
-                self.client_device = self.device_tree.getDeviceByUUID(client_uuid)
-            except devices.DeviceNotFoundError as e:
-                newDevice = devices.Device(client_uuid, "Auto-registered device", devices.DeviceType.AUTO_REGISTERED)
-                self.device_tree.addDevice(newDevice)
-                self.client_device = newDevice
-                self._log.info(f"Added new device {newDevice}")
+            self.client_device = await self.__lookupDevice(client_uuid)
+            # Count everything from here on against the device
+            self._rx_counters.clear()
+            self._tx_counter = None
+            if self.__on_identified:
+                self.__on_identified(self)
         else:
             assert(self.client_device.deviceID == client_uuid)
-        self._log.info(f"Got heartbeat from {self.client_device.deviceID} "
-              f"({self.client_device.description}) at {packet.timestamp}")
+        level = self._config.packet_log_level
+        if self._rx_log.isEnabledFor(level):
+            self._rx_log.log(level, 'Got heartbeat from %s (%s) at %s',
+                             self.client_device.deviceID,
+                             self.client_device.description, packet.timestamp)
         self.client_device.setLastHeardFrom(dt.datetime.now())
+        if self._liveness:
+            self._liveness.heard(self, self.client_device.deviceID)
         self.hasClient.set()
 
+    async def __lookupDevice(self, client_uuid: uuid.UUID) -> devices.Device:
+        """Finds the device a client authenticated as, registering it if it
+        is new.  A RemoteDeviceTree is asked without blocking the event loop.
+        """
+        tree = self.device_tree
+        try:
+            if isinstance(tree, RemoteDeviceTree):
+                return await tree.getDeviceByUUID(client_uuid)
+            return tree.getDeviceByUUID(client_uuid)
+        except devices.DeviceNotFoundError:
+            pass
+        newDevice = devices.Device(client_uuid, "Auto-registered device", devices.DeviceType.AUTO_REGISTERED)
+        if isinstance(tree, RemoteDeviceTree):
+            await tree.addDevice(newDevice)
+        else:
+            tree.addDevice(newDevice)
+        self._log.info(f"Added new device {newDevice}")
+        return newDevice
+
+    def reap(self) -> None:
+        """Drops a connection whose unit has stopped sending heartbeats, or
+        that has been replaced by a newer connection from the same unit.  The
+        streams it started are stopped, which releases their ports, and the
+        connection is aborted, which closes its files as ClientHandler.run
+        finishes.
+        """
+        for name in list(self._streams):
+            self._ffmpeg.stop(name)
+        # Do not wait to flush to a peer that is gone
+        self.writer.transport.abort()
+
     async def onRTPStart(self, packet: codec.binaryPacket):
         self._log.info("Got RTP Start Command")
         assert(isinstance(packet, codec.E4E_START_RTP_CMD))
-        free_port = self._config.rtsp_ports.reservePort()
-        self._log.info(f'Got port {free_port}')
-        response = codec.E4E_START_RTP_RSP(self._config.uuid, packet._source,
-                                           free_port, packet.streamID)
-        proc = await self.runRTPServer(free_port)
-        await self.sendPacket(response)
-
-        retval = await proc.wait()
-        self._config.rtsp_ports.releasePort(free_port)
+        async with contextlib.AsyncExitStack() as stream_resources:
+            try:
+                await stream_resources.enter_async_context(self._ffmpeg.admit())
+                free_port = await stream_resources.enter_async_context(
+                    self._config.rtsp_ports.lease())
+                self._log.info(f'Got port {free_port}')
+                ff_logs = await self.__openFFmpegLogs()
+                stream_resources.push_async_callback(ff_logs.close)
+                stream = await self._ffmpeg.start(
+                    f'{packet._source}:{packet.streamID}:{free_port}',
+                    lambda: self.runRTPServer(free_port, ff_logs))
+            except (AdmissionError, RuntimeError, OSError) as e:
+                # Port 0 tells the client that no stream was started
+                self._log.warning(f'Rejected RTP start for stream {packet.streamID}: {e}')
+                await self.sendPacket(codec.E4E_START_RTP_RSP(self._config.uuid, packet._source,
+                                                              0, packet.streamID))
+                return
+            response = codec.E4E_START_RTP_RSP(self._config.uuid, packet._source,
+                                               free_port, packet.streamID)
+            await self.sendPacket(response)
+            # The supervisor now holds the slot, port and logs until ffmpeg
+            # exits, independently of this connection
+            self._ffmpeg.watch(stream, stream_resources.pop_all(),
+                               lambda stream: self.onRTPEnd(stream, free_port))
+            self._streams.add(stream.name)
 
+    async def onRTPEnd(self, stream: SupervisedStream, port: int):
+        self._streams.discard(stream.name)
+        proc = stream.proc
+        assert(proc)
+        parser, drain_task = self._ffmpeg_parsers.pop(port)
+        await drain_task
         if proc.returncode != 0:
             self._log.warning("ffmpeg shut down with error code %d", proc.returncode)
-            self._log.info("ffmpeg stderr: %s", (await proc.stderr.read()).decode())
-            self._log.info("ffmpeg stdout: %s", (await proc.stdout.read()).decode())
+            self._log.info("ffmpeg output: %s", parser.lastOutput())
         else:
             self._log.info("ffmpeg returned with code 0")
 
-    async def runRTPServer(self, port: int):
+    async def __openFFmpegLogs(self) -> bufferedWriter.WriterGroup:
+        await self.hasClient.wait()
+        assert(self.client_device)
+        return bufferedWriter.WriterGroup(
+            device_dir=pathlib.Path(self.ff_log_dir,
+                                    self.client_device.getDevicePath()),
+            flush_bytes=self._config.event_flush_bytes,
+            flush_interval_s=self._config.event_flush_interval_s,
+            fsync=False,
+            io_executor=self._io)
+
+    async def runRTPServer(self, port: int, ff_logs: bufferedWriter.WriterGroup):
         await self.hasClient.wait()
         assert(self.client_device)
         data_dir = self._config.data_dir
 
         device_path = self.client_device.getDevicePath()
-        fname = '%Y.%m.%d.%H.%M.%S.mp4'
+        fname = SEGMENT_NAME_FORMAT
         file_path = os.path.abspath(os.path.join(data_dir, device_path, fname))
         file_dir = os.path.dirname(file_path)
-        pathlib.Path(file_dir).mkdir(parents=True, exist_ok=True)
+        await self._io.run(self._ioKey(), self.__makeDir, file_dir)
 
-        ff_stats_path = pathlib.Path(self.ff_log_dir, device_path, "stats.log")
-        ff_info_path = pathlib.Path(self.ff_log_dir, device_path, "info.log")
-        split_script = "-m ASM_utils.ffmpeg.split_log"
+        parser = FFmpegLogParser(stats_log=ff_logs.getWriter('stats.log'),
+                                 info_log=ff_logs.getWriter('info.log'))
 
-        cmd = (f'ffmpeg -i tcp://@:{port}?listen -c copy -flags +global_header'
-               f' -f segment -segment_time {self._config.video_increment_s} -strftime 1 '
-               f'-reset_timestamps 1 {file_path} '
-               f' 2>&1 | {sys.executable} {split_script} {ff_stats_path} {ff_info_path}'
-            )
+        # ffmpeg reports progress on stdout and everything else on stderr,
+        # both are parsed here instead of in a separate process
+        listen_url = f'tcp://@:{port}?listen'
+        if self._config.rtp_listen_timeout_s > 0:
+            # Gives up the slot and port if the unit never connects, also
+            # after a restart
+            listen_url += f'&listen_timeout={int(self._config.rtp_listen_timeout_s * 1000)}'
+        cmd = [self._config.ffmpeg_path, '-nostats', '-progress', 'pipe:1',
+               '-i', listen_url, '-c', 'copy',
+               '-flags', '+global_header', '-f', 'segment',
+               '-segment_time', str(self._config.video_increment_s),
+               '-strftime', '1', '-reset_timestamps', '1', file_path]
+        segment_list: Optional[Tuple[int, int]] = None
+        if self._catalog or self._archiver:
+            # ffmpeg reports each closed segment on an extra pipe
+            segment_list = os.pipe()
+            cmd[-1:-1] = ['-segment_list', f'pipe:{segment_list[1]}',
+                          '-segment_list_type', 'csv']
         proc_out = asyncio.subprocess.PIPE
         proc_err = asyncio.subprocess.PIPE
-        self._log.info(f'Started ffmpeg with command: {cmd}')
-        proc = await asyncio.create_subprocess_shell(cmd, stdout=proc_out,
-                                                     stderr=proc_err)
+        self._log.info(f'Started ffmpeg with command: {" ".join(cmd)}')
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=proc_out,
+                stderr=proc_err,
+                pass_fds=(segment_list[1],) if segment_list else ())
+        except BaseException:
+            if segment_list:
+                os.close(segment_list[0])
+            raise
+        finally:
+            if segment_list:
+                os.close(segment_list[1])
+        segment_fd = segment_list[0] if segment_list else None
+        self._ffmpeg_parsers[port] = (parser, asyncio.create_task(
+            self.__drainFFmpeg(proc, parser, segment_fd, file_dir)))
         self._log.info(f'RTP Server on port {port} started outputting to {file_dir}')
         self._log.info(f"FFmpeg logging to: {os.path.join(self.ff_log_dir, device_path)}")
         return proc
 
+    async def __drainFFmpeg(self, proc: asyncio.subprocess.Process,
+                            parser: FFmpegLogParser, segment_fd: Optional[int],
+                            file_dir: str):
+        readers = [parser.drain(proc)]
+        if segment_fd is not None:
+            readers.append(self.__followSegments(segment_fd, file_dir))
+        await asyncio.gather(*readers)
+
+    async def __followSegments(self, segment_fd: int, file_dir: str):
+        assert(self.client_device)
+        follower = SegmentListFollower(
+            self._catalog, str(self.client_device.deviceID), file_dir,
+            on_closed=self._archiver.submit if self._archiver else None)
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(segment_fd, 'rb', buffering=0))
+        try:
+            # A single key keeps the catalog writes on one thread at a time
+            await follower.follow(reader, self._io, CATALOG_NAME)
+        finally:
+            transport.close()
+        self._log.info(f'Cataloged {follower.segments} segments in {file_dir}')
+
     async def data_packet_handler(self, packet: codec.binaryPacket):
         if self.client_device:
             file_key = (packet._class, packet._id)
-            if file_key not in self._data_endpoints:
-                self.open_file_endpoint(file_key)
-            endpoint = self._data_endpoints[file_key]
-            assert(endpoint)
-            if endpoint.closed:
-                self.open_file_endpoint(file_key)
-            endpoint.write(self.protocol_codec.encode([packet]))
-
-    def open_file_endpoint(self, file_key):
+            sink = self._getRawSink()
+            sink.add(file_key, self.protocol_codec.encode([packet]))
+            sink.scheduleFlush()
+
+    def _getRawSink(self) -> rawSink.RawDataSink:
         assert(self.client_device)
-        device_dir = self.client_device.getDevicePath()
-        data_dir = self._config.data_dir
-        fname = dt.datetime.now().strftime('%Y.%m.%d.%H.%M.%S.bin')
-        file_path = os.path.abspath(os.path.join(data_dir, device_dir, fname))
-        file_dir = os.path.dirname(file_path)
-        pathlib.Path(file_dir).mkdir(parents=True, exist_ok=True)
-        self._data_endpoints[file_key] = open(file_path, 'ab')
-        self._log.info(f'Opened file endpoint for {file_key} at {file_path}')
+        if self._raw_sink is None:
+            device_dir = pathlib.Path(self._config.data_dir,
+                                      self.client_device.getDevicePath())
+            self._raw_sink = rawSink.RawDataSink(
+                device_dir=device_dir,
+                io_executor=self._io,
+                io_key=self._ioKey(),
+                rotate_bytes=self._config.data_rotate_bytes,
+                rotate_interval_s=self._config.data_increment_s,
+                index_interval_s=self._config.data_index_interval_s,
+                on_closed=self._archiver.submit if self._archiver else None)
+        return self._raw_sink
+
+    @staticmethod
+    def __makeDir(path: Union[str, pathlib.Path]) -> None:
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
 
 
 class Server:
@@ -286,34 +767,394 @@ class Server:
             git_rev_parse += ' dirty'
         return git_rev_parse
 
-    def __init__(self, config_file: str) -> None:
+    def __init__(self, config_file: str, worker_index: int = 0,
+                 workers: int = 1, registry_path: Optional[str] = None) -> None:
+        """Creates the server.
+
+        Args:
+            config_file (str): Configuration file path
+            worker_index (int, optional): Index of this worker process.
+            Defaults to 0.
+            workers (int, optional): Number of worker processes accepting on
+            the same port. Defaults to 1.
+            registry_path (Optional[str], optional): Socket of the
+            DeviceRegistryServer that owns the devices.  If None, this server
+            loads and owns devices.yaml itself. Defaults to None.
+        """
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.info(f"Starting ASM Data Server v{DataServer.__version__}, {self.__getRevision()}")
+        self.config_file = config_file
         self.config = ServerConfig(config_file)
-        devices_file = os.path.join(self.config.data_dir, 'devices.yaml')
-        self.device_tree = devices.DeviceTree(devices_file)
+        self.worker_index = worker_index
+        self.workers = workers
+        if workers > 1:
+            self.config.partitionPorts(worker_index, workers)
+        self.__offsetMetricsPort(self.config)
+        self.device_tree: Union[devices.DeviceTree, RemoteDeviceTree]
+        if registry_path is not None:
+            self.device_tree = RemoteDeviceTree(registry_path)
+        else:
+            devices_file = os.path.join(self.config.data_dir, 'devices.yaml')
+            self.device_tree = devices.DeviceTree(devices_file)
         self.hostname = ''
         self.__client_queues: List[ClientHandler] = []
+        self.__client_tasks: Set[asyncio.Task] = set()
+        self.__reload_tasks: Set[asyncio.Task] = set()
+        # Per worker, a stale session on another worker is left to the
+        # liveness tracker
+        self.__sessions = SessionTable()
+        self.__accept_bucket: Optional[TokenBucket] = None
+        if self.config.accept_rate > 0:
+            self.__accept_bucket = TokenBucket(self.config.accept_rate,
+                                               self.config.accept_burst)
+        self.io_executor: Optional[IOExecutor] = None
+        self.ffmpeg_supervisor = FFmpegSupervisor(
+            max_streams=self.config.max_rtp_streams,
+            max_queued=self.config.max_queued_rtp_streams,
+            queue_timeout_s=self.config.rtp_queue_timeout_s,
+            max_restarts=self.config.ffmpeg_max_restarts)
+        self.liveness: Optional[LivenessTracker] = None
+        if self.config.missed_heartbeats > 0:
+            self.liveness = LivenessTracker(
+                timeout_s=self.config.heartbeat_interval_s * self.config.missed_heartbeats,
+                on_expire=self.__reap)
+        self.video_catalog: Optional[VideoCatalog] = None
+        if self.config.video_catalog:
+            catalog_path = os.path.abspath(self.config.video_catalog_path)
+            data_dir = os.path.abspath(self.config.data_dir)
+            # The data directory is typically on a network share
+            on_data_dir = os.path.commonpath([catalog_path, data_dir]) == data_dir
+            self.video_catalog = VideoCatalog(catalog_path, wal=not on_data_dir)
+        self.archiver: Optional[Archiver] = None
+        if self.config.archive_dir is not None:
+            self.archiver = Archiver(self.config.data_dir,
+                                     self.config.archive_dir,
+                                     max_transfers=self.config.archive_transfers,
+                                     chunk_bytes=self.config.archive_chunk_bytes)
+        self.metrics = ServerMetrics(MetricsRegistry())
+        self.__registerGauges(self.metrics.registry)
+        self.__stream_cpu = self.metrics.registry.gauge(
+            'asm_rtp_stream_cpu_seconds',
+            'CPU time used by a running ffmpeg stream and its children',
+            ('stream',))
+        self.__stream_rss = self.metrics.registry.gauge(
+            'asm_rtp_stream_rss_bytes',
+            'Resident memory of a running ffmpeg stream and its children',
+            ('stream',))
+        self.__stream_restarts = self.metrics.registry.gauge(
+            'asm_rtp_stream_restarts', 'Restarts of a running ffmpeg stream',
+            ('stream',))
+
+    async def __collectStreamUsage(self) -> None:
+        """Reads the resource usage of the running streams from /proc on the
+        IO executor, and replaces the per-stream gauges with it.
+        """
+        assert(self.io_executor)
+        usage = await self.io_executor.run('ffmpeg_stats',
+                                           self.ffmpeg_supervisor.stats)
+        for gauge in (self.__stream_cpu, self.__stream_rss,
+                      self.__stream_restarts):
+            gauge.clear()
+        for stream in usage:
+            self.__stream_cpu.labels(stream.name).set(stream.cpu_s)
+            self.__stream_rss.labels(stream.name).set(stream.rss_bytes)
+            self.__stream_restarts.labels(stream.name).set(stream.restarts)
+
+    def __registerGauges(self, registry: MetricsRegistry) -> None:
+        # Read when scraped, so that they cost nothing on the hot paths
+        registry.gauge('asm_connections', 'Connected clients',
+                       function=lambda: len(self.__client_queues))
+        registry.gauge('asm_rtp_ports_reserved', 'RTP ports in use',
+                       function=lambda: self.config.rtsp_ports.reserved)
+        registry.gauge('asm_rtp_streams_active', 'Running ffmpeg streams',
+                       function=lambda: self.ffmpeg_supervisor.active)
+        registry.gauge('asm_rtp_streams_queued',
+                       'RTP start requests waiting for a slot',
+                       function=lambda: self.ffmpeg_supervisor.queued)
+        registry.counter('asm_rtp_streams_rejected_total',
+                         'RTP start requests rejected',
+                         function=lambda: self.ffmpeg_supervisor.rejected)
+        registry.gauge('asm_devices_online', 'Devices with a live connection',
+                       function=lambda: self.liveness.online
+                       if self.liveness else 0)
+        registry.counter('asm_connections_reaped_total',
+                         'Connections closed for missing heartbeats',
+                         function=lambda: self.liveness.reaped
+                         if self.liveness else 0)
+        registry.counter('asm_sessions_superseded_total',
+                         'Connections closed for a newer connection from the '
+                         'same device',
+                         function=lambda: self.__sessions.superseded)
+        registry.gauge('asm_archive_queued', 'Files waiting to be archived',
+                       function=lambda: self.archiver.queued
+                       if self.archiver else 0)
+        registry.counter('asm_archive_files_total', 'Files archived',
+                         function=lambda: self.archiver.files
+                         if self.archiver else 0)
+        registry.counter('asm_archive_bytes_total', 'Bytes copied to the '
+                         'archive',
+                         function=lambda: self.archiver.bytes_copied
+                         if self.archiver else 0)
+        registry.counter('asm_archive_failures_total', 'Failed archive copies',
+                         function=lambda: self.archiver.failures
+                         if self.archiver else 0)
+        registry.gauge('asm_io_pending', 'File operations waiting for the IO '
+                       'executor',
+                       function=lambda: self.io_executor.pending
+                       if self.io_executor else 0)
 
     async def run(self):
+        self.io_executor = IOExecutor(max_workers=self.config.io_threads,
+                                      queue_depth=self.config.io_queue_depth)
         self._log.info(f'Connecting to {self.hostname}:{self.config.port}')
-        server = await asyncio.start_server(self.client_thread, self.hostname,
-                                            self.config.port)
-        async with server:
-            await server.serve_forever()
+        # Workers share the port, the kernel spreads connections over them
+        server: asyncio.AbstractServer
+        if self.config.receive_path == 'protocol':
+            server = await asyncio.get_running_loop().create_server(
+                self.__makeReceiver, self.hostname, self.config.port,
+                reuse_port=self.workers > 1)
+        else:
+            server = await asyncio.start_server(
+                self.client_thread, self.hostname, self.config.port,
+                limit=self.config.receive_buffer_bytes,
+                reuse_port=self.workers > 1)
+        metrics_server: Optional[asyncio.AbstractServer] = None
+        if self.config.metrics_port is not None:
+            routes = {}
+            if self.liveness:
+                routes['/devices'] = self.liveness.status
+            metrics_server = await MetricsServer(
+                self.metrics.registry, routes,
+                on_scrape=self.__collectStreamUsage).start(
+                self.config.metrics_bind_address, self.config.metrics_port)
+        watchdog: Optional[asyncio.Task] = None
+        if self.config.loop_lag_threshold_s > 0:
+            watchdog = asyncio.create_task(LoopWatchdog(
+                threshold_s=self.config.loop_lag_threshold_s,
+                histogram=self.metrics.loop_lag).run())
+        reaper: Optional[asyncio.Task] = None
+        if self.liveness:
+            reaper = asyncio.create_task(self.liveness.run())
+        heard_reporter: Optional[asyncio.Task] = None
+        if isinstance(self.device_tree, RemoteDeviceTree):
+            heard_reporter = asyncio.create_task(self.device_tree.run())
+        compactor: Optional[asyncio.Task] = None
+        # Workers share the data directory, only the first one compacts it
+        if self.config.event_compaction_interval_s > 0 and self.worker_index == 0:
+            compactor = asyncio.create_task(self.__compactEvents())
+        if self.archiver:
+            # Files closed before this start are picked up by the first worker
+            await self.archiver.start(scan=self.worker_index == 0)
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP,
+                                                          self.__onSighup)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if reaper:
+                reaper.cancel()
+            if compactor:
+                compactor.cancel()
+            if heard_reporter:
+                heard_reporter.cancel()
+            if hasattr(signal, 'SIGHUP'):
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            if metrics_server:
+                metrics_server.close()
+            await self.ffmpeg_supervisor.close()
+            await self.__closeClients()
+            if self.archiver:
+                await self.archiver.close()
+            if self.video_catalog:
+                self.video_catalog.close()
+            # Make sure that newly registered devices are on disk
+            if isinstance(self.device_tree, RemoteDeviceTree):
+                await self.device_tree.flush()
+                self.device_tree.close()
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.device_tree.flush)
+
+    async def __closeClients(self, timeout_s: float = 10.0):
+        """Disconnects the clients, waits for them to close their files and
+        for the IO executor to finish the queued writes, then stops it.
+        """
+        assert(self.io_executor)
+        for client in list(self.__client_queues):
+            client.writer.transport.abort()
+        if self.__client_tasks:
+            await asyncio.wait(set(self.__client_tasks), timeout=timeout_s)
+        try:
+            await asyncio.wait_for(self.io_executor.drain(), timeout_s)
+        except asyncio.TimeoutError:
+            self._log.error('%d file operations did not finish before '
+                            'shutdown', self.io_executor.pending)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.io_executor.shutdown)
+
+    async def __compactEvents(self):
+        assert(self.io_executor)
+        loop = asyncio.get_running_loop()
+        while True:
+            device_dirs = await loop.run_in_executor(None, self.__listDeviceDirs)
+            compacted = 0
+            for device_dir in device_dirs:
+                store = EventStore(device_dir)
+                for stream in STREAM_FILES:
+                    try:
+                        # Ordered with the device's own file operations
+                        compacted += await self.io_executor.run(
+                            device_dir, store.compact, stream)
+                    except Exception:
+                        self._log.exception(f'Failed to compact {stream} in '
+                                            f'{device_dir}')
+            if compacted:
+                self._log.info(f'Compacted {compacted} events')
+            await asyncio.sleep(self.config.event_compaction_interval_s)
+
+    def __listDeviceDirs(self) -> List[str]:
+        return [entry.path for entry in os.scandir(self.config.data_dir)
+                if entry.is_dir()]
+
+    def __onSighup(self) -> None:
+        task = asyncio.create_task(self.reloadConfig())
+        self.__reload_tasks.add(task)
+        task.add_done_callback(self.__reload_tasks.discard)
+
+    async def reloadConfig(self) -> bool:
+        """Reads the configuration file again, and uses it for connections
+        accepted from now on.  Connections that are already open keep the
+        configuration they started with.  Settings that are only read on
+        start up keep their current value, and RTP ports that are in use stay
+        reserved even if they are no longer in the configured block.
+
+        Returns:
+            bool: True if the new configuration is in use, False if it was
+            not valid and the current one was kept
+        """
+        assert(self.io_executor)
+        try:
+            # Reading and parsing the file stays off the event loop
+            config: ServerConfig = await self.io_executor.run(
+                self.config_file, ServerConfig, self.config_file)
+            self.__offsetMetricsPort(config)
+            block = config.rtsp_port_block
+            if self.workers > 1:
+                block = partitionBlock(block[0], block[1], self.worker_index,
+                                       self.workers)
+        except Exception as e:
+            self._log.error(f'Keeping the current configuration, '
+                            f'{self.config_file} is not valid: {e}')
+            return False
+        ignored = config.keepRestartSettings(self.config)
+        if ignored:
+            self._log.warning(f'Restart to apply {", ".join(ignored)}')
+        # The allocator holds the running streams' ports, so it is kept
+        self.config.rtsp_ports.resize(block[0], block[1])
+        config.rtsp_ports = self.config.rtsp_ports
+        await self.ffmpeg_supervisor.setLimits(
+            max_streams=config.max_rtp_streams,
+            max_queued=config.max_queued_rtp_streams,
+            queue_timeout_s=config.rtp_queue_timeout_s,
+            max_restarts=config.ffmpeg_max_restarts)
+        if (config.accept_rate, config.accept_burst) != \
+                (self.config.accept_rate, self.config.accept_burst):
+            self.__accept_bucket = None
+            if config.accept_rate > 0:
+                self.__accept_bucket = TokenBucket(config.accept_rate,
+                                                   config.accept_burst)
+        self.config = config
+        self._log.info(f'Reloaded {self.config_file}, RTP ports {block[0]} to '
+                       f'{block[1]}')
+        return True
+
+    def __offsetMetricsPort(self, config: ServerConfig) -> None:
+        # Each worker serves its metrics on its own port
+        if self.workers > 1 and config.metrics_port is not None:
+            config.metrics_port += self.worker_index
+
+    def __makeReceiver(self) -> PacketReceiver:
+        return PacketReceiver(on_connect=self.__onReceiverConnected,
+                              buffer_size=self.config.receive_buffer_bytes)
+
+    def __onReceiverConnected(self, receiver: PacketReceiver) -> None:
+        assert(receiver.writer)
+        task = asyncio.create_task(self.client_thread(receiver,
+                                                      receiver.writer))
+        self.__client_tasks.add(task)
+        task.add_done_callback(self.__client_tasks.discard)
 
-    async def client_thread(self, reader: StreamReader, writer: StreamWriter):
+    async def client_thread(self, reader: Union[StreamReader, PacketReceiver],
+                            writer: Union[StreamWriter, TransportWriter]):
+        assert(self.io_executor)
+        # Tracked so that shutdown can wait for the client to close its files
+        task = asyncio.current_task()
+        if task is not None and task not in self.__client_tasks:
+            self.__client_tasks.add(task)
+            task.add_done_callback(self.__client_tasks.discard)
+        rejection = self.__admit()
+        if rejection:
+            self.metrics.connections_rejected.labels(rejection).inc()
+            # Before anything is allocated for it, and without a close
+            # handshake, so that a reconnect storm stays cheap
+            writer.transport.abort()
+            return
         client = ClientHandler(device_tree=self.device_tree, reader=reader,
-                               writer=writer, config=self.config)
+                               writer=writer, config=self.config,
+                               io_executor=self.io_executor,
+                               ffmpeg_supervisor=self.ffmpeg_supervisor,
+                               metrics=self.metrics,
+                               liveness=self.liveness,
+                               video_catalog=self.video_catalog,
+                               archiver=self.archiver,
+                               on_identified=self.__onIdentified)
+        self.metrics.connections_total.inc()
         self.__client_queues.append(client)
-        await client.run()
-        self.__client_queues.remove(client)
+        if self.liveness:
+            self.liveness.connect(client)
+        try:
+            await client.run()
+        finally:
+            if self.liveness:
+                self.liveness.disconnect(client)
+            if client.client_device:
+                self.__sessions.release(client.client_device.deviceID, client)
+            self.__client_queues.remove(client)
+
+    def __admit(self) -> Optional[str]:
+        """Decides whether to serve a new connection.
+
+        Returns:
+            Optional[str]: Reason to reject it, or None to serve it
+        """
+        if self.config.max_connections > 0 and \
+                len(self.__client_queues) >= self.config.max_connections:
+            return 'max_connections'
+        if self.__accept_bucket and not self.__accept_bucket.take():
+            return 'accept_rate'
+        return None
+
+    def __onIdentified(self, client: ClientHandler) -> None:
+        assert(client.client_device)
+        previous = self.__sessions.claim(client.client_device.deviceID, client)
+        if previous is not None:
+            assert(isinstance(previous, ClientHandler))
+            self._log.warning(f'Closing the previous connection of device '
+                              f'{client.client_device.deviceID}')
+            previous.reap()
+
+    def __reap(self, client: Any) -> None:
+        assert(isinstance(client, ClientHandler))
+        client.reap()
 
     def checkForServices(self):
         self.__checkForFFMPEG()
 
     def __checkForFFMPEG(self):
-        ffmpeg_path = shutil.which('ffmpeg')
+        ffmpeg_path = shutil.which(self.config.ffmpeg_path)
         if ffmpeg_path is None:
             raise RuntimeError("Could not find ffmpeg")
         self._log.info(f'Found ffmpeg as {ffmpeg_path}')
@@ -0,0 +1,299 @@
+'''Catalog of the recorded video segments, kept in SQLite on local storage.
+'''
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import appdirs
+
+from DataServer.ioExecutor import IOExecutor
+
+# Name of the segments written by ClientHandler.runRTPServer
+SEGMENT_NAME_FORMAT = '%Y.%m.%d.%H.%M.%S.mp4'
+CATALOG_NAME = 'video_catalog.sqlite'
+
+
+def defaultCatalogPath() -> str:
+    """Local path of the catalog when none is configured.  The data
+    directory is often a network share, which SQLite's WAL mode does not
+    support.
+    """
+    return os.path.join(appdirs.user_data_dir('ASMDataServer'), CATALOG_NAME)
+
+
+@dataclass
+class Segment:
+    device: str
+    start: dt.datetime
+    end: dt.datetime
+    size: int
+    path: str
+
+
+def parseSegmentName(fname: str) -> Optional[dt.datetime]:
+    """Reads the start time from a segment file name.
+
+    Args:
+        fname (str): File name, with or without directories
+
+    Returns:
+        Optional[dt.datetime]: Local start time, or None if the name is not a
+        segment name
+    """
+    try:
+        return dt.datetime.strptime(os.path.basename(fname),
+                                    SEGMENT_NAME_FORMAT)
+    except ValueError:
+        return None
+
+
+class VideoCatalog:
+    """SQLite table of video segments by device and time.
+
+    Segments of a device do not overlap and are no longer than the longest
+    segment in the table, so the segments overlapping a window are found
+    with a single range scan of the (device, start) index.
+
+    On local storage the database is in WAL mode, so several server
+    processes can add segments while it is being queried.  WAL needs shared
+    memory, so pass wal=False for a database on a network filesystem.  It
+    then uses a rollback journal, and writers and readers block each other.
+    """
+
+    def __init__(self, path: str, wal: bool = True) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.__db = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        with self.__lock, self.__db:
+            self.__db.execute('PRAGMA journal_mode=' +
+                              ('WAL' if wal else 'DELETE'))
+            self.__db.execute('CREATE TABLE IF NOT EXISTS segments ('
+                              'device TEXT NOT NULL, '
+                              'start REAL NOT NULL, '
+                              'end REAL NOT NULL, '
+                              'size INTEGER NOT NULL, '
+                              'path TEXT NOT NULL UNIQUE)')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS segments_by_start '
+                              'ON segments (device, start)')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS segments_by_length '
+                              'ON segments (end - start)')
+
+    def add(self, segment: Segment, replace: bool = True) -> None:
+        """Adds a segment.  This blocks on the database, call it from the IO
+        executor.
+
+        Args:
+            segment (Segment): Segment to add
+            replace (bool, optional): Replace an existing entry for the same
+            path, otherwise keep it. Defaults to True.
+        """
+        self.addMany([segment], replace)
+
+    def addMany(self, segments: Iterable[Segment],
+                replace: bool = True) -> int:
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        rows = [(segment.device, segment.start.timestamp(),
+                 segment.end.timestamp(), segment.size,
+                 os.path.abspath(segment.path)) for segment in segments]
+        with self.__lock, self.__db:
+            cursor = self.__db.executemany(
+                f'{verb} INTO segments (device, start, end, size, path) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+            return cursor.rowcount
+
+    def query(self, device: str, start: dt.datetime,
+              end: dt.datetime) -> List[Segment]:
+        """Finds the segments of a device that overlap a time window.
+
+        Args:
+            device (str): Device ID
+            start (dt.datetime): Start of the window
+            end (dt.datetime): End of the window
+
+        Returns:
+            List[Segment]: Overlapping segments, oldest first
+        """
+        window_start = start.timestamp()
+        window_end = end.timestamp()
+        with self.__lock:
+            longest = self.__db.execute(
+                'SELECT MAX(end - start) FROM segments').fetchone()[0]
+            if longest is None:
+                return []
+            rows = self.__db.execute(
+                'SELECT device, start, end, size, path FROM segments '
+                'WHERE device = ? AND start >= ? AND start < ? AND end > ? '
+                'ORDER BY start',
+                (device, window_start - longest, window_end,
+                 window_start)).fetchall()
+        return [self.__toSegment(row) for row in rows]
+
+    @staticmethod
+    def __toSegment(row: Tuple) -> Segment:
+        device, start, end, size, path = row
+        return Segment(device=device, start=dt.datetime.fromtimestamp(start),
+                       end=dt.datetime.fromtimestamp(end), size=size,
+                       path=path)
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__db.close()
+
+    def backfill(self, data_dir: str, segment_length_s: float) -> int:
+        """Adds the segments already in data_dir.  Segments that are in the
+        catalog are left as they are.
+
+        The end of each segment is taken to be the start of the next segment
+        of the same device, but at most segment_length_s after its start.
+
+        Args:
+            data_dir (str): Data directory, with one directory per device
+            segment_length_s (float): Configured segment length
+
+        Returns:
+            int: Number of segments added
+        """
+        added = 0
+        for device in sorted(os.listdir(data_dir)):
+            device_dir = os.path.join(data_dir, device)
+            if not os.path.isdir(device_dir):
+                continue
+            starts = []
+            for fname in os.listdir(device_dir):
+                start = parseSegmentName(fname)
+                if start is not None:
+                    starts.append((start, os.path.join(device_dir, fname)))
+            starts.sort()
+            segments = []
+            for idx, (start, path) in enumerate(starts):
+                end = start + dt.timedelta(seconds=segment_length_s)
+                if idx + 1 < len(starts):
+                    end = min(end, starts[idx + 1][0])
+                segments.append(Segment(device=device, start=start, end=end,
+                                        size=os.path.getsize(path), path=path))
+            if segments:
+                added += self.addMany(segments, replace=False)
+        return added
+
+
+class SegmentListFollower:
+    """Adds segments to the catalog as ffmpeg closes them, and passes them
+    on to on_closed.
+
+    ffmpeg is started with "-segment_list pipe:N -segment_list_type csv",
+    which writes a "file,start,end" line for each closed segment, with times
+    in seconds from the start of the stream.  The segment's wall clock start
+    comes from its file name.
+    """
+
+    def __init__(self, catalog: Optional[VideoCatalog], device: str,
+                 directory: str,
+                 on_closed: Optional[Callable[[str], None]] = None) -> None:
+        self._log = logging.getLogger(self.__class__.__name__)
+        self.catalog = catalog
+        self.device = device
+        self.directory = directory
+        self.__on_closed = on_closed
+        self.segments = 0
+
+    def parseLine(self, line: str) -> Optional[Segment]:
+        """Turns a segment list line into a segment, without its size.
+
+        Args:
+            line (str): Line of the csv segment list
+
+        Returns:
+            Optional[Segment]: Segment, or None if the line is not valid
+        """
+        # The file name may contain commas, the times never do
+        fields = line.strip().rsplit(',', 2)
+        if len(fields) != 3:
+            return None
+        fname, start_s, end_s = fields
+        start = parseSegmentName(fname.strip('"'))
+        try:
+            duration = float(end_s) - float(start_s)
+        except ValueError:
+            return None
+        if start is None:
+            return None
+        path = os.path.join(self.directory, os.path.basename(fname.strip('"')))
+        return Segment(device=self.device, start=start,
+                       end=start + dt.timedelta(seconds=duration), size=0,
+                       path=path)
+
+    def record(self, segment: Segment) -> None:
+        """Stats the segment and adds it to the catalog.  This blocks, call it
+        from the IO executor.
+        """
+        try:
+            segment.size = os.path.getsize(segment.path)
+        except OSError:
+            self._log.warning(f'Closed segment {segment.path} is missing')
+            return
+        if self.catalog is not None:
+            self.catalog.add(segment)
+        if self.__on_closed is not None:
+            self.__on_closed(segment.path)
+        self.segments += 1
+
+    async def follow(self, stream: asyncio.StreamReader,
+                     io_executor: IOExecutor, io_key: str) -> None:
+        """Reads the segment list until ffmpeg closes it.
+
+        Args:
+            stream (asyncio.StreamReader): Read end of the segment list pipe
+            io_executor (IOExecutor): Executor for the catalog writes
+            io_key (str): Key to order the writes by
+        """
+        async for raw_line in stream:
+            segment = self.parseLine(raw_line.decode(errors='replace'))
+            if segment is None:
+                continue
+            await io_executor.run(io_key, self.record, segment)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ASM video segment catalog')
+    parser.add_argument('data_dir', help='Server data directory')
+    parser.add_argument('--catalog', default=defaultCatalogPath(),
+                        help='Catalog database, the configured '
+                        'video_catalog_path')
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill = commands.add_parser('backfill', help='Add existing segments')
+    backfill.add_argument('--segment-length', type=float, default=300,
+                          help='Configured video_increment in seconds')
+    query = commands.add_parser('query', help='List segments in a window')
+    query.add_argument('device', help='Device ID')
+    query.add_argument('start', type=dt.datetime.fromisoformat,
+                       help='Window start, ISO 8601 local time')
+    query.add_argument('end', type=dt.datetime.fromisoformat,
+                       help='Window end, ISO 8601 local time')
+    args = parser.parse_args()
+
+    catalog = VideoCatalog(args.catalog)
+    try:
+        if args.command == 'backfill':
+            added = catalog.backfill(args.data_dir, args.segment_length)
+            print(f'Added {added} segments')
+        else:
+            for segment in catalog.query(args.device, args.start, args.end):
+                print(f'{segment.start.isoformat()} {segment.end.isoformat()} '
+                      f'{segment.size} {segment.path}')
+    finally:
+        catalog.close()
+
+
+if __name__ == '__main__':
+    main()
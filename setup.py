@@ -13,7 +13,10 @@ setup(
 	packages=find_packages(),
 	entry_points={
 		'console_scripts': [
-			'runServer = DataServer.runServer:main'
+			'runServer = DataServer.runServer:main',
+			'asmLoadGen = DataServer.loadGen:main',
+			'asmVideoCatalog = DataServer.videoCatalog:main',
+			'asmEventStore = DataServer.eventStore:main'
 		]
 	},
 	install_requires=[
@@ -23,6 +26,7 @@ setup(
 		'appdirs',
 		'pytest'],
 	extras_require={
+		'uvloop': ['uvloop'],
 		'dev': [
 			'pytest',
 			'coverage',
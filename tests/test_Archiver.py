@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+
+from DataServer.archiver import MANIFEST_NAME, Archiver
+
+
+def readManifest(archive_dir: pathlib.Path):
+    with open(pathlib.Path(archive_dir, MANIFEST_NAME)) as manifest:
+        return [json.loads(line) for line in manifest]
+
+
+def test_transfer(tmp_path: pathlib.Path):
+    async def run():
+        data_dir = pathlib.Path(tmp_path, 'data')
+        archive_dir = pathlib.Path(tmp_path, 'archive')
+        device_dir = pathlib.Path(data_dir, 'device')
+        device_dir.mkdir(parents=True)
+        segment = pathlib.Path(device_dir, '2026.01.01.12.00.00.mp4')
+        segment.write_bytes(os.urandom(300000))
+        raw = pathlib.Path(device_dir, '2026.01.01.12.00.00.bin')
+        raw.write_bytes(os.urandom(1000))
+        pathlib.Path(device_dir, 'labels.csv').write_text('not archived\n')
+
+        archiver = Archiver(str(data_dir), str(archive_dir), max_transfers=2,
+                            chunk_bytes=65536)
+        # Files from before the start are found by the scan
+        await archiver.start(scan=True)
+        await archiver.join()
+        assert(archiver.files == 2 and archiver.failures == 0)
+        for path in (segment, raw):
+            copy = pathlib.Path(archive_dir, 'device', path.name)
+            assert(copy.read_bytes() == path.read_bytes())
+        entries = {entry['path']: entry for entry in readManifest(archive_dir)}
+        assert(entries[os.path.join('device', segment.name)]['sha256'] ==
+               hashlib.sha256(segment.read_bytes()).hexdigest())
+        assert(not pathlib.Path(archive_dir, 'device', 'labels.csv').exists())
+
+        # Archived files are not copied again
+        archiver.submit(str(segment))
+        await asyncio.sleep(0.01)
+        await archiver.join()
+        assert(archiver.files == 2)
+        await archiver.close()
+
+        # A new archiver picks up from the manifest
+        restarted = Archiver(str(data_dir), str(archive_dir))
+        await restarted.start(scan=True)
+        await restarted.join()
+        assert(restarted.files == 0)
+        await restarted.close()
+    asyncio.run(run())
+
+
+def test_resume(tmp_path: pathlib.Path):
+    async def run():
+        data_dir = pathlib.Path(tmp_path, 'data')
+        archive_dir = pathlib.Path(tmp_path, 'archive')
+        data_dir.mkdir()
+        archive_dir.mkdir()
+        source = pathlib.Path(data_dir, 'data.bin')
+        content = os.urandom(10 * 4096)
+        source.write_bytes(content)
+        # An interrupted copy, with a torn last chunk
+        part = pathlib.Path(archive_dir, 'data.bin.part')
+        part.write_bytes(content[:3 * 4096] + bytes(4096))
+
+        archiver = Archiver(str(data_dir), str(archive_dir), chunk_bytes=4096)
+        await archiver.start()
+        assert(await archiver.transfer(str(source)))
+        assert(archiver.bytes_copied == 7 * 4096)
+        assert(pathlib.Path(archive_dir, 'data.bin').read_bytes() == content)
+        assert(not part.exists())
+        assert(readManifest(archive_dir)[0]['sha256'] ==
+               hashlib.sha256(content).hexdigest())
+
+        # A modified file is copied again
+        source.write_bytes(content[::-1])
+        assert(await archiver.transfer(str(source)))
+        assert(pathlib.Path(archive_dir, 'data.bin').read_bytes() ==
+               content[::-1])
+        await archiver.close()
+    asyncio.run(run())
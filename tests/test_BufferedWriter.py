@@ -0,0 +1,40 @@
+import asyncio
+import pathlib
+
+from DataServer.bufferedWriter import BufferedLineWriter, WriterGroup
+
+
+def test_BufferedLineWriter(tmp_path: pathlib.Path):
+    async def run():
+        writer = BufferedLineWriter(pathlib.Path(tmp_path, 'dev', 'labels.csv'),
+                                    flush_bytes=1024, flush_interval_s=60)
+        for i in range(100):
+            writer.write(f'{i}\n')
+        # Below the size threshold and before the interval, nothing is written
+        await asyncio.sleep(0)
+        assert(writer.stats.flushes == 0)
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    lines = pathlib.Path(tmp_path, 'dev', 'labels.csv').read_text().splitlines()
+    assert(lines == [str(i) for i in range(100)])
+    assert(writer.stats.lines == 100)
+    assert(writer.stats.flushes == 1)
+
+
+def test_WriterGroupSizeFlush(tmp_path: pathlib.Path):
+    async def run():
+        group = WriterGroup(tmp_path, flush_bytes=16, flush_interval_s=60,
+                            fsync=False)
+        # Lines from the same tick are merged into a single write
+        for _ in range(10):
+            group.write('flipper_data.txt', '0123456789\n')
+        await group.close()
+        return group
+
+    group = asyncio.run(run())
+    assert(group.stats.flushes == 1)
+    assert(group.stats.lines == 10)
+    assert(group.stats.bytes_written == 110)
+    assert(pathlib.Path(tmp_path, 'flipper_data.txt').stat().st_size == 110)
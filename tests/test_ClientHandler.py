@@ -0,0 +1,67 @@
+import asyncio
+import pathlib
+import uuid
+
+import pytest
+import yaml
+
+pytest.importorskip('asm_protocol.codec')
+
+from DataServer.devices import DeviceTree
+from DataServer.ffmpegSupervisor import FFmpegSupervisor
+from DataServer.ioExecutor import IOExecutor
+from DataServer.metrics import MetricsRegistry
+from DataServer.server import ClientHandler, ServerConfig, ServerMetrics
+
+
+class Label:
+    def __init__(self, seq: int) -> None:
+        self.seq = seq
+
+
+def test_packetsBeforeHeartbeat(tmp_path: pathlib.Path):
+    data_dir = pathlib.Path(tmp_path, 'data')
+    data_dir.mkdir()
+    config_path = pathlib.Path(tmp_path, 'config.yaml')
+    config_path.write_text(yaml.safe_dump({
+        'data_dir': str(data_dir),
+        'port': 9000,
+        'server_uuid': str(uuid.uuid4()),
+        'video_increment': 300,
+        'rtsp_port_block': [10700, 10710],
+        'max_packet_handlers': 4,
+    }))
+
+    async def run():
+        executor = IOExecutor()
+        client = ClientHandler(
+            device_tree=DeviceTree(str(pathlib.Path(data_dir, 'devices.yaml'))),
+            reader=None, writer=None, config=ServerConfig(str(config_path)),
+            io_executor=executor, ffmpeg_supervisor=FFmpegSupervisor(),
+            metrics=ServerMetrics(MetricsRegistry()))
+        seen = []
+
+        async def labels(packet):
+            # Like the event handlers, this needs the client's device
+            await client.hasClient.wait()
+            seen.append(packet.seq)
+
+        client._packet_handlers = {Label: labels}
+        client._ordered_handlers = {labels}
+        # Far more packets than an ordered lane holds, the reader must not
+        # block on them before the heartbeat is read
+        async def receive():
+            for seq in range(40):
+                await client.dispatch_packet(Label(seq))
+
+        await asyncio.wait_for(receive(), 5)
+        client.hasClient.set()
+        for _ in range(100):
+            if len(seen) == 40:
+                break
+            await asyncio.sleep(0.01)
+        await client._dispatcher.close()
+        executor.shutdown()
+        return seen
+
+    assert(asyncio.run(run()) == list(range(40)))
@@ -0,0 +1,53 @@
+import uuid
+
+import pytest
+
+from DataServer.connectionGuard import SessionTable, TokenBucket
+
+
+def test_TokenBucket():
+    now = [0.0]
+    bucket = TokenBucket(rate_per_s=10, burst=5, clock=lambda: now[0])
+    assert(all(bucket.take() for _ in range(5)))
+    assert(not bucket.take())
+    now[0] += 0.25
+    assert(bucket.take() and bucket.take())
+    assert(not bucket.take())
+    # Idle time never saves up more than the burst
+    now[0] += 60
+    assert(sum(bucket.take() for _ in range(100)) == 5)
+    with pytest.raises(RuntimeError):
+        TokenBucket(rate_per_s=0, burst=1)
+
+
+def test_SessionTable():
+    table = SessionTable()
+    device = uuid.uuid4()
+    first = object()
+    second = object()
+    assert(table.claim(device, first) is None)
+    assert(table.claim(device, first) is None)
+    assert(table.claim(device, second) is first)
+    assert(table.superseded == 1)
+    # The replaced session closing does not end its replacement
+    table.release(device, first)
+    assert(len(table) == 1)
+    table.release(device, second)
+    assert(len(table) == 0)
+    assert(table.claim(uuid.uuid4(), first) is None)
+
+
+def test_SessionTablePerWorker():
+    # Workers do not share their tables, so a unit that reconnects to
+    # another worker does not supersede its session on the first one
+    worker_a = SessionTable()
+    worker_b = SessionTable()
+    device = uuid.uuid4()
+    stale = object()
+    assert(worker_a.claim(device, stale) is None)
+    assert(worker_b.claim(device, object()) is None)
+    assert(worker_a.superseded == 0 and worker_b.superseded == 0)
+    assert(len(worker_a) == 1)
+    # It stays until the liveness tracker reaps it and it is released
+    worker_a.release(device, stale)
+    assert(len(worker_a) == 0)
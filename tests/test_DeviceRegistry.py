@@ -0,0 +1,58 @@
+import asyncio
+import datetime as dt
+import pathlib
+import uuid
+
+import pytest
+
+from DataServer.deviceRegistry import DeviceRegistryServer, RemoteDeviceTree
+from DataServer.devices import (Device, DeviceNotFoundError, DeviceTree,
+                                DeviceType)
+
+
+def test_RemoteDeviceTree(tmp_path: pathlib.Path):
+    async def run():
+        tree = DeviceTree(str(pathlib.Path(tmp_path, 'devices.yaml')))
+        known = Device(uuid.uuid4(), 'Known', DeviceType.ASM_REMOTE_SENSOR_UNIT)
+        tree.addDevice(known)
+        socket_path = str(pathlib.Path(tmp_path, 'devices.sock'))
+        server = await DeviceRegistryServer(tree, socket_path).start()
+        worker_a = RemoteDeviceTree(socket_path)
+        worker_b = RemoteDeviceTree(socket_path, heard_interval_s=0.05)
+
+        # The worker side does not block, so it can share the registry's loop
+        remote = await worker_a.getDeviceByUUID(known.deviceID)
+        assert(remote == known)
+
+        new_device = Device(uuid.uuid4(), 'Auto', DeviceType.AUTO_REGISTERED)
+        with pytest.raises(DeviceNotFoundError):
+            await worker_a.getDeviceByUUID(new_device.deviceID)
+        await worker_a.addDevice(new_device)
+        assert(tree.getDeviceByUUID(new_device.deviceID) == new_device)
+        # Registered by one worker, visible to the others
+        seen_by_b = await worker_b.getDeviceByUUID(new_device.deviceID)
+        assert(seen_by_b.description == 'Auto')
+
+        # Last heard from times are batched until the next report
+        reporter = asyncio.create_task(worker_b.run())
+        heard = dt.datetime.now()
+        seen_by_b.setLastHeardFrom(heard)
+        assert(tree.getDeviceByUUID(new_device.deviceID)._last_comms is None)
+        await asyncio.sleep(0.2)
+        assert(tree.getDeviceByUUID(new_device.deviceID)._last_comms == heard)
+        assert(tree.getStaleDevices(heard + dt.timedelta(seconds=1))[0]
+               .deviceID == new_device.deviceID)
+        reporter.cancel()
+
+        # Reported on flush as well
+        later = heard + dt.timedelta(seconds=5)
+        seen_by_b.setLastHeardFrom(later)
+        await worker_b.flush()
+        assert(tree.getDeviceByUUID(new_device.deviceID)._last_comms == later)
+
+        worker_a.close()
+        worker_b.close()
+        server.close()
+        await server.wait_closed()
+        tree.flush()
+    asyncio.run(run())
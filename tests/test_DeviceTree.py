@@ -0,0 +1,159 @@
+import datetime as dt
+import os
+import pathlib
+import threading
+import time
+import uuid
+
+import yaml
+
+from DataServer.devices import Device, DeviceTree, DeviceType
+
+
+def make_device(idx: int) -> Device:
+    return Device(uuid.uuid4(), f'Device {idx}', DeviceType.AUTO_REGISTERED,
+                  location=f'Enclosure {idx % 4}')
+
+
+def test_DeviceTreeJournal(tmp_path: pathlib.Path):
+    path = str(pathlib.Path(tmp_path, 'devices.yaml'))
+    tree = DeviceTree(path, compact_every=100)
+    devices = [make_device(idx) for idx in range(10)]
+    for device in devices:
+        tree.addDevice(device)
+    tree.flush()
+    # Changes are journaled, not written to the snapshot
+    with open(path, 'r') as stream:
+        assert(yaml.safe_load(stream) == {})
+    assert(os.path.getsize(path + DeviceTree.JOURNAL_SUFFIX) > 0)
+
+    # Simulate a crash in the middle of a journal write
+    with open(path + DeviceTree.JOURNAL_SUFFIX, 'a') as journal:
+        journal.write('{"op": "add", "id"')
+
+    reloaded = DeviceTree(path, compact_every=100)
+    for device in devices:
+        loaded = reloaded.getDeviceByUUID(device.deviceID)
+        assert(loaded.to_dict() == device.to_dict())
+
+    # The partial line is dropped, so later changes are not appended to it
+    added = make_device(10)
+    reloaded.addDevice(added)
+    reloaded.flush()
+    again = DeviceTree(path, compact_every=100)
+    assert(again.getDeviceByUUID(added.deviceID).to_dict() == added.to_dict())
+    assert(len(again.getDevices()) == len(devices) + 1)
+
+
+def test_DeviceTreeCompaction(tmp_path: pathlib.Path):
+    path = str(pathlib.Path(tmp_path, 'devices.yaml'))
+    tree = DeviceTree(path, compact_every=5)
+    devices = [make_device(idx) for idx in range(12)]
+    for device in devices:
+        tree.addDevice(device)
+        tree.flush()
+    tree.saveToDisk()
+    assert(os.path.getsize(path + DeviceTree.JOURNAL_SUFFIX) == 0)
+    assert(not os.path.exists(path + '.tmp'))
+    with open(path, 'r') as stream:
+        snapshot = yaml.safe_load(stream)
+    assert(set(snapshot) == {str(device.deviceID) for device in devices})
+
+
+def test_DeviceTreeSaveDuringCompaction(tmp_path: pathlib.Path):
+    path = str(pathlib.Path(tmp_path, 'devices.yaml'))
+    # Every change compacts, so snapshots are written all the time
+    tree = DeviceTree(path, compact_every=1)
+    devices = [make_device(idx) for idx in range(50)]
+    errors = []
+
+    def save() -> None:
+        try:
+            for _ in range(10):
+                tree.saveToDisk()
+        except Exception as e: # pragma: no cover
+            errors.append(e) # pragma: no cover
+
+    savers = [threading.Thread(target=save) for _ in range(2)]
+    for saver in savers:
+        saver.start()
+    for device in devices:
+        tree.addDevice(device)
+    for saver in savers:
+        saver.join()
+    assert(errors == [])
+    tree.saveToDisk()
+    with open(path, 'r') as stream:
+        snapshot = yaml.safe_load(stream)
+    assert(set(snapshot) == {str(device.deviceID) for device in devices})
+
+
+def test_DeviceTreeStartupBenchmark(tmp_path: pathlib.Path):
+    path = str(pathlib.Path(tmp_path, 'devices.yaml'))
+    n_devices = 10000
+    device_dict = {str(uuid.uuid4()): make_device(idx).to_dict()
+                   for idx in range(n_devices)}
+    with open(path, 'w') as stream:
+        yaml.safe_dump(device_dict, stream)
+
+    start = time.perf_counter()
+    tree = DeviceTree(path)
+    cold_s = time.perf_counter() - start
+    # Wait for the cache to be written
+    tree.flush()
+    assert(os.path.isfile(path + DeviceTree.CACHE_SUFFIX))
+
+    start = time.perf_counter()
+    cached = DeviceTree(path)
+    cached_s = time.perf_counter() - start
+    assert(cached_s < cold_s)
+    for id in list(device_dict)[:100]:
+        loaded = cached.getDeviceByUUID(uuid.UUID(id))
+        assert(loaded.to_dict() == device_dict[id])
+
+    # Editing the YAML invalidates the cache
+    device_dict.popitem()
+    with open(path, 'w') as stream:
+        yaml.safe_dump(device_dict, stream)
+    assert(len(DeviceTree(path).getDevices()) == n_devices - 1)
+
+
+def test_DeviceTreeIndexes(tmp_path: pathlib.Path):
+    tree = DeviceTree(str(pathlib.Path(tmp_path, 'devices.yaml')))
+    devices = [make_device(idx) for idx in range(8)]
+    for device in devices:
+        tree.addDevice(device)
+    assert(not hasattr(devices[0], '__dict__'))
+
+    in_enclosure = tree.getDevicesByLocation('Enclosure 1')
+    assert({device.deviceID for device in in_enclosure} ==
+           {devices[1].deviceID, devices[5].deviceID})
+    assert(len(tree.getDevicesByType(DeviceType.AUTO_REGISTERED)) == 8)
+    assert(tree.getDevicesByType(DeviceType.ASM_ON_BOX_SENSOR_UNIT) == [])
+
+    # Re-adding a device moves it in the indexes
+    moved = Device(devices[1].deviceID, 'Moved', DeviceType.ASM_ON_BOX_SENSOR_UNIT,
+                   fw_version='1.2.0', location='Enclosure 2')
+    tree.addDevice(moved)
+    assert(tree.getDevicesByLocation('Enclosure 1') == [devices[5]])
+    assert(tree.getDevicesByType(DeviceType.ASM_ON_BOX_SENSOR_UNIT) == [moved])
+    assert(tree.getDevicesByFirmware('1.2.0') == [moved])
+    # So does changing it in place and re-adding the same object
+    moved.location = 'Enclosure 3'
+    tree.addDevice(moved)
+    in_enclosure = tree.getDevicesByLocation('Enclosure 2')
+    assert(moved.deviceID not in {device.deviceID for device in in_enclosure})
+    in_enclosure = tree.getDevicesByLocation('Enclosure 3')
+    assert(moved.deviceID in {device.deviceID for device in in_enclosure})
+
+    now = dt.datetime.now()
+    for idx, device in enumerate(devices[2:6]):
+        device.setLastHeardFrom(now - dt.timedelta(minutes=20 - idx * 5))
+    stale = tree.getStaleDevices(now - dt.timedelta(minutes=10))
+    assert(stale == [devices[2], devices[3]])
+    # Hearing from a device again removes it from the stale set
+    devices[2].setLastHeardFrom(now)
+    stale = tree.getStaleDevices(now - dt.timedelta(minutes=10))
+    assert(stale == [devices[3]])
+    assert(len(tree.getSilentDevices()) == 4)
+    tree.flush()
@@ -0,0 +1,94 @@
+import asyncio
+
+from DataServer.dispatcher import PacketDispatcher
+
+
+def test_ordered():
+    async def run():
+        dispatcher = PacketDispatcher(max_concurrency=4)
+        seen = []
+
+        async def handler(packet):
+            # Later packets finish sooner if they are run concurrently
+            await asyncio.sleep(0.01 * (10 - packet))
+            seen.append(packet)
+
+        for i in range(10):
+            await dispatcher.dispatch(handler, i, ordered=True)
+        while dispatcher.completed < 10:
+            await asyncio.sleep(0.01)
+        await dispatcher.close()
+        return seen
+    assert(asyncio.run(run()) == list(range(10)))
+
+
+def test_bounded():
+    async def run():
+        dispatcher = PacketDispatcher(max_concurrency=4)
+        peak = 0
+        release = asyncio.Event()
+
+        async def handler(packet):
+            nonlocal peak
+            peak = max(peak, dispatcher.in_flight)
+            await release.wait()
+
+        dispatch = asyncio.gather(
+            *[dispatcher.dispatch(handler, i) for i in range(10)])
+        await asyncio.sleep(0.05)
+        assert(dispatcher.in_flight == 4)
+        assert(dispatcher.queued == 6)
+        release.set()
+        await dispatch
+        while dispatcher.completed < 10:
+            await asyncio.sleep(0.01)
+        await dispatcher.close()
+        return peak
+    assert(asyncio.run(run()) == 4)
+
+
+def test_failures_and_close():
+    async def run():
+        dispatcher = PacketDispatcher()
+
+        async def failing(packet):
+            raise ValueError(packet)
+
+        async def hanging(packet):
+            await asyncio.Event().wait()
+
+        await dispatcher.dispatch(failing, 1)
+        await dispatcher.dispatch(hanging, 2)
+        await dispatcher.dispatch(hanging, 3, ordered=True)
+        await asyncio.sleep(0.01)
+        assert(dispatcher.failed == 1)
+        assert(dispatcher.in_flight == 2)
+        await dispatcher.close(drain_timeout_s=0.05)
+        return dispatcher.stats()
+    stats = asyncio.run(run())
+    assert(stats['in_flight'] == 0)
+    assert(stats['completed'] == 0)
+
+
+def test_close_drains_ordered():
+    async def run():
+        dispatcher = PacketDispatcher(max_concurrency=8)
+        seen = []
+
+        async def ordered(packet):
+            await asyncio.sleep(0.01)
+            seen.append(packet)
+
+        async def hanging(packet):
+            await asyncio.Event().wait()
+
+        await dispatcher.dispatch(hanging, 0)
+        for i in range(5):
+            await dispatcher.dispatch(ordered, i, ordered=True)
+        # Queued ordered packets are handled, the unordered one is cancelled
+        await dispatcher.close()
+        return seen, dispatcher.stats()
+    seen, stats = asyncio.run(run())
+    assert(seen == list(range(5)))
+    assert(stats['completed'] == 5)
+    assert(stats['in_flight'] == 0)
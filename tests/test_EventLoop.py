@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from DataServer.eventLoop import LoopWatchdog, installEventLoop
+from DataServer.metrics import MetricsRegistry
+
+
+def test_installEventLoop():
+    assert(installEventLoop('asyncio') == 'asyncio')
+    assert(installEventLoop('auto') in ('asyncio', 'uvloop'))
+    with pytest.raises(RuntimeError):
+        installEventLoop('gevent')
+    installEventLoop('asyncio')
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+def test_LoopWatchdog(caplog):
+    async def run():
+        histogram = MetricsRegistry().histogram('lag_seconds', 'Lag')
+        watchdog = LoopWatchdog(threshold_s=0.05, interval_s=0.01,
+                                histogram=histogram)
+        task = asyncio.create_task(watchdog.run())
+        await asyncio.sleep(0.05)
+        blocking_call()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return watchdog, histogram
+    with caplog.at_level(logging.WARNING):
+        watchdog, histogram = asyncio.run(run())
+    assert(watchdog.stalls == 1)
+    assert(watchdog.max_lag_s >= 0.25)
+    assert(histogram.quantile(1.0) > 0.05)
+    # The stack was taken while the loop was blocked
+    assert('blocking_call' in caplog.text)
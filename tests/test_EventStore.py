@@ -0,0 +1,82 @@
+import datetime as dt
+import pathlib
+import time
+
+from DataServer.eventStore import EventStore, compactDataDir, parseLine
+
+
+def writeLabels(device_dir: pathlib.Path, start: dt.datetime, count: int,
+                step: dt.timedelta):
+    with open(pathlib.Path(device_dir, 'labels.csv'), 'a') as handle:
+        for idx in range(count):
+            timestamp = start + idx * step
+            handle.write(f'{timestamp.isoformat()}, {"sleep" if idx % 2 else "awake"}\n')
+
+
+def test_parseLine():
+    assert(parseLine('labels', '2026-01-01T12:00:00.500000, a, b\n') ==
+           (dt.datetime(2026, 1, 1, 12, 0, 0, 500000), 'a, b'))
+    assert(parseLine('flipper', '2026-01-01 12:00:00: out\n') ==
+           (dt.datetime(2026, 1, 1, 12), 'out'))
+    assert(parseLine('labels', 'not a label\n') is None)
+    assert(parseLine('flipper', 'garbage: in\n') is None)
+
+
+def test_compact(tmp_path: pathlib.Path):
+    device_dir = pathlib.Path(tmp_path, 'device')
+    device_dir.mkdir()
+    base = dt.datetime(2026, 1, 1)
+    writeLabels(device_dir, base, 3 * 24, dt.timedelta(hours=1))
+    with open(pathlib.Path(device_dir, 'flipper_data.txt'), 'w') as handle:
+        handle.write(f'{base + dt.timedelta(hours=1)}: in\n')
+        handle.write(f'{base + dt.timedelta(hours=2)}: out\n')
+        # Partial line, still being written
+        handle.write(f'{base + dt.timedelta(hours=3)}: i')
+
+    store = EventStore(str(device_dir))
+    # Jan 3 is still open
+    assert(store.compact('labels', today=dt.date(2026, 1, 3)) == 48)
+    assert(store.compact('flipper', today=dt.date(2026, 1, 3)) == 2)
+    assert(sorted(store.readIndex('labels')['days']) ==
+           ['2026-01-01', '2026-01-02'])
+    assert(store.compact('labels', today=dt.date(2026, 1, 3)) == 0)
+
+    slices = store.query('labels', base + dt.timedelta(hours=20),
+                         base + dt.timedelta(hours=50))
+    events = [event for day_slice in slices for event in day_slice]
+    assert(len(events) == 30)
+    assert(events[0] == (base + dt.timedelta(hours=20), 'awake'))
+    assert(events[-1] == (base + dt.timedelta(hours=49), 'sleep'))
+    # The first two days come from chunks, the rest from the text log
+    assert([day_slice.day for day_slice in slices] ==
+           [dt.date(2026, 1, 1), dt.date(2026, 1, 2), dt.date(2026, 1, 3)])
+    flipper = [event for day_slice in store.query(
+        'flipper', base, base + dt.timedelta(days=1)) for event in day_slice]
+    assert([value for _, value in flipper] == ['in', 'out'])
+
+    # A late event for a closed day is merged into its chunk
+    writeLabels(device_dir, base + dt.timedelta(minutes=30), 1,
+                dt.timedelta(0))
+    assert(store.compact('labels', today=dt.date(2026, 1, 5)) == 25)
+    day_one = store.query('labels', base, base + dt.timedelta(days=1))
+    assert(len(day_one) == 1 and len(day_one[0]) == 25)
+    assert(list(day_one[0])[1] == (base + dt.timedelta(minutes=30), 'awake'))
+    store.close()
+
+    assert(compactDataDir(str(tmp_path), today=dt.date(2026, 1, 5)) == 0)
+
+
+def test_queryYear(tmp_path: pathlib.Path):
+    device_dir = pathlib.Path(tmp_path, 'device')
+    device_dir.mkdir()
+    base = dt.datetime(2025, 1, 1)
+    writeLabels(device_dir, base, 365 * 96, dt.timedelta(minutes=15))
+    store = EventStore(str(device_dir))
+    store.compact('labels', today=dt.date(2026, 1, 1))
+
+    start = time.perf_counter()
+    slices = store.query('labels', base, base + dt.timedelta(days=365))
+    elapsed = time.perf_counter() - start
+    assert(sum(len(day_slice) for day_slice in slices) == 365 * 96)
+    assert(elapsed < 0.5)
+    store.close()
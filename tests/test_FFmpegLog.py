@@ -0,0 +1,33 @@
+import asyncio
+import pathlib
+
+from DataServer.bufferedWriter import WriterGroup
+from DataServer.ffmpegLog import FFmpegLogParser
+
+
+def test_FFmpegLogParser(tmp_path: pathlib.Path):
+    script = ('printf "frame=1\\nfps=30.0\\nprogress=continue\\n'
+              'frame=2\\nfps=29.9\\nprogress=end\\n"; '
+              'echo "Input #0, h264" >&2; echo "Output #0, segment" >&2')
+
+    async def run():
+        logs = WriterGroup(tmp_path, fsync=False)
+        parser = FFmpegLogParser(logs.getWriter('stats.log'),
+                                 logs.getWriter('info.log'))
+        proc = await asyncio.create_subprocess_exec(
+            'sh', '-c', script, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        await parser.drain(proc)
+        await proc.wait()
+        await logs.close()
+        return parser
+
+    parser = asyncio.run(run())
+    assert(parser.progress['frame'] == '2')
+    assert(parser.progress['progress'] == 'end')
+    assert(parser.lastOutput() == 'Input #0, h264\nOutput #0, segment')
+    stats = pathlib.Path(tmp_path, 'stats.log').read_text().splitlines()
+    assert(len(stats) == 2)
+    assert(stats[0].endswith('frame=1 fps=30.0 progress=continue'))
+    info = pathlib.Path(tmp_path, 'info.log').read_text().splitlines()
+    assert(info == ['Input #0, h264', 'Output #0, segment'])
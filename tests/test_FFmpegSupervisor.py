@@ -0,0 +1,118 @@
+import asyncio
+import contextlib
+
+from DataServer.ffmpegSupervisor import AdmissionError, FFmpegSupervisor
+
+
+def test_FFmpegSupervisorAdmission():
+    async def run():
+        supervisor = FFmpegSupervisor(max_streams=1, max_queued=1,
+                                      queue_timeout_s=0.1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with supervisor.admit():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        assert(supervisor.active == 1)
+
+        # One request may queue, and times out
+        try:
+            async with supervisor.admit():
+                assert(False)
+        except AdmissionError:
+            pass
+
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        assert(supervisor.queued == 1)
+        # The queue is full, so this is rejected right away
+        try:
+            async with supervisor.admit():
+                assert(False)
+        except AdmissionError:
+            pass
+        assert(supervisor.rejected == 2)
+
+        release.set()
+        await asyncio.gather(holder, waiter)
+        assert(supervisor.active == 0)
+
+    asyncio.run(run())
+
+
+def test_FFmpegSupervisorSetLimits():
+    async def run():
+        supervisor = FFmpegSupervisor(max_streams=1, max_queued=4,
+                                      queue_timeout_s=5)
+        release = asyncio.Event()
+
+        async def hold():
+            async with supervisor.admit():
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold()) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert(supervisor.active == 1 and supervisor.queued == 2)
+        # Raising the limit lets the queued streams in
+        await supervisor.setLimits(max_streams=3, max_queued=4,
+                                   queue_timeout_s=5, max_restarts=3)
+        await asyncio.sleep(0.05)
+        assert(supervisor.active == 3 and supervisor.queued == 0)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+
+def test_FFmpegSupervisorRestart():
+    async def run():
+        supervisor = FFmpegSupervisor(max_restarts=2)
+        launches = []
+
+        async def launch():
+            launches.append(None)
+            return await asyncio.create_subprocess_exec('sh', '-c', 'exit 3')
+
+        async with supervisor.admit():
+            stream = await supervisor.start('test', launch)
+            assert(len(supervisor.stats()) == 1)
+            returncode = await stream.wait()
+        assert(returncode == 3)
+        assert(stream.restarts == 2)
+        assert(len(launches) == 3)
+        assert(supervisor.stats() == [])
+
+    asyncio.run(run())
+
+
+def test_FFmpegSupervisorRestartFails():
+    async def run():
+        supervisor = FFmpegSupervisor(max_restarts=2)
+        launches = []
+        exited = asyncio.Event()
+
+        async def launch():
+            launches.append(None)
+            if len(launches) > 1:
+                raise OSError('ffmpeg is gone')
+            return await asyncio.create_subprocess_exec('sh', '-c', 'exit 3')
+
+        async def on_exit(stream):
+            exited.set()
+
+        async with contextlib.AsyncExitStack() as cleanup:
+            await cleanup.enter_async_context(supervisor.admit())
+            stream = await supervisor.start('test', launch)
+            supervisor.watch(stream, cleanup.pop_all(), on_exit)
+        # The failed restart ends the stream, which runs the normal cleanup
+        await asyncio.wait_for(exited.wait(), 5)
+        await supervisor.close()
+        assert(len(launches) == 2)
+        assert(stream.proc.returncode == 3)
+        assert(supervisor.active == 0)
+        assert(supervisor.stats() == [])
+
+    asyncio.run(run())
@@ -0,0 +1,63 @@
+import asyncio
+import threading
+import time
+
+from DataServer.ioExecutor import IOExecutor
+
+
+def test_IOExecutorOrdering():
+    async def run():
+        executor = IOExecutor(max_workers=4, queue_depth=1024)
+        results = {key: [] for key in range(4)}
+
+        def append(key: int, value: int):
+            time.sleep(0.0001 * (value % 3))
+            results[key].append(value)
+
+        futures = [executor.submit(key, append, key, value)
+                   for value in range(50) for key in range(4)]
+        await asyncio.gather(*futures)
+        executor.shutdown()
+        return results
+
+    results = asyncio.run(run())
+    for values in results.values():
+        assert(values == list(range(50)))
+
+
+def test_IOExecutorDrain():
+    async def run():
+        executor = IOExecutor(max_workers=2)
+        done = []
+
+        def slow(value: int):
+            time.sleep(0.01)
+            done.append(value)
+
+        # Not awaited, like the raw data writes
+        for value in range(5):
+            executor.submit('key', slow, value)
+        await asyncio.wait_for(executor.drain(), 1)
+        assert(done == list(range(5)))
+        assert(executor.pending == 0)
+        await executor.drain()
+        executor.shutdown()
+
+    asyncio.run(run())
+
+
+def test_IOExecutorBackpressure():
+    async def run():
+        executor = IOExecutor(max_workers=1, queue_depth=2)
+        gate = threading.Event()
+        futures = [executor.submit('key', gate.wait) for _ in range(2)]
+        waiter = asyncio.create_task(executor.waitForCapacity())
+        await asyncio.sleep(0.01)
+        assert(not waiter.done())
+        gate.set()
+        await asyncio.wait_for(waiter, 1)
+        await asyncio.gather(*futures)
+        assert(executor.pending == 0)
+        executor.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import asyncio
+import time
+import uuid
+
+from DataServer.liveness import LivenessTracker, TimerWheel
+
+
+def test_TimerWheel():
+    wheel: TimerWheel[str] = TimerWheel(timeout_ticks=3)
+    wheel.touch('a')
+    wheel.touch('b')
+    assert(wheel.advance() == [])
+    assert(wheel.advance() == [])
+    wheel.touch('b')
+    wheel.touch('c')
+    wheel.remove('c')
+    assert(wheel.advance() == ['a'])
+    assert(wheel.advance() == [])
+    # Three ticks after it was last touched
+    assert(wheel.advance() == ['b'])
+    assert(len(wheel) == 0)
+
+
+def test_LivenessTracker():
+    reaped = []
+    tracker = LivenessTracker(timeout_s=3, on_expire=reaped.append, tick_s=1)
+    quiet = object()
+    chatty = object()
+    quiet_id = uuid.uuid4()
+    chatty_id = uuid.uuid4()
+    tracker.connect(quiet)
+    tracker.connect(chatty)
+    tracker.heard(quiet, quiet_id)
+    for _ in range(5):
+        tracker.heard(chatty, chatty_id)
+        tracker.tick()
+    assert(reaped == [quiet])
+    assert(tracker.reaped == 1)
+    # The reaped connection closes and disconnects
+    tracker.disconnect(quiet)
+    status = tracker.status()
+    assert([device['id'] for device in status['online']] == [str(chatty_id)])
+    assert([device['id'] for device in status['offline']] == [str(quiet_id)])
+
+    # A reconnect before the old connection closes keeps the device online
+    replacement = object()
+    tracker.heard(replacement, chatty_id)
+    tracker.disconnect(chatty)
+    assert(tracker.online == 1)
+
+
+def test_LivenessTrackerRun():
+    async def run():
+        reaped = []
+        tracker = LivenessTracker(timeout_s=0.05, on_expire=reaped.append,
+                                  tick_s=0.01)
+        task = asyncio.create_task(tracker.run())
+        tracker.connect('connection')
+        await asyncio.sleep(0.2)
+        task.cancel()
+        return reaped
+    assert(asyncio.run(run()) == ['connection'])
+
+
+def test_TimerWheelBenchmark():
+    wheel: TimerWheel[int] = TimerWheel(timeout_ticks=30)
+    n_connections = 10000
+    for idx in range(n_connections):
+        wheel.touch(idx)
+    start = time.perf_counter()
+    n_rounds = 10
+    for _ in range(n_rounds):
+        for idx in range(n_connections):
+            wheel.touch(idx)
+        wheel.advance()
+    elapsed = time.perf_counter() - start
+    # Constant time per heartbeat, far below a scan of all connections
+    assert(elapsed / (n_rounds * n_connections) < 1e-4)
+    assert(len(wheel) == n_connections)
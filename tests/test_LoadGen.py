@@ -0,0 +1,16 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('asm_protocol.codec')
+
+from DataServer.loadGen import LoadConfig, runLoad
+
+
+def test_loadGen(tmp_path):
+    config = LoadConfig(units=4, duration_s=2, heartbeat_hz=5, label_hz=5,
+                        flipper_hz=20, rtp_starts=1)
+    report = asyncio.run(runLoad(config, str(tmp_path)))
+    assert(report.packets_sent > 0)
+    assert(report.packets_handled == report.packets_sent)
+    assert(report.rtp_responses == config.units)
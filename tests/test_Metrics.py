@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+from DataServer.metrics import MetricsRegistry, MetricsServer
+
+
+def test_render():
+    registry = MetricsRegistry()
+    packets = registry.counter('packets_total', 'Packets', ('device',))
+    connections = registry.gauge('connections', 'Connections')
+    ports = registry.gauge('ports', 'Ports', function=lambda: 3)
+    latency = registry.histogram('latency_seconds', 'Latency', ('handler',),
+                                 buckets=(0.1, 1.0))
+    packets.labels('a').inc()
+    packets.labels('a').inc(2)
+    packets.labels('b"c').inc()
+    connections.inc()
+    connections.inc()
+    connections.dec()
+    latency.labels('h').observe(0.05)
+    latency.labels('h').observe(0.5)
+    latency.labels('h').observe(5)
+
+    lines = registry.render().splitlines()
+    assert('# TYPE packets_total counter' in lines)
+    assert('packets_total{device="a"} 3' in lines)
+    assert('packets_total{device="b\\"c"} 1' in lines)
+    assert('connections 1' in lines)
+    assert('ports 3' in lines)
+    assert('latency_seconds_bucket{handler="h",le="0.1"} 1' in lines)
+    assert('latency_seconds_bucket{handler="h",le="1"} 2' in lines)
+    assert('latency_seconds_bucket{handler="h",le="+Inf"} 3' in lines)
+    assert('latency_seconds_count{handler="h"} 3' in lines)
+    assert('latency_seconds_sum{handler="h"} 5.55' in lines)
+
+
+def test_server():
+    async def run():
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests').inc(7)
+        server = await MetricsServer(registry).start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        responses = []
+        for path in ['/metrics', '/other']:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+            responses.append(await reader.read())
+            writer.close()
+        server.close()
+        await server.wait_closed()
+        return responses
+    ok, missing = asyncio.run(run())
+    assert(ok.startswith(b'HTTP/1.1 200 OK'))
+    assert(b'requests_total 7\n' in ok)
+    assert(missing.startswith(b'HTTP/1.1 404'))
+
+
+def test_onScrape():
+    async def run():
+        registry = MetricsRegistry()
+        usage = registry.gauge('stream_rss_bytes', 'RSS', ('stream',))
+        usage.labels('gone').set(1)
+        streams = {'a': 100, 'b': 200}
+
+        async def refresh():
+            usage.clear()
+            for name, rss in streams.items():
+                usage.labels(name).set(rss)
+
+        server = await MetricsServer(registry, on_scrape=refresh).start(
+            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+    response = asyncio.run(run())
+    assert(b'stream_rss_bytes{stream="a"} 100\n' in response)
+    assert(b'stream_rss_bytes{stream="b"} 200\n' in response)
+    # Children of streams that ended are dropped
+    assert(b'stream="gone"' not in response)
+
+
+def test_overhead():
+    registry = MetricsRegistry()
+    counter = registry.counter('packets_total', 'Packets', ('device',)) \
+        .labels('device')
+    histogram = registry.histogram('latency_seconds', 'Latency')
+    n_updates = 100000
+    start = time.perf_counter()
+    for idx in range(n_updates):
+        counter.inc()
+        histogram.observe(idx * 1e-6)
+    elapsed = time.perf_counter() - start
+    assert(elapsed / n_updates < 1e-4)
+    assert(counter.value == n_updates)
+
+
+def test_quantile():
+    registry = MetricsRegistry()
+    latency = registry.histogram('latency_seconds', 'Latency', ('handler',),
+                                 buckets=(1, 2, 4))
+    for value in [0.5] * 50 + [1.5] * 49 + [3]:
+        latency.labels('a' if value < 1 else 'b').observe(value)
+    assert(latency.quantile(0.5) == 1)
+    assert(1 < latency.quantile(0.9) < 2)
+    assert(2 < latency.quantile(1.0) <= 4)
+    counter = registry.counter('packets_total', 'Packets', ('device',))
+    counter.labels('a').inc(2)
+    counter.labels('b').inc(3)
+    assert(counter.total() == 5)
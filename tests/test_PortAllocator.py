@@ -1,8 +1,12 @@
+import asyncio
+import time
 from typing import Dict
-from DataServer.portAllocator import PortAllocator
+from DataServer.portAllocator import PortAllocator, partitionBlock
 import socket
 import os
 
+import pytest
+
 def test_PortAllocator():
     start_port = 10200
     end_port = 10300
@@ -75,6 +79,8 @@ def test_PortAllocator():
 
     bad_sock.close()
     available_ports.add(bad_port)
+    # Ports found in use are only picked up again after a re-probe
+    allocator.reprobe()
 
     # We should be able to reserve the full set of available ports
     while len(available_ports) > 0:
@@ -121,4 +127,127 @@ def test_PortAllocator():
         allocator.releasePort(start_port)
     except Exception as e:
         assert(isinstance(e, RuntimeError))
-    
\ No newline at end of file
+
+
+def test_PortAllocatorBenchmark():
+    start_port = 20000
+    end_port = 30000
+    allocator = PortAllocator(start_port, end_port)
+    open_fds = len(os.listdir('/proc/self/fd')) \
+        if os.path.isdir('/proc/self/fd') else None
+
+    # Probe every port in the block once
+    reserved = []
+    while True:
+        try:
+            reserved.append(allocator.reservePort())
+        except RuntimeError:
+            break
+    assert(len(reserved) != 0)
+    assert(allocator.reserved == len(reserved))
+    # Keep one port cycling while every other port stays reserved
+    cycle_port = reserved.pop()
+    allocator.releasePort(cycle_port)
+
+    n_cycles = 10000
+    start = time.perf_counter()
+    for _ in range(n_cycles):
+        port = allocator.reservePort()
+        assert(port == cycle_port)
+        allocator.releasePort(port)
+    elapsed = time.perf_counter() - start
+    per_cycle_us = elapsed / n_cycles * 1e6
+    # A linear scan over the block would take milliseconds per cycle
+    assert(per_cycle_us < 1000)
+
+    for port in reserved:
+        allocator.releasePort(port)
+    assert(allocator.reserved == 0)
+    # Released ports do not keep a socket open
+    if open_fds is not None:
+        assert(len(os.listdir('/proc/self/fd')) == open_fds)
+
+
+def test_PortAllocatorAsync():
+    start_port = 10400
+    end_port = 10410
+    allocator = PortAllocator(start_port, end_port, bind_address='127.0.0.1')
+
+    async def run():
+        async with allocator.lease() as port:
+            assert(start_port <= port < end_port)
+            leased = port
+        # The lease released the port, so it is handed out again first
+        port = await allocator.reserve()
+        assert(port == leased)
+        await allocator.release(port)
+
+        async def hold():
+            async with allocator.lease():
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(hold())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Cancellation released the port
+        port = await allocator.reserve()
+        assert(port == leased)
+        await allocator.release(port)
+
+    asyncio.run(run())
+
+
+def test_PortAllocatorResize():
+    allocator = PortAllocator(10500, 10510, bind_address='127.0.0.1')
+    held = [allocator.reservePort() for _ in range(3)]
+    assert(held == [10500, 10501, 10502])
+    allocator.releasePort(10502)
+
+    allocator.resize(10501, 10506)
+    # Reserved ports are untouched, even the one that left the block
+    assert(allocator.reserved == 2)
+    ports = [allocator.reservePort() for _ in range(4)]
+    # The released port is reused first, then the rest of the new block
+    assert(ports == [10502, 10503, 10504, 10505])
+    try:
+        allocator.reservePort()
+        assert(False)
+    except RuntimeError:
+        pass
+
+    # Once released, a port outside of the block is not handed out again
+    allocator.releasePort(10500)
+    allocator.releasePort(10505)
+    assert(allocator.reservePort() == 10505)
+    assert(allocator.reserved == 5)
+
+    # A reserved port that comes back into the block is kept
+    allocator.resize(10504, 10508)
+    allocator.releasePort(10504)
+    assert(allocator.reservePort() in (10504, 10506))
+    for port in (10501, 10502, 10503):
+        allocator.releasePort(port)
+
+
+def test_PortAllocatorReleaseUnreserved():
+    allocator = PortAllocator(10900, 10905, bind_address='127.0.0.1')
+    # Never handed out, so releasing it must not queue it a second time
+    with pytest.raises(RuntimeError):
+        allocator.releasePort(10903)
+    ports = [allocator.reservePort() for _ in range(5)]
+    assert(sorted(ports) == list(range(10900, 10905)))
+    assert(allocator.reserved == 5)
+    for port in ports:
+        allocator.releasePort(port)
+
+
+def test_partitionBlock():
+    parts = [partitionBlock(9100, 9200, idx, 3) for idx in range(3)]
+    assert(parts[0][0] == 9100)
+    assert(parts[-1][1] == 9200)
+    ports = [port for start, end in parts for port in range(start, end)]
+    assert(ports == list(range(9100, 9200)))
@@ -0,0 +1,86 @@
+import asyncio
+import pathlib
+import uuid
+from typing import List
+
+import pytest
+import yaml
+
+pytest.importorskip('asm_protocol.codec')
+
+from DataServer.devices import Device, DeviceTree, DeviceType
+from DataServer.ffmpegSupervisor import FFmpegSupervisor
+from DataServer.ioExecutor import IOExecutor
+from DataServer.metrics import MetricsRegistry
+from DataServer.rawSink import (FRAME_HEADER, FRAME_SYNC, FrameScanner,
+                                frameChecksum)
+from DataServer.server import ClientHandler, ServerConfig, ServerMetrics
+
+
+class DataPacket:
+    def __init__(self, packet_class: int, packet_id: int, frame: bytes) -> None:
+        self._class = packet_class
+        self._id = packet_id
+        self.frame = frame
+
+
+class FrameCodec:
+    """Decodes every frame to a data packet, which no handler claims
+    """
+
+    def decode(self, data: bytes) -> List[DataPacket]:
+        return [DataPacket(packet_class, packet_id, bytes(frame))
+                for packet_class, packet_id, frame in FrameScanner().scan(data)]
+
+    def encode(self, packets: List[DataPacket]) -> bytes:
+        return b''.join(packet.frame for packet in packets)
+
+
+def make_frame(seq: int) -> bytes:
+    payload = seq.to_bytes(4, 'little')
+    header = FRAME_HEADER.pack(FRAME_SYNC, uuid.uuid4().bytes,
+                               uuid.uuid4().bytes, 0x04, 0x01, len(payload), 0)
+    header = header[:-2] + frameChecksum(header[:-2]).to_bytes(2, 'little')
+    return header + payload + b'\x00\x00'
+
+
+def test_rawIngestOrder(tmp_path: pathlib.Path):
+    data_dir = pathlib.Path(tmp_path, 'data')
+    data_dir.mkdir()
+    config_path = pathlib.Path(tmp_path, 'config.yaml')
+    config_path.write_text(yaml.safe_dump({
+        'data_dir': str(data_dir),
+        'port': 9000,
+        'server_uuid': str(uuid.uuid4()),
+        'video_increment': 300,
+        'rtsp_port_block': [10700, 10710],
+        'raw_data_ingest': True,
+    }))
+
+    async def run():
+        config = ServerConfig(str(config_path))
+        executor = IOExecutor()
+        client = ClientHandler(
+            device_tree=DeviceTree(str(pathlib.Path(data_dir, 'devices.yaml'))),
+            reader=None, writer=None, config=config, io_executor=executor,
+            ffmpeg_supervisor=FFmpegSupervisor(),
+            metrics=ServerMetrics(MetricsRegistry()))
+        client.protocol_codec = FrameCodec()
+        client.client_device = Device(uuid.uuid4(), 'Unit',
+                                      DeviceType.AUTO_REGISTERED)
+        frames = [make_frame(seq) for seq in range(8)]
+        # The first frame of the stream arrives with others behind it
+        await client.ingest_raw(b''.join(frames[:5]))
+        await client.ingest_raw(b''.join(frames[5:]))
+        await client._dispatcher.close()
+        await client._raw_sink.close()
+        executor.shutdown()
+        return pathlib.Path(data_dir, client.client_device.getDevicePath())
+
+    device_dir = asyncio.run(run())
+    data = b''.join(path.read_bytes()
+                    for path in sorted(device_dir.glob('*.bin')))
+    order = [int.from_bytes(bytes(frame[FRAME_HEADER.size:FRAME_HEADER.size + 4]),
+                            'little')
+             for _, _, frame in FrameScanner().scan(data)]
+    assert(order == list(range(8)))
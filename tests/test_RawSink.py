@@ -0,0 +1,107 @@
+import asyncio
+import pathlib
+import uuid
+from typing import List
+
+import pytest
+
+from DataServer.ioExecutor import IOExecutor
+from DataServer.rawSink import (FRAME_HEADER, FRAME_SYNC, DataIndex,
+                                FrameScanner, RawDataSink, RawEndpoint,
+                                frameChecksum)
+
+
+def make_frame(packet_class: int, packet_id: int, payload: bytes) -> bytes:
+    header = FRAME_HEADER.pack(FRAME_SYNC, uuid.uuid4().bytes,
+                               uuid.uuid4().bytes, packet_class, packet_id,
+                               len(payload), 0)
+    header = header[:-2] + frameChecksum(header[:-2]).to_bytes(2, 'little')
+    return header + payload + b'\x00\x00'
+
+
+def test_FrameScanner():
+    frames = [make_frame(0x04, i % 3, bytes(range(i))) for i in range(20)]
+    stream = b'\x00\x01' + b''.join(frames)
+    scanner = FrameScanner()
+    found = []
+    # Feed the stream in chunks that split frames and headers
+    for idx in range(0, len(stream), 37):
+        for packet_class, packet_id, frame in scanner.scan(stream[idx:idx + 37]):
+            assert(isinstance(frame, memoryview))
+            found.append((packet_class, packet_id, bytes(frame)))
+    assert(found == [(0x04, i % 3, frames[i]) for i in range(20)])
+    assert(scanner.discarded_bytes == 2)
+
+
+def test_FrameScannerFalseSync():
+    frames = [make_frame(0x04, 1, b'payload') for _ in range(3)]
+    # A sync word in junk with a large length must not swallow the frames
+    junk = FRAME_HEADER.pack(FRAME_SYNC, bytes(16), bytes(16), 0x04, 1,
+                             0xFFFF, 0)
+    stream = junk + b''.join(frames)
+    scanner = FrameScanner()
+    found = [bytes(frame) for _, _, frame in scanner.scan(stream)]
+    assert(found == frames)
+    assert(scanner.discarded_bytes == len(junk))
+
+
+def test_FrameScannerCodec():
+    codec = pytest.importorskip('asm_protocol.codec')
+    source = uuid.uuid4()
+    dest = uuid.uuid4()
+    packets = [codec.E4E_Heartbeat(source, dest) for _ in range(4)]
+    stream = b'\x00' + codec.Codec().encode(packets)
+    scanner = FrameScanner()
+    found = scanner.scan(stream)
+    assert(len(found) == len(packets))
+    assert(scanner.discarded_bytes == 1)
+    for _, _, frame in found:
+        decoded = codec.Codec().decode(bytes(frame))
+        assert(len(decoded) == 1 and isinstance(decoded[0], codec.E4E_Heartbeat))
+
+
+def test_RawDataSink(tmp_path: pathlib.Path):
+    frames = [make_frame(0x04, i % 2, b'payload') for i in range(10)]
+
+    async def run():
+        executor = IOExecutor()
+        sink = RawDataSink(tmp_path, executor, str(tmp_path))
+        scanner = FrameScanner()
+        for packet_class, packet_id, frame in scanner.scan(b''.join(frames)):
+            sink.add((packet_class, packet_id), frame)
+        sink.flush()
+        await sink.close()
+        executor.shutdown()
+        return sink
+
+    sink = asyncio.run(run())
+    assert(sink.frames == 10)
+    assert(sink.writes == 2)
+    assert(sink.bytes_written == sum(len(frame) for frame in frames))
+    assert(sum(path.stat().st_size for path in tmp_path.glob('*.bin'))
+           == sink.bytes_written)
+
+
+def test_RawEndpointRotation(tmp_path: pathlib.Path):
+    index = DataIndex(tmp_path, interval_s=0)
+    closed: List[pathlib.Path] = []
+    endpoint = RawEndpoint(tmp_path, (0x04, 0x01), rotate_bytes=100,
+                           index=index, on_closed=closed.append)
+    paths = []
+    for _ in range(3):
+        endpoint.writev([bytes(60), bytes(60)])
+        paths.append(endpoint.path)
+    endpoint.close()
+    # Each write exceeds the size limit, so each one starts a new file
+    assert(len(set(paths)) == 3)
+    assert(closed == paths)
+    assert(all(path.stat().st_size == 120 for path in paths))
+    entries = DataIndex.read(tmp_path)
+    assert([entry.fname for entry in entries] == [path.name for path in paths])
+    assert(all(entry.file_key == (0x04, 0x01) for entry in entries))
+    assert(all(entry.offset == 0 for entry in entries))
+
+    path, offset = DataIndex.seek(tmp_path, (0x04, 0x01), entries[-1].timestamp)
+    assert(path == paths[-1])
+    assert(offset == 0)
+    assert(DataIndex.seek(tmp_path, (0x04, 0x02), 0) is None)
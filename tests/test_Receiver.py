@@ -0,0 +1,111 @@
+import asyncio
+import uuid
+
+from DataServer.rawSink import FRAME_HEADER, FRAME_SYNC, frameChecksum
+from DataServer.receiver import PacketReceiver
+
+
+def make_frame(packet_class: int, packet_id: int, payload: bytes) -> bytes:
+    header = FRAME_HEADER.pack(FRAME_SYNC, uuid.uuid4().bytes,
+                               uuid.uuid4().bytes, packet_class, packet_id,
+                               len(payload), 0)
+    header = header[:-2] + frameChecksum(header[:-2]).to_bytes(2, 'little')
+    return header + payload + b'\x00\x00'
+
+
+def feed(receiver: PacketReceiver, data: bytes, step: int) -> None:
+    pos = 0
+    while pos < len(data):
+        buffer = receiver.get_buffer(-1)
+        n_bytes = min(step, len(buffer), len(data) - pos)
+        buffer[:n_bytes] = data[pos:pos + n_bytes]
+        receiver.buffer_updated(n_bytes)
+        pos += n_bytes
+
+
+def test_PacketReceiver():
+    async def run():
+        frames = [make_frame(0x04, 1, bytes(i % 256 for i in range(size)))
+                  for size in [0, 10, 100, 300, 5, 1000, 7]]
+        stream = b'\x00\x01' + b''.join(frames[:3]) + b'junk' + \
+            b''.join(frames[3:])
+        receiver = PacketReceiver(on_connect=lambda receiver: None,
+                                  buffer_size=256)
+        # Split frames and headers across reads
+        feed(receiver, stream, 37)
+        receiver.eof_received()
+        chunks = []
+        while True:
+            chunk = await receiver.read()
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return receiver, chunks, frames
+    receiver, chunks, frames = asyncio.run(run())
+    # Chunks only ever hold whole frames
+    assert(b''.join(chunks) == b''.join(frames))
+    assert(chunks[0].startswith(FRAME_SYNC))
+    assert(receiver.discarded_bytes == 6)
+    # Only the 1000 byte payload outgrew the buffer, which doubled to fit it
+    assert(receiver.reallocations == 3)
+
+
+def test_PacketReceiverSocket():
+    async def run():
+        received = []
+        done = asyncio.Event()
+
+        async def handle(receiver: PacketReceiver):
+            while True:
+                chunk = await receiver.read()
+                if not chunk:
+                    break
+                received.append(chunk)
+                assert(receiver.writer)
+                receiver.writer.write(b'ack')
+                await receiver.writer.drain()
+            receiver.writer.close()
+            done.set()
+
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: PacketReceiver(
+                on_connect=lambda receiver: loop.create_task(handle(receiver))),
+            '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        frames = [make_frame(0x04, i % 3, bytes(i)) for i in range(200)]
+        writer.write(b''.join(frames))
+        await writer.drain()
+        assert(await reader.readexactly(3) == b'ack')
+        writer.write_eof()
+        await asyncio.wait_for(done.wait(), 5)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return received, frames
+    received, frames = asyncio.run(run())
+    assert(b''.join(received) == b''.join(frames))
+
+
+def test_PacketReceiverFalseSync():
+    async def run():
+        frames = [make_frame(0x04, 1, b'payload') for _ in range(3)]
+        # A sync word in junk with a large length must not hold the frames
+        junk = FRAME_HEADER.pack(FRAME_SYNC, bytes(16), bytes(16), 0x04, 1,
+                                 0xFFFF, 0)
+        receiver = PacketReceiver(on_connect=lambda receiver: None,
+                                  buffer_size=256)
+        feed(receiver, junk + b''.join(frames), 37)
+        receiver.eof_received()
+        chunks = []
+        while True:
+            chunk = await receiver.read()
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return receiver, chunks, frames, junk
+    receiver, chunks, frames, junk = asyncio.run(run())
+    assert(b''.join(chunks) == b''.join(frames))
+    assert(receiver.discarded_bytes == len(junk))
+    assert(receiver.reallocations == 0)
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import pathlib
+import uuid
+
+import pytest
+import yaml
+
+pytest.importorskip('asm_protocol.codec')
+
+from DataServer.ioExecutor import IOExecutor
+from DataServer.server import Server
+
+
+def test_reloadWorkerMetricsPort(tmp_path: pathlib.Path, caplog):
+    data_dir = pathlib.Path(tmp_path, 'data')
+    data_dir.mkdir()
+    config_path = pathlib.Path(tmp_path, 'config.yaml')
+    config = {
+        'data_dir': str(data_dir),
+        'port': 9000,
+        'server_uuid': str(uuid.uuid4()),
+        'video_increment': 300,
+        'rtsp_port_block': [10800, 10820],
+        'metrics_port': 9100,
+        'video_catalog': False,
+        'max_rtp_streams': 4,
+    }
+    config_path.write_text(yaml.safe_dump(config))
+    server = Server(str(config_path), worker_index=1, workers=2,
+                    registry_path=str(pathlib.Path(tmp_path, 'devices.sock')))
+    assert(server.config.metrics_port == 9101)
+
+    async def run():
+        server.io_executor = IOExecutor()
+        config['max_rtp_streams'] = 8
+        config_path.write_text(yaml.safe_dump(config))
+        with caplog.at_level(logging.WARNING):
+            assert(await server.reloadConfig())
+        server.io_executor.shutdown()
+
+    asyncio.run(run())
+    # The unchanged metrics port is not reported as needing a restart
+    assert('Restart to apply' not in caplog.text)
+    assert(server.config.metrics_port == 9101)
+    assert(server.config.max_rtp_streams == 8)
+
+
+def test_reloadEventCompactionInterval(tmp_path: pathlib.Path, caplog):
+    data_dir = pathlib.Path(tmp_path, 'data')
+    data_dir.mkdir()
+    config_path = pathlib.Path(tmp_path, 'config.yaml')
+    config = {
+        'data_dir': str(data_dir),
+        'port': 9000,
+        'server_uuid': str(uuid.uuid4()),
+        'video_increment': 300,
+        'rtsp_port_block': [10800, 10820],
+        'video_catalog': False,
+        'event_compaction_interval': 0,
+    }
+    config_path.write_text(yaml.safe_dump(config))
+    server = Server(str(config_path))
+
+    async def run():
+        server.io_executor = IOExecutor()
+        config['event_compaction_interval'] = 60
+        config_path.write_text(yaml.safe_dump(config))
+        with caplog.at_level(logging.WARNING):
+            assert(await server.reloadConfig())
+        server.io_executor.shutdown()
+
+    asyncio.run(run())
+    # The compaction task is only started with the server
+    assert('event_compaction_interval_s' in caplog.text)
+    assert(server.config.event_compaction_interval_s == 0)
@@ -0,0 +1,30 @@
+import asyncio
+
+from DataServer.sendQueue import WatermarkQueue
+
+
+def test_WatermarkQueue():
+    async def run():
+        queue: WatermarkQueue[int] = WatermarkQueue(high_watermark=4,
+                                                    low_watermark=1)
+        for idx in range(4):
+            await queue.put(idx)
+        assert(queue.paused)
+
+        # Producers wait while the queue is above its watermarks
+        blocked = asyncio.create_task(queue.put(4))
+        await asyncio.sleep(0)
+        assert(not blocked.done())
+
+        assert(await queue.get_batch() == [0, 1, 2, 3])
+        # Still paused until the consumer asks for the next batch
+        await asyncio.sleep(0)
+        assert(not blocked.done())
+
+        next_batch = asyncio.create_task(queue.get_batch())
+        await asyncio.wait_for(blocked, 1)
+        assert(await next_batch == [4])
+        assert(not queue.paused)
+        assert(queue.pauses == 1)
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import asyncio
+import datetime as dt
+import pathlib
+import sqlite3
+
+from DataServer.ioExecutor import IOExecutor
+from DataServer.videoCatalog import (SEGMENT_NAME_FORMAT, Segment,
+                                     SegmentListFollower, VideoCatalog)
+
+
+def makeSegment(device: str, start: dt.datetime, length_s: float) -> Segment:
+    return Segment(device=device, start=start,
+                   end=start + dt.timedelta(seconds=length_s), size=1,
+                   path=f'/data/{device}/{start.strftime(SEGMENT_NAME_FORMAT)}')
+
+
+def test_query(tmp_path: pathlib.Path):
+    catalog = VideoCatalog(str(pathlib.Path(tmp_path, 'catalog.sqlite')))
+    base = dt.datetime(2026, 1, 1, 12)
+    for idx in range(100):
+        catalog.add(makeSegment('a', base + dt.timedelta(minutes=5 * idx), 300))
+    catalog.add(makeSegment('b', base, 300))
+
+    found = catalog.query('a', base + dt.timedelta(minutes=7),
+                          base + dt.timedelta(minutes=16))
+    assert([s.start for s in found] ==
+           [base + dt.timedelta(minutes=m) for m in (5, 10, 15)])
+    # Windows that only touch a segment boundary do not overlap it
+    found = catalog.query('a', base + dt.timedelta(minutes=5),
+                          base + dt.timedelta(minutes=10))
+    assert([s.start for s in found] == [base + dt.timedelta(minutes=5)])
+    assert(catalog.query('a', base - dt.timedelta(hours=1), base) == [])
+    assert(len(catalog.query('b', base, base + dt.timedelta(days=1))) == 1)
+    assert(catalog.query('c', base, base + dt.timedelta(days=1)) == [])
+
+    # Re-adding a path replaces its entry
+    catalog.add(makeSegment('a', base, 120))
+    found = catalog.query('a', base, base + dt.timedelta(seconds=1))
+    assert(len(found) == 1 and found[0].end == base + dt.timedelta(minutes=2))
+    catalog.close()
+
+
+def test_journalMode(tmp_path: pathlib.Path):
+    path = str(pathlib.Path(tmp_path, 'nested', 'catalog.sqlite'))
+    VideoCatalog(path).close()
+    db = sqlite3.connect(path)
+    assert(db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal')
+    db.close()
+
+    # A catalog on a network share switches back to a rollback journal
+    VideoCatalog(path, wal=False).close()
+    db = sqlite3.connect(path)
+    assert(db.execute('PRAGMA journal_mode').fetchone()[0] == 'delete')
+    db.close()
+
+
+def test_backfill(tmp_path: pathlib.Path):
+    device_dir = pathlib.Path(tmp_path, 'device')
+    device_dir.mkdir()
+    base = dt.datetime(2026, 1, 1, 12)
+    # The last segment of a recording is cut short by the next recording
+    for offset_s in (0, 300, 420, 1000):
+        start = base + dt.timedelta(seconds=offset_s)
+        pathlib.Path(device_dir, start.strftime(SEGMENT_NAME_FORMAT)).write_bytes(b'0')
+    pathlib.Path(device_dir, 'ffmpeg.log').write_text('')
+
+    catalog = VideoCatalog(str(pathlib.Path(tmp_path, 'catalog.sqlite')))
+    assert(catalog.backfill(str(tmp_path), 300) == 4)
+    segments = catalog.query('device', base, base + dt.timedelta(hours=1))
+    assert([(s.end - s.start).total_seconds() for s in segments] ==
+           [300, 120, 300, 300])
+    # Already cataloged segments are left alone
+    assert(catalog.backfill(str(tmp_path), 300) == 0)
+    catalog.close()
+
+
+def test_SegmentListFollower(tmp_path: pathlib.Path):
+    async def run():
+        catalog = VideoCatalog(str(pathlib.Path(tmp_path, 'catalog.sqlite')))
+        follower = SegmentListFollower(catalog, 'device', str(tmp_path))
+        start = dt.datetime(2026, 1, 1, 12)
+        fname = start.strftime(SEGMENT_NAME_FORMAT)
+        pathlib.Path(tmp_path, fname).write_bytes(b'0' * 10)
+
+        assert(follower.parseLine('garbage\n') is None)
+        assert(follower.parseLine('notes.txt,0.0,1.0\n') is None)
+
+        stream = asyncio.StreamReader()
+        stream.feed_data(f'{fname},0.000000,299.500000\n'.encode())
+        # Closed but already deleted, skipped
+        stream.feed_data(b'2026.01.01.12.05.00.mp4,299.5,599.5\n')
+        stream.feed_eof()
+        executor = IOExecutor(max_workers=1)
+        await follower.follow(stream, executor, 'catalog')
+        executor.shutdown()
+
+        assert(follower.segments == 1)
+        segments = catalog.query('device', start, start + dt.timedelta(hours=1))
+        assert(len(segments) == 1)
+        assert(segments[0].size == 10)
+        assert(segments[0].end == start + dt.timedelta(seconds=299.5))
+        catalog.close()
+    asyncio.run(run())